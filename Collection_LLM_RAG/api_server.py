@@ -0,0 +1,211 @@
+import os
+import json
+import logging
+import argparse
+from typing import List, Optional
+
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from openai import AuthenticationError
+
+from query_service import QueryService
+from user_agent import UserAgent
+from worker_pool import QueryWorkerPool, WorkerAuthenticationError
+from instrumentation import configure_instrumentation
+from trace_callbacks import register_trace_callbacks
+from call_cache import configure_call_cache
+from profiling import configure_profiling
+from local_embeddings import configure_local_embeddings
+from knowledgeBase.shards import configure_sharding
+from knowledgeBase.collection import CollectionManager
+from knowledgeBase.refresh import RefreshScheduler
+
+
+class QueryRequest(BaseModel):
+    question: str = Field(min_length=1)
+    mode: Optional[str] = None
+    collections: Optional[List[str]] = None
+    profile: bool = False
+
+
+class BatchQueryRequest(BaseModel):
+    questions: List[str] = Field(min_length=1)
+    mode: Optional[str] = None
+    collections: Optional[List[str]] = None
+    max_concurrency: Optional[int] = Field(default=None, ge=1)
+
+
+class StreamQueryRequest(BaseModel):
+    question: str = Field(min_length=1)
+    collections: Optional[List[str]] = None
+
+
+def create_api(query_service):
+    """
+    Creates the JSON HTTP API on top of a query service.
+    Endpoints:
+        GET  /collections: The collections that can be queried.
+        POST /collections/reload: Drops the agents and indices of the collections that changed on disk.
+        POST /query: Answers a question.
+        POST /batch_query: Answers several questions concurrently.
+        POST /query/stream: Answers a question as server-sent events, one 'token' event per text delta,
+                            followed by a 'references' event and a 'done' event.
+    Args:
+        query_service (QueryService or QueryWorkerPool): The service that answers the queries, in this process
+                                                         or in worker processes.
+    Returns:
+        FastAPI: The API application.
+    """
+    api = FastAPI(title="Collection-LLM-RAG API", default_response_class=ORJSONResponse)
+
+    # The endpoints are synchronous functions, which FastAPI runs in its thread pool
+    @api.get("/collections")
+    def collections():
+        return {"collections": query_service.list_collections()}
+
+    @api.post("/collections/reload")
+    def reload_collections():
+        return {"changed": query_service.refresh_catalog(force=True)}
+
+    @api.post("/query")
+    def query(request: QueryRequest):
+        try:
+            return query_service.query(question=request.question, mode=request.mode, collections=request.collections, profile=request.profile)
+        except (AuthenticationError, WorkerAuthenticationError):
+            raise HTTPException(status_code=502, detail="Authentication error: Incorrect API key provided.")
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    @api.post("/batch_query")
+    def batch_query(request: BatchQueryRequest):
+        try:
+            results = query_service.batch_query(
+                questions=request.questions,
+                mode=request.mode,
+                collections=request.collections,
+                max_concurrency=request.max_concurrency
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {"results": results}
+
+    @api.post("/query/stream")
+    def query_stream(request: StreamQueryRequest):
+        try:
+            tokens, references = query_service.stream_query(question=request.question, collections=request.collections)
+        except (AuthenticationError, WorkerAuthenticationError):
+            raise HTTPException(status_code=502, detail="Authentication error: Incorrect API key provided.")
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        def events():
+            try:
+                for token in tokens:
+                    if token:
+                        yield "event: token\ndata: {}\n\n".format(json.dumps({"text": token}))
+            except Exception as e:
+                logging.error(">    Streaming of an answer failed: {}".format(e))
+                yield "event: error\ndata: {}\n\n".format(json.dumps({"detail": str(e)}))
+                return
+            yield "event: references\ndata: {}\n\n".format(json.dumps({"references": references}))
+            yield "event: done\ndata: {}\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return api
+
+
+def main():
+    parser = argparse.ArgumentParser(description='JSON HTTP API for querying the collections without the Gradio interface.')
+    parser.add_argument('--host', default=None, help='Host to bind to. Defaults to the value of the configuration file.')
+    parser.add_argument('--port', type=int, default=None, help='Port to bind to. Defaults to the value of the configuration file.')
+    parser.add_argument('--mode', default=None, help='Default mode of the queries. Defaults to the first mode of the configuration file.')
+    parser.add_argument('--llm', default=None, help='Name of the LLM. Defaults to the first API LLM of the configuration file.')
+    parser.add_argument('--embedding', default=None, help='Name of the embedding model. Defaults to the first API embedding model of the configuration file.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes answering the queries, 0 to answer them in this process. Defaults to the value of the configuration file.')
+    parser.add_argument('--openai-api-key', default=os.environ.get('OPENAI_API_KEY', ''), help='OpenAI API key. Defaults to the OPENAI_API_KEY environment variable.')
+    args = parser.parse_args()
+
+    if args.openai_api_key == "":
+        parser.error('An OpenAI API key is required (--openai-api-key or OPENAI_API_KEY).')
+
+    # Loading setting configurations
+    with open('./Collection_LLM_RAG/program_init_config.json', 'r') as file:
+        config_data = json.load(file)
+
+    configure_instrumentation(config_data['Instrumentation'])
+    register_trace_callbacks()
+    configure_call_cache(config_data['CallCache'])
+    configure_profiling(config_data['Profiling'])
+    configure_local_embeddings(config_data['LocalEmbedding'])
+    configure_sharding(config_data['Sharding'])
+
+    service_kwargs = dict(
+        openAI_api=args.openai_api_key,
+        llm_name=args.llm or config_data['LLMs']['API'][0],
+        embedding_name=args.embedding or config_data['Embedding']['API'][0],
+        default_mode=args.mode or config_data['Modes'][0],
+        api_base=config_data['OpenAI-API-base'],
+        subquestion_max_parallel=config_data['SubQuestion']['max_parallel'],
+        subquestion_timeout=config_data['SubQuestion']['timeout_seconds'],
+        context_token_budget=config_data['ContextCompression']['token_budget'],
+        synthesis_mode=config_data['Synthesis']['mode'],
+        max_prompt_tokens=config_data['Synthesis']['max_prompt_tokens'],
+        adaptive_retrieval=config_data['AdaptiveRetrieval'],
+        reranking=config_data['Reranking'],
+        max_batch_concurrency=config_data['API']['max_batch_concurrency']
+    )
+
+    # With worker processes, this process only dispatches the requests and does not load any index
+    num_workers = config_data['API']['workers'] if args.workers is None else args.workers
+    if num_workers > 0:
+        query_service = QueryWorkerPool(
+            num_workers=num_workers,
+            service_kwargs=service_kwargs,
+            config=config_data,
+            worker_threads=config_data['API']['worker_threads'],
+            max_batch_concurrency=config_data['API']['max_batch_concurrency']
+        )
+    else:
+        query_service = QueryService(**service_kwargs)
+
+    # Collections are crawled again in this process, and the workers switch to the new versions when they
+    # see the updated list of collections
+    scheduler = None
+    if config_data['Refresh']['enabled']:
+        scheduler = RefreshScheduler(
+            collection_manager=CollectionManager(),
+            models_factory=lambda details: UserAgent(
+                llm_name=service_kwargs['llm_name'],
+                embedding_name=details['embedding_name'],
+                openAI_api=args.openai_api_key,
+                mode=service_kwargs['default_mode'],
+                api_base=config_data['OpenAI-API-base']
+            ),
+            interval_hours=config_data['Refresh']['interval_hours'],
+            check_seconds=config_data['Refresh']['check_minutes'] * 60,
+            on_refresh=lambda collection_name: query_service.refresh_catalog()
+        )
+        scheduler.start()
+
+    uvicorn.run(
+        create_api(query_service),
+        host=args.host or config_data['API']['host'],
+        port=args.port or config_data['API']['port'],
+        log_level='warning'
+    )
+
+    if scheduler is not None:
+        scheduler.stop()
+    if num_workers > 0:
+        query_service.shutdown()
+
+
+if __name__ == '__main__':
+
+    # Configure logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    main()
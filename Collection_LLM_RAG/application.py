@@ -1,11 +1,58 @@
+import os
 import json
+import time
 import logging
+import threading
+import contextvars
 import gradio as gr
 
 from knowledgeBase.collection import CollectionManager
-from user_agent import UserAgent
+from user_agent import UserAgent, CatalogWatcher, evict_shared_query_engines
+from instrumentation import configure_instrumentation, BuildReport
+from call_cache import configure_call_cache
+from profiling import configure_profiling
+from local_embeddings import configure_local_embeddings
+from knowledgeBase.shards import configure_sharding
+from knowledgeBase.refresh import RefreshScheduler
 
 collection_manager = CollectionManager()
+# Drops the shared query engines and indices of the collections that change on disk, e.g. when they are refreshed.
+# It is created by `launch_app`, or when the first session (e.g. of the load test) is set up, not on import.
+catalog_watcher = None
+_catalog_watcher_lock = threading.Lock()
+
+def get_catalog_watcher():
+    """
+    Returns the watcher of the list of collections, which is created the first time it is needed.
+    Returns:
+        CatalogWatcher: The watcher of the collections of `collection_manager`.
+    """
+    global catalog_watcher
+    with _catalog_watcher_lock:
+        if catalog_watcher is None:
+            catalog_watcher = CatalogWatcher(collection_manager)
+        return catalog_watcher
+
+def follow_catalog(user_models):
+    """
+    Applies the changes of the collections on disk: the shared query engines and indices of the changed
+    collections are dropped, and the agent of the session is set up again if one of its collections
+    changed, so that it queries their current version. The chat memory is kept.
+    Args:
+        user_models (UserAgent): The agent of the session.
+    Returns:
+        None
+    """
+    get_catalog_watcher().refresh()
+    if user_models.agent is None:
+        return
+    current = collection_manager.get_query_engines_detail_by_name([details['name'] for details in user_models.query_engines_details])
+    if current != user_models.query_engines_details:
+        messages = user_models.memory.get_all() if user_models.memory is not None else None
+        user_models.set_agent(query_engines_details=current)
+        if messages is not None and user_models.memory is not None:
+            user_models.memory.set(messages)
+        logging.info('>    Query engine(s) updated to the current version of the collections: {}'.format([details['name'] for details in current]))
 
 def ai_response(user_message, chat_interface, user_models, selected_query_engines):
     """
@@ -28,6 +75,7 @@ def ai_response(user_message, chat_interface, user_models, selected_query_engine
         chat_interface.append({"role": "assistant", "content": "Please select one or more query engines to answer your queries."})
         return "", chat_interface
 
+    follow_catalog(user_models)
     return user_models.interact_with_agent(message=user_message, chat_history=chat_interface)
 
 def clear_chat(chat_interface, user_models):
@@ -115,32 +163,49 @@ def change_models_api(open_ai_api_textbox, user_models):
     if open_ai_api_textbox != "":
         user_models.set_api(open_ai_api_textbox)
     logging.info(">    API key updated.")
+    logging.info('>    Session state uses {:.1f} KB besides the shared models and query engines.'.format(user_models.session_size() / 1024))
 
 def new_query_engine(user_models, path_json_file, type_json, chat_interface):
     """
     Creates a new query engine based on a input json file that contain name of article/papers and their links.
+    The collection is built in a thread, and the metrics of its build are shown every second while it runs.
 
     Args:
         user_models (list): A list of user models to be used by the query engine.
         path_json_file (str): The file path to the JSON configuration file.
         type_json (str): The type of JSON configuration (e.g., 'schema', 'data').
 
-    Returns:
-        None
+    Yields:
+        tuple: The chat and the metrics of the build as Markdown.
     """
     if user_models.openAI_api == "":
         chat_interface.append({"role": "assistant", "content": "API key is not valid or missing. Please provide a valid API key."})
-        return chat_interface
-    
-    try:
-        collection_manager.create_new_collection(user_models, path_json_file, type_json)
-    except Exception as e:
-        chat_interface.append({"role": "assistant", "content": f"An error occurred: {e}"})
-        return chat_interface
+        yield chat_interface, ""
+        return
+
+    report = BuildReport()
+    errors = []
+
+    def build():
+        try:
+            collection_manager.create_new_collection(user_models, path_json_file, type_json, report=report)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(build,), name='build-collection', daemon=True)
+    thread.start()
+    while thread.is_alive():
+        yield chat_interface, report.to_markdown()
+        thread.join(timeout=1.0)
+
+    if errors:
+        chat_interface.append({"role": "assistant", "content": f"An error occurred: {errors[0]}"})
+        yield chat_interface, report.to_markdown()
+        return
 
     logging.info('>    New Query Engine, Vector Index, and Keyword Index were created and saved.')
 
-    return chat_interface
+    yield chat_interface, report.to_markdown()
 
 def on_select_query_engine(user_models, selected_query_engines):
     """
@@ -153,16 +218,33 @@ def on_select_query_engine(user_models, selected_query_engines):
     Returns:
         None
     """
+    get_catalog_watcher().refresh()
     user_models.set_agent(query_engines_details=collection_manager.get_query_engines_detail_by_name(selected_query_engines))
     logging.info('>    Query Engine(s) selected: {}'.format(selected_query_engines))
+    logging.info('>    Session state uses {:.1f} KB besides the shared models and query engines.'.format(user_models.session_size() / 1024))
 
 def delete_query_engine(selected_query_engine):
     """
     """
     collection_manager.delete_query_engine_by_name(selected_query_engine)
+    evict_shared_query_engines(selected_query_engine)
     logging.info('>   Query Engine {} was deleted.'.format(selected_query_engine))
     return None
 
+def query_engines_checkbox():
+    """
+    Returns the query engine selection updated with the current list of query engines, all selected.
+    """
+    names = collection_manager.get_query_engines_name()
+    return gr.CheckboxGroup(choices=names, value=names)
+
+def query_engines_dropdown():
+    """
+    Returns the query engine deletion dropdown updated with the current list of query engines.
+    """
+    names = collection_manager.get_query_engines_name()
+    return gr.Dropdown(choices=names, value=names[0] if names else None)
+
 
 def lock_component(*components):
     """
@@ -186,7 +268,35 @@ def unlock_component(*components):
     
     return [gr.update(interactive=True) for _ in components]
 
-def launch_app(enable_query_engine_management=True):
+def prewarm(query_engines_details):
+    """
+    Imports the packages needed for answering queries and loads the indices of the given collections,
+    so that they are ready when the first user selects them. Called in a background thread once the
+    interface is served.
+    Args:
+        query_engines_details (list of dict): The details of the collections to load.
+    Returns:
+        None
+    """
+    start = time.perf_counter()
+
+    # Packages that `UserAgent` imports when its models and agent are first set
+    import cached_models  # noqa: F401
+    import llama_index.core.agent.react  # noqa: F401
+    import knowledgeBase.hybrid_query_engine  # noqa: F401
+    import knowledgeBase.bounded_query_engine  # noqa: F401
+    from trace_callbacks import register_trace_callbacks
+
+    register_trace_callbacks()
+
+    for details in query_engines_details:
+        try:
+            collection_manager.preload_collection(details['name'])
+        except Exception as e:
+            logging.error('>    Indices of {} could not be loaded: {}'.format(details['name'], e))
+    logging.info('>    Prewarm finished in {:.1f} s.'.format(time.perf_counter() - start))
+
+def launch_app(enable_query_engine_management=True, fast_startup=False, import_profiler=None):
     """
     Launches the web-based GUI application for LLMConfRAG.
 
@@ -209,6 +319,11 @@ def launch_app(enable_query_engine_management=True):
     - Real-time updates for UI elements.
 
     **Notes:**
+    - LlamaIndex, Chroma and OpenAI are imported when they are first used. With `fast_startup`, they and
+      the indices of all collections are loaded in a background thread once the interface is served.
+    - If an `import_profiler` is given, it is stopped once the interface is served and its report is logged.
+    - Per-stage latencies of queries are written to the trace log and served on the local metrics
+      endpoint configured in the `Instrumentation` section of the configuration file.
     - The function expects a configuration file at `./Collection_LLM_RAG/program_init_config.json`.
     - Gradio is used to build the web interface.
     - Query engine management features are controlled by the `enable_query_engine_management` flag.
@@ -223,20 +338,73 @@ def launch_app(enable_query_engine_management=True):
         config_data = json.load(file)         
     llm_names = [name + ' (Local)' for name in config_data['LLMs']['local']]
     llm_names.extend([name for name in config_data['LLMs']['API']])
-    emb_names = [name + ' (Local)' for name in config_data['Embedding']['local']]
-    emb_names.extend([name for name in config_data['Embedding']['API']])
+    # The API embedding models come first, so the default model does not change when local models are added
+    emb_names = [name for name in config_data['Embedding']['API']]
+    emb_names.extend([name + ' (Local)' for name in config_data['Embedding']['local']])
+
+    # Per-query trace log and local metrics endpoint
+    configure_instrumentation(config_data['Instrumentation'])
+    # The tracing callback manager is the default of LlamaIndex, which `prewarm` imports with `fast_startup`
+    if not fast_startup:
+        from trace_callbacks import register_trace_callbacks
+        register_trace_callbacks()
+
+    # Cache of the deterministic LLM and embedding calls, shared with the other processes
+    configure_call_cache(config_data['CallCache'])
+    configure_profiling(config_data['Profiling'])
+    configure_local_embeddings(config_data['LocalEmbedding'])
+
+    # Number of shards of new collections, and where the shards of collections are searched
+    configure_sharding(config_data['Sharding'])
+
+    # The list of collections is followed from the state it has when the application starts
+    get_catalog_watcher()
+
+    # Collections are crawled again in the background with the OpenAI API key of the environment, and
+    # the sessions switch to their new versions with their next message
+    scheduler = None
+    if config_data['Refresh']['enabled']:
+        if os.environ.get('OPENAI_API_KEY', '') == '':
+            logging.warning('>    Refresh is enabled but OPENAI_API_KEY is not set, so collections are not refreshed.')
+        else:
+            scheduler = RefreshScheduler(
+                collection_manager=collection_manager,
+                models_factory=lambda details: UserAgent(
+                    llm_name=config_data['LLMs']['API'][0],
+                    embedding_name=details['embedding_name'],
+                    openAI_api=os.environ['OPENAI_API_KEY'],
+                    mode=config_data['Modes'][0],
+                    api_base=config_data['OpenAI-API-base']
+                ),
+                interval_hours=config_data['Refresh']['interval_hours'],
+                check_seconds=config_data['Refresh']['check_minutes'] * 60,
+                on_refresh=lambda collection_name: get_catalog_watcher().refresh()
+            )
+
+    # The list of collections is read once for building the interface
+    query_engines_details = collection_manager.get_query_engines_detail()
+    query_engine_names = [qe_i['name'] for qe_i in query_engines_details]
 
     # Web based GUI
     with gr.Blocks(theme=gr.themes.Ocean()) as app:
         
-        # Each user has its own models and settings
+        # Each user has its own settings, agent and chat memory. Gradio deep-copies the state for
+        # every session, and the copies share the models and query engines (see `UserAgent.__deepcopy__`)
         user_models = gr.State(
             UserAgent(
                 llm_name=llm_names[0], 
                 embedding_name=emb_names[0], 
                 mode=config_data['Modes'][0],
-                query_engines_details=collection_manager.get_query_engines_detail(), 
-                openAI_api="")
+                query_engines_details=query_engines_details, 
+                openAI_api="",
+                subquestion_max_parallel=config_data['SubQuestion']['max_parallel'],
+                subquestion_timeout=config_data['SubQuestion']['timeout_seconds'],
+                api_base=config_data['OpenAI-API-base'],
+                context_token_budget=config_data['ContextCompression']['token_budget'],
+                synthesis_mode=config_data['Synthesis']['mode'],
+                max_prompt_tokens=config_data['Synthesis']['max_prompt_tokens'],
+                adaptive_retrieval=config_data['AdaptiveRetrieval'],
+                reranking=config_data['Reranking'])
             )
         
         with gr.Row():
@@ -280,8 +448,8 @@ def launch_app(enable_query_engine_management=True):
 
                 # Selecting one or more query engines to answer queries
                 selected_query_engines = gr.CheckboxGroup(
-                                            collection_manager.get_query_engines_name(), 
-                                            value=collection_manager.get_query_engines_name(), 
+                                            query_engine_names, 
+                                            value=query_engine_names, 
                                             label="Select Existing Query Engines to Use", interactive=True)
 
             # Third column
@@ -297,10 +465,13 @@ def launch_app(enable_query_engine_management=True):
                                                      label='Type of Files in Directory', 
                                                      interactive=enable_query_engine_management)
                     button_create_new_Query_engine = gr.Button(value="Create", interactive=enable_query_engine_management)
+
+                    # Metrics of the collection being built, updated while it is built
+                    build_metrics = gr.Markdown()
                     
                 with gr.Accordion("🗑️ Delete Query Engine"):
                     # Select a query engine to delete
-                    delete_query_engine_dropdown = gr.Dropdown(collection_manager.get_query_engines_name(), label="Select Query Engine to Delete", interactive=enable_query_engine_management)
+                    delete_query_engine_dropdown = gr.Dropdown(query_engine_names, label="Select Query Engine to Delete", interactive=enable_query_engine_management)
                     button_delete_query_engine = gr.Button(value="Delete", interactive=False)
                        
 
@@ -410,12 +581,10 @@ def launch_app(enable_query_engine_management=True):
             inputs=[delete_query_engine_dropdown],
             outputs=None
         ).then(
-            fn=lambda: gr.CheckboxGroup(choices=collection_manager.get_query_engines_name(), value=collection_manager.get_query_engines_name()), 
+            fn=query_engines_checkbox, 
             outputs=selected_query_engines
         ).then(
-            lambda: gr.Dropdown(
-                choices=collection_manager.get_query_engines_name(), 
-                value=collection_manager.get_query_engines_name()[0] if collection_manager.get_query_engines_name() else None), 
+            fn=query_engines_dropdown, 
             outputs=delete_query_engine_dropdown
         ).then(
             fn=lambda: gr.Button(value="Delete", interactive=False), 
@@ -432,18 +601,14 @@ def launch_app(enable_query_engine_management=True):
         ).then(
             new_query_engine,
             inputs=[user_models, path_documents_json_file, type_documents_folder, chat_interface], 
-            outputs=[chat_interface]
+            outputs=[chat_interface, build_metrics]
         ).then(
             lambda: gr.Button(value="Create", interactive=False), outputs=button_create_new_Query_engine
         ).then(
-            lambda: gr.CheckboxGroup(
-                choices=collection_manager.get_query_engines_name(), 
-                value=collection_manager.get_query_engines_name()), 
+            fn=query_engines_checkbox, 
             outputs=selected_query_engines
         ).then(
-            lambda: gr.Dropdown(
-                choices=collection_manager.get_query_engines_name(), 
-                value=collection_manager.get_query_engines_name()[0] if collection_manager.get_query_engines_name() else None), 
+            fn=query_engines_dropdown, 
             outputs=delete_query_engine_dropdown
         ).then(
             fn=on_select_query_engine, inputs=[user_models, selected_query_engines]
@@ -453,7 +618,22 @@ def launch_app(enable_query_engine_management=True):
 
 
     # Launch the web based GUI
-    app.launch()
+    app.launch(prevent_thread_lock=True)
+
+    if import_profiler is not None:
+        import_profiler.stop()
+        import_profiler.log_report()
+
+    if fast_startup:
+        threading.Thread(target=prewarm, args=(query_engines_details,), name='prewarm', daemon=True).start()
+    if scheduler is not None:
+        scheduler.start()
+
+    # Serve the GUI until the process is stopped
+    app.block_thread()
+
+    if scheduler is not None:
+        scheduler.stop()
 
 
     
\ No newline at end of file
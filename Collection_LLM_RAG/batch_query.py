@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from query_service import QueryService
+from utils import RateLimiter
+from instrumentation import configure_instrumentation, percentile
+from trace_callbacks import register_trace_callbacks
+from call_cache import configure_call_cache, get_call_cache
+from profiling import configure_profiling
+from local_embeddings import configure_local_embeddings
+from knowledgeBase.shards import configure_sharding
+
+
+def load_questions(path):
+    """
+    Loads the questions of a batch run. Supported formats are JSON lines ('.jsonl'), a JSON list ('.json')
+    and plain text with one question per line. JSON entries are either strings or objects with a 'question'
+    and optionally an 'id', 'collections' (overriding the collections of the run) and any other fields
+    (e.g. the expected answer), which are copied to the output.
+    Args:
+        path (str): The path of the question file.
+    Returns:
+        list of dict: The questions, each with an 'id' and a 'question'.
+    Raises:
+        ValueError: If an entry has no question or two entries have the same id.
+    """
+    with open(path, 'r') as file:
+        if path.endswith('.jsonl'):
+            entries = [json.loads(line) for line in file if line.strip()]
+        elif path.endswith('.json'):
+            entries = json.load(file)
+        else:
+            entries = [line.strip() for line in file if line.strip()]
+
+    questions = []
+    seen_ids = set()
+    for idx, entry in enumerate(entries):
+        if isinstance(entry, str):
+            entry = {"question": entry}
+        if not entry.get('question'):
+            raise ValueError('Entry {} of {} has no question.'.format(idx, path))
+        entry = {"id": str(entry.get('id', idx)), **{key: value for key, value in entry.items() if key != 'id'}}
+        if entry['id'] in seen_ids:
+            raise ValueError('Question id {} appears more than once in {}.'.format(entry['id'], path))
+        seen_ids.add(entry['id'])
+        questions.append(entry)
+    return questions
+
+def resume_output(output_path):
+    """
+    Prepares the output file of a previous run to be resumed: the records of questions that failed (and lines
+    cut off because the run was killed while writing them) are removed, as the failed questions are asked
+    again, so every question appears once in the output.
+    Args:
+        output_path (str): The path of the JSON lines output.
+    Returns:
+        set of str: The ids of the answered questions.
+    """
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    lines = []
+    with open(output_path, 'r') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if 'error' not in record and str(record['id']) not in completed:
+                completed.add(str(record['id']))
+                lines.append(line if line.endswith('\n') else line + '\n')
+
+    # The file is replaced at once, so the answers are kept if the run is killed while it is written
+    temp_path = output_path + '.tmp'
+    with open(temp_path, 'w') as file:
+        file.writelines(lines)
+    os.replace(temp_path, output_path)
+    return completed
+
+def run_batch(query_service, questions, output_path, mode, collections=None, concurrency=4, rate_per_minute=0):
+    """
+    Answers questions concurrently and appends one JSON line per question to the output file as soon as it
+    is answered, with the answer, the references and their scores, and the latency.
+    Args:
+        query_service (QueryService): The service that answers the questions.
+        questions (list of dict): The questions, as returned by `load_questions`.
+        output_path (str): The path of the JSON lines output.
+        mode (str): The mode of the agent.
+        collections (list of str, optional): The names of the collections. Defaults to all collections.
+        concurrency (int): The number of questions answered at the same time.
+        rate_per_minute (float): The maximum number of questions started per minute. 0 disables the limit.
+    Returns:
+        list of dict: The written records.
+    """
+    rate_limiter = RateLimiter(rate_per_minute)
+    write_lock = threading.Lock()
+    records = []
+
+    def answer(entry):
+        rate_limiter.acquire()
+        start = time.perf_counter()
+        try:
+            result = query_service.query(
+                question=entry['question'],
+                mode=mode,
+                collections=entry.get('collections', collections)
+            )
+        except Exception as e:
+            logging.error('>    Question {} could not be answered: {}'.format(entry['id'], e))
+            result = {"error": str(e), "latency_ms": (time.perf_counter() - start) * 1000}
+        return {**entry, **result}
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'a') as output_file, ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, answer, entry) for entry in questions]
+        try:
+            for future in as_completed(futures):
+                record = future.result()
+                with write_lock:
+                    output_file.write(json.dumps(record, default=str) + '\n')
+                    output_file.flush()
+                records.append(record)
+                logging.info('>    [{}/{}] Question {} {} in {:.0f} ms.'.format(
+                    len(records), len(questions), record['id'], 'failed' if 'error' in record else 'answered', record['latency_ms']))
+        except KeyboardInterrupt:
+            logging.info('>    Interrupted; run again with the same output file to resume.')
+            for future in futures:
+                future.cancel()
+            raise
+    return records
+
+def main():
+    parser = argparse.ArgumentParser(description='Answers a file of questions with the collections and writes the results as JSON lines.')
+    parser.add_argument('questions', help='Question file: .jsonl, .json or plain text with one question per line.')
+    parser.add_argument('--output', default=None, help='JSON lines output. Defaults to Data/batch-results/<question file name>.jsonl.')
+    parser.add_argument('--mode', default='Router-Based Query Engines', help='Mode of the agent.')
+    parser.add_argument('--collections', nargs='+', default=None, help='Names of the collections. Defaults to all collections.')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of questions answered at the same time.')
+    parser.add_argument('--rate-limit', type=float, default=0, help='Maximum number of questions started per minute. 0 disables the limit.')
+    parser.add_argument('--llm', default=None, help='Name of the LLM. Defaults to the first API LLM of the configuration file.')
+    parser.add_argument('--embedding', default=None, help='Name of the embedding model. Defaults to the first API embedding model of the configuration file.')
+    parser.add_argument('--openai-api-key', default=os.environ.get('OPENAI_API_KEY', ''), help='OpenAI API key. Defaults to the OPENAI_API_KEY environment variable.')
+    parser.add_argument('--restart', action='store_true', help='Discard the results of a previous run instead of resuming it.')
+    args = parser.parse_args()
+
+    if args.openai_api_key == "":
+        parser.error('An OpenAI API key is required (--openai-api-key or OPENAI_API_KEY).')
+
+    output = args.output or os.path.join('Data', 'batch-results', os.path.splitext(os.path.basename(args.questions))[0] + '.jsonl')
+
+    # Loading setting configurations
+    with open('./Collection_LLM_RAG/program_init_config.json', 'r') as file:
+        config_data = json.load(file)
+
+    configure_instrumentation({**config_data['Instrumentation'], "metrics_port": None})
+    register_trace_callbacks()
+    configure_call_cache(config_data['CallCache'])
+    configure_profiling(config_data['Profiling'])
+    configure_local_embeddings(config_data['LocalEmbedding'])
+    configure_sharding(config_data['Sharding'])
+
+    questions = load_questions(args.questions)
+    if args.restart and os.path.exists(output):
+        os.remove(output)
+    completed = resume_output(output)
+    pending = [entry for entry in questions if entry['id'] not in completed]
+    logging.info('>    {} questions, {} already answered, {} to answer.'.format(len(questions), len(completed & {q['id'] for q in questions}), len(pending)))
+
+    query_service = QueryService(
+        openAI_api=args.openai_api_key,
+        llm_name=args.llm or config_data['LLMs']['API'][0],
+        embedding_name=args.embedding or config_data['Embedding']['API'][0],
+        default_mode=args.mode,
+        api_base=config_data['OpenAI-API-base'],
+        subquestion_max_parallel=config_data['SubQuestion']['max_parallel'],
+        subquestion_timeout=config_data['SubQuestion']['timeout_seconds'],
+        context_token_budget=config_data['ContextCompression']['token_budget'],
+        synthesis_mode=config_data['Synthesis']['mode'],
+        max_prompt_tokens=config_data['Synthesis']['max_prompt_tokens'],
+        adaptive_retrieval=config_data['AdaptiveRetrieval'],
+        reranking=config_data['Reranking']
+    )
+
+    # Load the indices of the collections of the run once, before the first question.
+    # Collections of individual questions are loaded when they are first used.
+    query_service.preload_collections(args.collections)
+
+    start = time.perf_counter()
+    records = run_batch(
+        query_service=query_service,
+        questions=pending,
+        output_path=output,
+        mode=args.mode,
+        collections=args.collections,
+        concurrency=args.concurrency,
+        rate_per_minute=args.rate_limit
+    )
+    duration = time.perf_counter() - start
+
+    latencies = sorted(record['latency_ms'] for record in records if 'error' not in record)
+    num_errors = sum(1 for record in records if 'error' in record)
+    logging.info('>    {} questions answered, {} failed in {:.1f} s; latency p50 {} ms, p95 {} ms. Results saved to {}'.format(
+        len(latencies), num_errors, duration,
+        '{:.0f}'.format(percentile(latencies, 50)) if latencies else '-',
+        '{:.0f}'.format(percentile(latencies, 95)) if latencies else '-',
+        output))
+    if get_call_cache() is not None:
+        for kind, stats in sorted(get_call_cache().stats()['kinds'].items()):
+            logging.info('>    Call cache {}: {} hits, {} misses ({:.0%} hit rate).'.format(kind, stats['hits'], stats['misses'], stats['hit_rate']))
+
+
+if __name__ == '__main__':
+
+    # Configure logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    main()
@@ -0,0 +1,288 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+from datetime import datetime
+from types import SimpleNamespace
+
+from knowledgeBase.collection import CollectionManager, create_text_splitter, documents_from_scraped_data
+from knowledgeBase.hybrid_query_engine import load_hybrid_query_engine
+from knowledgeBase.text_extraction_webpages import extract_text_from_html
+from instrumentation import metrics_registry, percentile
+from trace_callbacks import register_trace_callbacks
+from mock_models import create_mock_models
+from local_embeddings import configure_local_embeddings
+
+
+def generate_vocabulary(size, rng):
+    """
+    Generates a vocabulary of pseudo-words built from random syllables.
+    Args:
+        size (int): The number of words.
+        rng (random.Random): The random number generator.
+    Returns:
+        list of str: The generated words.
+    """
+    syllables = ['ka', 'lo', 'mi', 'ne', 'ra', 'tu', 'si', 'po', 'ven', 'dor', 'lex', 'qua', 'bri', 'zen', 'tor']
+    vocabulary = set()
+    while len(vocabulary) < size:
+        vocabulary.add(''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    return sorted(vocabulary)
+
+def generate_corpus(num_documents, words_per_document=1500, vocabulary_size=5000, seed=0):
+    """
+    Generates a synthetic collection in the format of the scraped data of `scrape_articles`.
+    Word frequencies follow a Zipf-like distribution, so keyword and semantic search behave
+    similarly to real text. The same seed always generates the same collection.
+    Args:
+        num_documents (int): The number of documents.
+        words_per_document (int): The average number of words of a document.
+        vocabulary_size (int): The number of distinct words.
+        seed (int): The seed of the random number generator.
+    Returns:
+        tuple: The scraped data (dict with 'description' and 'data') and the vocabulary.
+    """
+    rng = random.Random(seed)
+    vocabulary = generate_vocabulary(vocabulary_size, rng)
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+
+    data = []
+    for doc_i in range(num_documents):
+        num_words = max(10, int(rng.gauss(words_per_document, words_per_document / 4)))
+        words = rng.choices(vocabulary, weights=weights, k=num_words)
+        data.append({
+            "Name": "Synthetic document {}".format(doc_i),
+            "Link": "https://example.com/synthetic/{}".format(doc_i),
+            "Content": ' '.join(words)
+        })
+    return {"description": "A synthetic collection for benchmarking.", "data": data}, vocabulary
+
+def render_html(document):
+    """
+    Renders a document of a synthetic collection as a webpage, including elements that are
+    removed during text extraction.
+    Args:
+        document (dict): A document with 'Name' and 'Content'.
+    Returns:
+        str: The HTML source of the webpage.
+    """
+    words = document['Content'].split(' ')
+    paragraphs = [' '.join(words[i:i + 120]) for i in range(0, len(words), 120)]
+    body = ''.join('<p>{}</p>'.format(paragraph) for paragraph in paragraphs)
+    return ('<html><head><title>{0}</title><style>p {{margin: 0}}</style><script>var x = 1;</script></head>'
+            '<body><header>{0}</header><nav><a href="/">Home</a></nav>{1}'
+            '<pre>print("{0}")</pre><footer>Footer</footer></body></html>').format(document['Name'], body)
+
+def generate_questions(vocabulary, num_questions, seed=0):
+    """
+    Generates questions made of frequent and rare words of the vocabulary.
+    """
+    rng = random.Random(seed + 1)
+    return ['What is {} and how is it related to {} {}?'.format(
+                rng.choice(vocabulary[:200]), rng.choice(vocabulary), rng.choice(vocabulary))
+            for _ in range(num_questions)]
+
+def directory_size(path):
+    """
+    Returns the total size in bytes of the files in a directory.
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            total += os.path.getsize(os.path.join(root, file_name))
+    return total
+
+def summarize(values):
+    """
+    Summarizes a list of durations in milliseconds.
+    """
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean_ms": statistics.fmean(values) if values else None,
+        "p50_ms": percentile(values, 50),
+        "p95_ms": percentile(values, 95),
+        "p99_ms": percentile(values, 99),
+        "max_ms": values[-1] if values else None
+    }
+
+def benchmark_collection_size(num_documents, args, work_dir):
+    """
+    Runs all benchmarks for a synthetic collection of the given size.
+    Args:
+        num_documents (int): The number of documents of the collection.
+        args (argparse.Namespace): The command line arguments.
+        work_dir (str): A temporary directory for the indices.
+    Returns:
+        dict: The results of the benchmarks.
+    """
+    logging.info('>    Benchmarking a collection with {} documents ...'.format(num_documents))
+    data, vocabulary = generate_corpus(num_documents, words_per_document=args.words_per_document, seed=args.seed)
+    model_llm, model_embd = create_mock_models(llm_latency=args.llm_latency, embedding_latency=args.embedding_latency)
+    embedding_name = 'HashEmbedding (Benchmark)'
+    if args.local_embedding:
+        from local_models import LocalEmbedding
+
+        model_embd = LocalEmbedding(model_name=args.local_embedding)
+        embedding_name = args.local_embedding
+    user_models = SimpleNamespace(model_llm=model_llm, model_embd=model_embd, embedding_name=embedding_name)
+    corpus_bytes = sum(len(entity['Content'].encode('utf-8')) for entity in data['data'])
+    results = {"num_documents": num_documents, "corpus_bytes": corpus_bytes}
+
+    # Scrape parsing
+    pages = [render_html(entity) for entity in data['data']]
+    start = time.perf_counter()
+    for page in pages:
+        extract_text_from_html(page)
+    duration = time.perf_counter() - start
+    results["scrape_parsing"] = {
+        "seconds": duration,
+        "documents_per_second": len(pages) / duration,
+        "megabytes_per_second": sum(len(page) for page in pages) / duration / 1e6
+    }
+
+    # Chunking
+    documents = documents_from_scraped_data(data)
+    start = time.perf_counter()
+    chunks = create_text_splitter().get_nodes_from_documents(documents)
+    duration = time.perf_counter() - start
+    results["chunking"] = {
+        "seconds": duration,
+        "num_chunks": len(chunks),
+        "chunks_per_second": len(chunks) / duration
+    }
+
+    # Building the vector and keyword indices
+    collection_manager = CollectionManager(
+        scraped_data_path=os.path.join(work_dir, 'output-processed-sources'),
+        vector_index_save_path=os.path.join(work_dir, 'collections'),
+        keyword_index_save_path=os.path.join(work_dir, 'keyword-index'),
+        query_engines_info_json=os.path.join(work_dir, 'query_engines_list.json'),
+        chunk_store_save_path=os.path.join(work_dir, 'chunk-store')
+    )
+    collection_name = 'Benchmark-{}'.format(num_documents)
+    metrics_registry.reset()
+    start = time.perf_counter()
+    collection_manager.build_collection(user_models=user_models, data=data, collection_name=collection_name, num_shards=args.shards)
+    results["collection_build"] = {"seconds": time.perf_counter() - start, "num_shards": args.shards}
+    stages = metrics_registry.snapshot()
+    for stage, key in [("ingest.vector_index", "vector_index_build"), ("ingest.keyword_index", "keyword_index_build")]:
+        # Shards are built in parallel, so the slowest shard is the build time of the index
+        seconds = stages[stage]["max_ms"] / 1000
+        results[key] = {
+            "seconds": seconds,
+            "documents_per_second": num_documents / seconds,
+            "chunks_per_second": len(chunks) / seconds
+        }
+    # The chunks of the shards are embedded in parallel, so the slowest shard is the embedding time
+    results["embedding"] = {
+        "model": embedding_name,
+        "seconds": stages["ingest.embed"]["max_ms"] / 1000,
+        "chunks_per_second": len(chunks) / (stages["ingest.embed"]["max_ms"] / 1000)
+    }
+    storage_names = collection_manager.shard_storage_names(collection_name)
+    results["disk_bytes"] = {
+        "vector_index": sum(directory_size(collection_manager.vector_index_path(name)) for name in storage_names),
+        "keyword_index": sum(os.path.getsize(collection_manager.keyword_store_path(name)) for name in storage_names),
+        "chunk_store": sum(os.path.getsize(collection_manager.chunk_store_path(name)) for name in storage_names)
+    }
+
+    # Loading the indices (of all shards, one after the other)
+    vector_load, keyword_load = [], []
+    for _ in range(args.load_repeats):
+        start = time.perf_counter()
+        for name in storage_names:
+            collection_manager.load_vector_index_from_file(query_engine_name=collection_name, model_embd=model_embd, storage_name=name)
+        vector_load.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        for name in storage_names:
+            collection_manager.load_keyword_index_from_file(query_engine_name=collection_name, model_llm=model_llm, storage_name=name)
+        keyword_load.append((time.perf_counter() - start) * 1000)
+    results["vector_index_load"] = summarize(vector_load)
+    results["keyword_index_load"] = summarize(keyword_load)
+
+    # Querying the hybrid query engine
+    query_engine = load_hybrid_query_engine(
+        model_llm=model_llm,
+        model_embd=model_embd,
+        query_engine_name=collection_name,
+        query_engine_description=data['description'],
+        collection_manager=collection_manager
+    )
+    metrics_registry.reset()
+    latencies = []
+    for question in generate_questions(vocabulary, args.queries, seed=args.seed):
+        start = time.perf_counter()
+        query_engine.query(question)
+        latencies.append((time.perf_counter() - start) * 1000)
+    results["query_latency"] = summarize(latencies)
+    results["query_stages"] = metrics_registry.snapshot()
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of collection ingestion and querying with local stand-in models.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[25, 100, 400], help='Number of documents of the benchmarked collections.')
+    parser.add_argument('--words-per-document', type=int, default=1500, help='Average number of words of a document.')
+    parser.add_argument('--queries', type=int, default=20, help='Number of queries per collection.')
+    parser.add_argument('--load-repeats', type=int, default=3, help='Number of times the indices are loaded.')
+    parser.add_argument('--llm-latency', type=float, default=0.0, help='Artificial latency in seconds of every LLM call.')
+    parser.add_argument('--embedding-latency', type=float, default=0.0, help='Artificial latency in seconds of every embedding call.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic collections.')
+    parser.add_argument('--local-embedding', default=None, help="Local embedding model used instead of the stand-in, e.g. 'Hashed n-grams (Local)'.")
+    parser.add_argument('--shards', type=int, default=1, help='Number of shards of the benchmarked collections.')
+    parser.add_argument('--output', default=None, help='Path of the JSON report. Defaults to Data/benchmarks/benchmark-<time>.json.')
+    args = parser.parse_args()
+
+    register_trace_callbacks()
+    if args.local_embedding:
+        with open('./Collection_LLM_RAG/program_init_config.json', 'r') as file:
+            configure_local_embeddings(json.load(file)['LocalEmbedding'])
+
+    output = args.output or os.path.join('Data', 'benchmarks', 'benchmark-{}.json'.format(datetime.now().strftime('%Y%m%d-%H%M%S')))
+
+    report = {
+        "created": datetime.now().isoformat(timespec='seconds'),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "results": []
+    }
+
+    work_dir = tempfile.mkdtemp(prefix='rag-benchmark-')
+    try:
+        for num_documents in args.sizes:
+            report["results"].append(benchmark_collection_size(num_documents, args, work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=4)
+
+    for result in report["results"]:
+        logging.info('>    {} documents: parse {:.0f} docs/s, chunk {:.0f} chunks/s, vector index {:.1f} docs/s, '
+                     'keyword index {:.1f} docs/s, query p50 {:.1f} ms, p95 {:.1f} ms'.format(
+                        result["num_documents"],
+                        result["scrape_parsing"]["documents_per_second"],
+                        result["chunking"]["chunks_per_second"],
+                        result["vector_index_build"]["documents_per_second"],
+                        result["keyword_index_build"]["documents_per_second"],
+                        result["query_latency"]["p50_ms"],
+                        result["query_latency"]["p95_ms"]))
+    logging.info('>    Benchmark report saved to {}'.format(output))
+
+
+if __name__ == '__main__':
+
+    # Configure logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    main()
@@ -0,0 +1,257 @@
+import threading
+from array import array
+
+from openai.types.chat import ChatCompletion
+from openai.types.create_embedding_response import CreateEmbeddingResponse, Usage
+from openai.types.embedding import Embedding
+from llama_index.llms.openai import OpenAI
+from llama_index.embeddings.openai import OpenAIEmbedding
+
+from call_cache import call_key, get_call_cache, credential_fingerprint
+
+# The OpenAI models of LlamaIndex send their requests with the clients returned by `_get_client` and
+# `_get_aclient`. The models below wrap these clients so that the requests are looked up in the call
+# cache first, keyed by exactly what is sent to the API.
+# The key of a call does not depend on the API key, so that all users share the cache. A cached response
+# is therefore only served to an API key once a request with it succeeded in the process; the first
+# time, the key is checked with an authenticated request that lists the models.
+
+# API keys (by API base and fingerprint) with which a request succeeded
+_valid_credentials = set()
+_valid_credentials_lock = threading.Lock()
+
+
+class _Credential:
+    """
+    The API key of an OpenAI client, which is checked once per process before cached responses are served to it.
+    """
+
+    def __init__(self, client, api_base):
+        self._client = client
+        self._key = (api_base, credential_fingerprint(client.api_key))
+
+    def is_valid(self):
+        with _valid_credentials_lock:
+            return self._key in _valid_credentials
+
+    def set_valid(self):
+        with _valid_credentials_lock:
+            _valid_credentials.add(self._key)
+
+    def validate(self):
+        """
+        Raises the error of the API (e.g. openai.AuthenticationError) if the key is not valid.
+        """
+        if not self.is_valid():
+            self._client.models.list()
+            self.set_valid()
+
+    async def avalidate(self):
+        if not self.is_valid():
+            await self._client.models.list()
+            self.set_valid()
+
+
+class _CachedChatCompletions:
+    """
+    Chat completions of an OpenAI client that are cached when they are deterministic (temperature 0, not streamed).
+    """
+
+    def __init__(self, completions, api_base, credential):
+        self._completions = completions
+        self._api_base = api_base
+        self._credential = credential
+
+    def _key(self, kwargs):
+        """
+        Returns the key of a request, or None if its response must not be cached.
+        """
+        if kwargs.get('stream') or kwargs.get('temperature') != 0 or kwargs.get('n', 1) != 1:
+            return None
+        return call_key('chat', {"api_base": self._api_base, **kwargs})
+
+    @staticmethod
+    def _cached_response(value):
+        # Tokens of cached responses are not billed, so they are not reported as used
+        response = ChatCompletion.model_validate_json(value)
+        response.usage = None
+        return response
+
+    def create(self, **kwargs):
+        cache = get_call_cache()
+        key = self._key(kwargs) if cache is not None else None
+        if key is not None:
+            value = cache.get('chat', key)
+            if value is not None:
+                self._credential.validate()
+                return self._cached_response(value)
+        response = self._completions.create(**kwargs)
+        self._credential.set_valid()
+        if key is not None:
+            cache.put('chat', key, response.model_dump_json().encode('utf-8'))
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._completions, name)
+
+
+class _AsyncCachedChatCompletions(_CachedChatCompletions):
+    """
+    Chat completions of an asynchronous OpenAI client that are cached when they are deterministic.
+    """
+
+    async def create(self, **kwargs):
+        cache = get_call_cache()
+        key = self._key(kwargs) if cache is not None else None
+        if key is not None:
+            value = cache.get('chat', key)
+            if value is not None:
+                await self._credential.avalidate()
+                return self._cached_response(value)
+        response = await self._completions.create(**kwargs)
+        self._credential.set_valid()
+        if key is not None:
+            cache.put('chat', key, response.model_dump_json().encode('utf-8'))
+        return response
+
+
+class _CachedEmbeddings:
+    """
+    Embeddings of an OpenAI client, cached per text. Only the texts that are not cached are sent to the API.
+    """
+
+    def __init__(self, embeddings, api_base, credential):
+        self._embeddings = embeddings
+        self._api_base = api_base
+        self._credential = credential
+
+    def _lookup(self, cache, texts, model, kwargs):
+        """
+        Returns the keys of the texts and their cached embeddings (None for the texts that are not cached).
+        """
+        keys = [call_key('embedding', {"api_base": self._api_base, "model": model, **kwargs, "input": text}) for text in texts]
+        embeddings = []
+        for key in keys:
+            value = cache.get('embedding', key)
+            embeddings.append(array('f', value).tolist() if value is not None else None)
+        return keys, embeddings
+
+    @staticmethod
+    def _merge(cache, keys, embeddings, missing, response, model):
+        """
+        Stores the embeddings of the response, which answered the texts at the indices `missing`, and returns a response with all embeddings.
+        """
+        for idx, data in zip(missing, response.data if response is not None else []):
+            embeddings[idx] = data.embedding
+            # OpenAI clients decode embeddings as float32, so storing them as float32 is lossless
+            cache.put('embedding', keys[idx], array('f', data.embedding).tobytes())
+        usage = response.usage if response is not None else Usage(prompt_tokens=0, total_tokens=0)
+        return CreateEmbeddingResponse(
+            data=[Embedding(embedding=embedding, index=idx, object='embedding') for idx, embedding in enumerate(embeddings)],
+            model=model,
+            object='list',
+            usage=usage
+        )
+
+    def create(self, input, model, **kwargs):
+        cache = get_call_cache()
+        if cache is None:
+            return self._embeddings.create(input=input, model=model, **kwargs)
+        texts = [input] if isinstance(input, str) else list(input)
+        keys, embeddings = self._lookup(cache, texts, model, kwargs)
+        missing = [idx for idx, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            response = self._embeddings.create(input=[texts[idx] for idx in missing], model=model, **kwargs)
+            self._credential.set_valid()
+        else:
+            self._credential.validate()
+            response = None
+        return self._merge(cache, keys, embeddings, missing, response, model)
+
+    def __getattr__(self, name):
+        return getattr(self._embeddings, name)
+
+
+class _AsyncCachedEmbeddings(_CachedEmbeddings):
+    """
+    Embeddings of an asynchronous OpenAI client, cached per text.
+    """
+
+    async def create(self, input, model, **kwargs):
+        cache = get_call_cache()
+        if cache is None:
+            return await self._embeddings.create(input=input, model=model, **kwargs)
+        texts = [input] if isinstance(input, str) else list(input)
+        keys, embeddings = self._lookup(cache, texts, model, kwargs)
+        missing = [idx for idx, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            response = await self._embeddings.create(input=[texts[idx] for idx in missing], model=model, **kwargs)
+            self._credential.set_valid()
+        else:
+            await self._credential.avalidate()
+            response = None
+        return self._merge(cache, keys, embeddings, missing, response, model)
+
+
+class _ClientChat:
+    def __init__(self, completions):
+        self.completions = completions
+
+
+class CachedClient:
+    """
+    Wraps an OpenAI client (synchronous or asynchronous) so that its chat completions and embeddings use the call cache.
+    Other attributes are those of the wrapped client.
+    """
+
+    def __init__(self, client, api_base, asynchronous=False):
+        self._client = client
+        credential = _Credential(client, api_base)
+        if asynchronous:
+            self.chat = _ClientChat(_AsyncCachedChatCompletions(client.chat.completions, api_base, credential))
+            self.embeddings = _AsyncCachedEmbeddings(client.embeddings, api_base, credential)
+        else:
+            self.chat = _ClientChat(_CachedChatCompletions(client.chat.completions, api_base, credential))
+            self.embeddings = _CachedEmbeddings(client.embeddings, api_base, credential)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def __enter__(self):
+        self._client.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self._client.__exit__(*args)
+
+    async def __aenter__(self):
+        await self._client.__aenter__()
+        return self
+
+    async def __aexit__(self, *args):
+        return await self._client.__aexit__(*args)
+
+
+class CachedOpenAI(OpenAI):
+    """
+    An OpenAI LLM whose deterministic chat completions are cached in the call cache of the process.
+    """
+
+    def _get_client(self):
+        return CachedClient(super()._get_client(), self.api_base)
+
+    def _get_aclient(self):
+        return CachedClient(super()._get_aclient(), self.api_base, asynchronous=True)
+
+
+class CachedOpenAIEmbedding(OpenAIEmbedding):
+    """
+    An OpenAI embedding model whose embeddings are cached in the call cache of the process.
+    """
+
+    def _get_client(self):
+        return CachedClient(super()._get_client(), self.api_base)
+
+    def _get_aclient(self):
+        return CachedClient(super()._get_aclient(), self.api_base, asynchronous=True)
+
@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import logging
+import sqlite3
+import hashlib
+import threading
+from collections import defaultdict
+
+from instrumentation import metrics_registry, current_trace
+
+# This module only depends on the standard library, so the cache can be configured at startup
+# without importing LlamaIndex. The cached OpenAI models are defined in `cached_models`.
+
+# Cache shared by all models of the process, or None if caching is disabled
+_call_cache = None
+
+
+def call_key(kind, payload):
+    """
+    Returns the key of a call.
+    Args:
+        kind (str): The kind of call, e.g. 'chat' or 'embedding'.
+        payload (dict): Everything that determines the result of the call: the API base, the model, its
+                        parameters and the prompt (or the text to embed). It must be JSON serializable.
+    Returns:
+        str: The hexadecimal SHA-256 digest of the kind and the payload.
+    """
+    serialized = json.dumps({"kind": kind, "payload": payload}, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+def credential_fingerprint(api_key):
+    """
+    Returns a fingerprint of an API key, which identifies the objects and calls of the key without holding it.
+    """
+    return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:16]
+
+
+class CallCache:
+    """
+    A cache of the results of deterministic LLM and embedding calls in a SQLite file, which several
+    processes can use at the same time (the database is in WAL mode and writers wait for each other).
+    Entries expire after `ttl_seconds`, and the least recently used entries are removed when the
+    values take more than `max_bytes`. Hits and misses are counted per kind of call, and recorded in
+    the metrics registry as the 'cache.<kind>' stages and in the trace of the current query.
+    Attributes:
+        path (str): The path of the SQLite file.
+        ttl_seconds (float): The lifetime of an entry. None keeps entries until they are evicted for size.
+        max_bytes (int): The maximum total size of the cached values.
+    Methods:
+        get(kind, key):
+        put(kind, key, value):
+        evict():
+        stats():
+    """
+
+    # Number of writes between two evictions
+    evict_every = 200
+
+    # Minimum number of seconds between two updates of the last access time of an entry
+    touch_interval = 60
+
+    def __init__(self, path, ttl_seconds=7 * 24 * 3600, max_bytes=512 * 1024 * 1024):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._hits = defaultdict(int)
+        self._misses = defaultdict(int)
+        self._writes = 0
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connection() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS calls (key TEXT PRIMARY KEY, kind TEXT NOT NULL, value BLOB NOT NULL, "
+                "size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS calls_accessed ON calls (accessed)")
+
+    def _connection(self):
+        """
+        Returns the connection of the current thread, since SQLite connections cannot be shared between threads.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Waits up to 10 s for the writes of other threads and processes
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _record(self, kind, hit, duration_ms):
+        """
+        Counts a lookup.
+        """
+        with self._lock:
+            if hit:
+                self._hits[kind] += 1
+            else:
+                self._misses[kind] += 1
+        metrics_registry.observe('cache.' + kind, duration_ms, hits=int(hit), misses=int(not hit))
+        trace = current_trace()
+        if trace is not None:
+            trace.add_counters(**{'cache_{}_{}'.format(kind, 'hits' if hit else 'misses'): 1})
+
+    def get(self, kind, key):
+        """
+        Looks up a call.
+        Args:
+            kind (str): The kind of call.
+            key (str): The key of the call, see `call_key`.
+        Returns:
+            bytes: The cached result, or None if the call is not cached or its entry expired.
+        """
+        start = time.perf_counter()
+        now = time.time()
+        value = None
+        try:
+            connection = self._connection()
+            row = connection.execute("SELECT value, created, accessed FROM calls WHERE key = ?", (key,)).fetchone()
+            if row is not None and (self.ttl_seconds is None or now - row[1] <= self.ttl_seconds):
+                value = row[0]
+                if now - row[2] > self.touch_interval:
+                    with connection:
+                        connection.execute("UPDATE calls SET accessed = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            # The cache never makes a call fail
+            logging.warning('>    Call cache lookup failed: {}'.format(e))
+        self._record(kind, value is not None, (time.perf_counter() - start) * 1000)
+        return value
+
+    def put(self, kind, key, value):
+        """
+        Stores the result of a call.
+        Args:
+            kind (str): The kind of call.
+            key (str): The key of the call, see `call_key`.
+            value (bytes): The result.
+        """
+        now = time.time()
+        try:
+            with self._connection() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO calls (key, kind, value, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, kind, value, len(value), now, now)
+                )
+        except sqlite3.Error as e:
+            logging.warning('>    Call cache write failed: {}'.format(e))
+            return
+
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the expired entries, and the least recently used entries while the values take more than `max_bytes`.
+        """
+        try:
+            with self._connection() as connection:
+                if self.ttl_seconds is not None:
+                    connection.execute("DELETE FROM calls WHERE created < ?", (time.time() - self.ttl_seconds,))
+                total_bytes = connection.execute("SELECT COALESCE(SUM(size), 0) FROM calls").fetchone()[0]
+                if total_bytes > self.max_bytes:
+                    # Remove the oldest entries that bring the size below 90 % of the limit
+                    excess = total_bytes - int(self.max_bytes * 0.9)
+                    removed = 0
+                    keys = []
+                    for key, size in connection.execute("SELECT key, size FROM calls ORDER BY accessed"):
+                        keys.append((key,))
+                        removed += size
+                        if removed >= excess:
+                            break
+                    connection.executemany("DELETE FROM calls WHERE key = ?", keys)
+        except sqlite3.Error as e:
+            logging.warning('>    Call cache eviction failed: {}'.format(e))
+
+    def stats(self):
+        """
+        Returns the hit rates of this process and the size of the cache.
+        Returns:
+            dict: The hits, misses and hit rate of each kind of call, and the number of entries and bytes of the cache.
+        """
+        with self._lock:
+            kinds = {
+                kind: {
+                    "hits": self._hits[kind],
+                    "misses": self._misses[kind],
+                    "hit_rate": self._hits[kind] / (self._hits[kind] + self._misses[kind])
+                }
+                for kind in set(self._hits) | set(self._misses)
+            }
+        entries, total_bytes = self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM calls").fetchone()
+        return {"kinds": kinds, "entries": entries, "bytes": total_bytes}
+
+
+def configure_call_cache(config):
+    """
+    Sets up the call cache of the process from the 'CallCache' section of the configuration file.
+    Args:
+        config (dict): The configuration, with 'enabled', 'path', 'ttl_hours' and 'max_megabytes'.
+    Returns:
+        CallCache: The cache, or None if it is disabled.
+    """
+    global _call_cache
+    if not config.get('enabled', False):
+        _call_cache = None
+        return None
+    ttl_hours = config.get('ttl_hours')
+    _call_cache = CallCache(
+        path=config.get('path', 'Data/cache/llm-calls.sqlite3'),
+        ttl_seconds=ttl_hours * 3600 if ttl_hours else None,
+        max_bytes=int(config.get('max_megabytes', 512) * 1024 * 1024)
+    )
+    logging.info('>    LLM and embedding calls are cached in {}.'.format(_call_cache.path))
+    return _call_cache
+
+def get_call_cache():
+    """
+    Returns the call cache of the process.
+    Returns:
+        CallCache: The cache, or None if it is disabled or not configured.
+    """
+    return _call_cache
@@ -0,0 +1,70 @@
+import os
+import sys
+import json
+import logging
+import argparse
+
+from user_agent import UserAgent, EMBEDDING_MODELS
+from instrumentation import configure_instrumentation
+from trace_callbacks import register_trace_callbacks
+from call_cache import configure_call_cache
+from profiling import configure_profiling
+from local_embeddings import configure_local_embeddings, is_local_embedding
+from knowledgeBase.collection import CollectionManager
+
+
+def main():
+    # Loading setting configurations
+    with open('./Collection_LLM_RAG/program_init_config.json', 'r') as file:
+        config_data = json.load(file)
+    embedding_names = sorted(EMBEDDING_MODELS) + configure_local_embeddings(config_data['LocalEmbedding'])
+
+    parser = argparse.ArgumentParser(description='Embeds the chunks of a collection again with another embedding model, while the collection keeps being served.')
+    parser.add_argument('collection', help='Name of the collection.')
+    parser.add_argument('--embedding', required=True, choices=embedding_names, help='Name of the new embedding model.')
+    parser.add_argument('--batch-size', type=int, default=256, help='Number of chunks embedded per request and per checkpoint.')
+    parser.add_argument('--restart', action='store_true', help='Discard the progress of an interrupted migration instead of resuming it.')
+    parser.add_argument('--openai-api-key', default=os.environ.get('OPENAI_API_KEY', ''), help='OpenAI API key. Defaults to the OPENAI_API_KEY environment variable.')
+    args = parser.parse_args()
+
+    # Local embedding models do not call the API
+    if args.openai_api_key == "" and not is_local_embedding(args.embedding):
+        parser.error('An OpenAI API key is required (--openai-api-key or OPENAI_API_KEY).')
+
+    configure_instrumentation({**config_data['Instrumentation'], "metrics_port": None})
+    register_trace_callbacks()
+    configure_call_cache(config_data['CallCache'])
+    configure_profiling(config_data['Profiling'])
+
+    collection_manager = CollectionManager()
+    details = collection_manager.get_query_engines_detail_by_name([args.collection])
+    if not details:
+        logging.error('>    Unknown collection: {}.'.format(args.collection))
+        sys.exit(1)
+    if details[0].get('embedding_name') == args.embedding:
+        logging.info('>    {} is already embedded with {}.'.format(args.collection, args.embedding))
+        return
+
+    user_models = UserAgent(
+        llm_name=config_data['LLMs']['API'][0],
+        embedding_name=args.embedding,
+        openAI_api=args.openai_api_key,
+        mode=config_data['Modes'][0],
+        api_base=config_data['OpenAI-API-base']
+    )
+    summary = collection_manager.reembed_collection(
+        collection_name=args.collection,
+        embedding_name=args.embedding,
+        model_embd=user_models.embedding_model(args.embedding),
+        batch_size=args.batch_size,
+        restart=args.restart
+    )
+    logging.info('>    {} chunks embedded, {} is served from version {}.'.format(summary['embedded'], args.collection, summary['storage_version']))
+
+
+if __name__ == '__main__':
+
+    # Configure logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    main()
@@ -0,0 +1,75 @@
+import os
+import json
+import logging
+import argparse
+
+from user_agent import UserAgent
+from instrumentation import configure_instrumentation
+from trace_callbacks import register_trace_callbacks
+from call_cache import configure_call_cache
+from profiling import configure_profiling
+from local_embeddings import configure_local_embeddings
+from knowledgeBase.shards import configure_sharding
+from knowledgeBase.collection import CollectionManager
+from knowledgeBase.refresh import RefreshScheduler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Crawls the sources of collections again and re-indexes the pages that changed.')
+    parser.add_argument('--collections', nargs='+', default=None, help='Names of the collections. Defaults to all collections that are due.')
+    parser.add_argument('--force', action='store_true', help='Refresh the collections even if they are not due.')
+    parser.add_argument('--loop', action='store_true', help='Keep running and refresh the collections whenever they are due.')
+    parser.add_argument('--llm', default=None, help='Name of the LLM. Defaults to the first API LLM of the configuration file.')
+    parser.add_argument('--openai-api-key', default=os.environ.get('OPENAI_API_KEY', ''), help='OpenAI API key. Defaults to the OPENAI_API_KEY environment variable.')
+    args = parser.parse_args()
+
+    if args.openai_api_key == "":
+        parser.error('An OpenAI API key is required (--openai-api-key or OPENAI_API_KEY).')
+
+    # Loading setting configurations
+    with open('./Collection_LLM_RAG/program_init_config.json', 'r') as file:
+        config_data = json.load(file)
+
+    configure_instrumentation({**config_data['Instrumentation'], "metrics_port": None})
+    register_trace_callbacks()
+    configure_call_cache(config_data['CallCache'])
+    configure_profiling(config_data['Profiling'])
+    configure_local_embeddings(config_data['LocalEmbedding'])
+    configure_sharding(config_data['Sharding'])
+
+    # Every collection is embedded again with the embedding model it was created with
+    scheduler = RefreshScheduler(
+        collection_manager=CollectionManager(),
+        models_factory=lambda details: UserAgent(
+            llm_name=args.llm or config_data['LLMs']['API'][0],
+            embedding_name=details['embedding_name'],
+            openAI_api=args.openai_api_key,
+            mode=config_data['Modes'][0],
+            api_base=config_data['OpenAI-API-base']
+        ),
+        interval_hours=config_data['Refresh']['interval_hours'],
+        check_seconds=config_data['Refresh']['check_minutes'] * 60
+    )
+
+    if args.loop:
+        try:
+            scheduler.run()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    summaries = scheduler.run_once(collections=args.collections, force=args.force)
+    for name, summary in summaries.items():
+        logging.info('>    {}: {} changed, {} added, {} removed and {} unchanged pages, version {}{}.'.format(
+            name, summary['changed'], summary['added'], summary['removed'], summary['unchanged'],
+            summary['storage_version'], ' (rebuilt)' if summary['rebuilt'] else ''))
+    if not summaries:
+        logging.info('>    No collection was refreshed.')
+
+
+if __name__ == '__main__':
+
+    # Configure logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+from knowledgeBase.collection import CollectionManager
+from knowledgeBase.snapshots import export_collection_snapshot, import_collection_snapshot, verify_collection_snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exports, verifies and imports snapshots of collections, to deploy prebuilt collections without building them again.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='Writes a snapshot of a collection.')
+    export_parser.add_argument('collection', help='Name of the collection.')
+    export_parser.add_argument('--output', default=None, help='Path of the archive, or - to stream it to the standard output. Defaults to Data/snapshots/<collection>-<time>.tar.gz.')
+
+    verify_parser = subparsers.add_parser('verify', help='Checks the checksums of a snapshot without extracting it.')
+    verify_parser.add_argument('snapshot', help='Path of the archive, or - to read it from the standard input.')
+
+    import_parser = subparsers.add_parser('import', help='Verifies a snapshot while extracting it and adds its collection.')
+    import_parser.add_argument('snapshot', help='Path of the archive, or - to read it from the standard input (e.g. piped from curl).')
+    import_parser.add_argument('--overwrite', action='store_true', help='Replace an existing collection with the same name.')
+    args = parser.parse_args()
+
+    collection_manager = CollectionManager()
+    if args.command == 'export':
+        if args.output == '-':
+            manifest = export_collection_snapshot(collection_manager, args.collection, sys.stdout.buffer)
+        else:
+            output = args.output or os.path.join('Data', 'snapshots', '{}-{}.tar.gz'.format(args.collection, time.strftime('%Y%m%d-%H%M%S')))
+            os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+            manifest = export_collection_snapshot(collection_manager, args.collection, output)
+            logging.info('>    Snapshot saved to {}'.format(output))
+    else:
+        source = sys.stdin.buffer if args.snapshot == '-' else args.snapshot
+        try:
+            if args.command == 'verify':
+                manifest = verify_collection_snapshot(collection_manager, source)
+            else:
+                with open('./Collection_LLM_RAG/program_init_config.json', 'r') as file:
+                    config_data = json.load(file)
+                embedding_names = config_data['Embedding']['API'] + [name + ' (Local)' for name in config_data['Embedding']['local']]
+                manifest = import_collection_snapshot(collection_manager, source, overwrite=args.overwrite, embedding_names=embedding_names)
+        except ValueError as e:
+            logging.error('>    {}'.format(e))
+            sys.exit(1)
+
+    logging.info('>    {}: {} files, {} bytes, embedded with {} ({} dimensions).'.format(
+        manifest['collection']['name'],
+        len(manifest['files']),
+        sum(entry['size'] for entry in manifest['files'].values()),
+        manifest['embedding']['name'],
+        manifest['embedding']['dimension']
+    ))
+
+
+if __name__ == '__main__':
+
+    # Configure logging. Logs go to the standard error, so that snapshots can be streamed to the standard output.
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', stream=sys.stderr)
+
+    main()
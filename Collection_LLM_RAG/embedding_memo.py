@@ -0,0 +1,149 @@
+import re
+import time
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from call_cache import credential_fingerprint
+from instrumentation import metrics_registry, current_trace
+
+# This module only depends on the standard library, so a request scope can be opened without
+# importing LlamaIndex. Query embeddings are memoized at two levels:
+# - per request: every query engine that a question fans out to (and every similar tool input of
+#   the ReAct agent) reuses the first embedding of the question, however long the request takes;
+# - per process, for a short time: concurrent sessions asking the same question share it too.
+# Concurrent lookups of the same query wait for a single embedding call.
+
+# Embeddings of the request that is being answered in this thread (or asyncio task), or None
+_request_memo = contextvars.ContextVar('request_embedding_memo', default=None)
+
+_whitespace = re.compile(r'\s+')
+
+
+def normalize_query(text):
+    """
+    Normalizes a query for looking up its embedding: case and whitespace are ignored.
+    Args:
+        text (str): The query.
+    Returns:
+        str: The normalized query.
+    """
+    return _whitespace.sub(' ', text).strip().casefold()
+
+def embedding_model_key(model_embd):
+    """
+    Returns what identifies the embeddings of a model. The embeddings of API-backed models are also keyed by
+    the fingerprint of their API key, so a session with another (or an invalid) key does not reuse them.
+    Args:
+        model_embd (BaseEmbedding): The embedding model.
+    Returns:
+        tuple: The class, name, API base and dimensions of the model, and the fingerprint of its API key
+               (None for local models).
+    """
+    return (
+        type(model_embd).__name__,
+        getattr(model_embd, 'model_name', None),
+        getattr(model_embd, 'api_base', None),
+        getattr(model_embd, 'dimensions', None),
+        credential_fingerprint(model_embd.api_key) if hasattr(model_embd, 'api_key') else None
+    )
+
+
+@contextmanager
+def request_scope():
+    """
+    Opens the scope of a request: query embeddings computed inside the block (also in worker threads
+    started with a copy of the current context) are reused until it exits. Nested scopes share the
+    memo of the outermost one.
+    """
+    if _request_memo.get() is not None:
+        yield
+        return
+    token = _request_memo.set({})
+    try:
+        yield
+    finally:
+        _request_memo.reset(token)
+
+
+class QueryEmbeddingMemo:
+    """
+    A process-wide memo of query embeddings with a short lifetime, used together with the memo of the current request.
+    Attributes:
+        ttl_seconds (float): The lifetime of an embedding in the process-wide memo.
+        max_entries (int): The maximum number of embeddings in the process-wide memo.
+    Methods:
+        get(model_embd, texts, compute):
+    """
+
+    def __init__(self, ttl_seconds=60, max_entries=1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def _record(self, hit):
+        """
+        Counts a lookup.
+        """
+        metrics_registry.observe('embedding_memo', 0.0, hits=int(hit), misses=int(not hit))
+        trace = current_trace()
+        if trace is not None:
+            trace.add_counters(**{'embedding_memo_hits' if hit else 'embedding_memo_misses': 1})
+
+    def get(self, model_embd, texts, compute):
+        """
+        Returns the embedding of a query, computing it only if neither the current request nor the process has it.
+        Args:
+            model_embd (BaseEmbedding): The embedding model.
+            texts (list of str): The texts whose embeddings are aggregated into the query embedding.
+            compute (callable): A function without arguments that computes the embedding.
+        Returns:
+            list of float: The embedding.
+        """
+        key = (embedding_model_key(model_embd), tuple(normalize_query(text) for text in texts))
+        request_memo = _request_memo.get()
+        if request_memo is not None and key in request_memo:
+            self._record(True)
+            return request_memo[key]
+
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    embedding = entry[0]
+                    break
+                event = self._in_flight.get(key)
+                if event is None:
+                    # This lookup computes the embedding; the concurrent ones wait for it
+                    event = self._in_flight[key] = threading.Event()
+                    embedding = None
+                    break
+            event.wait()
+
+        if embedding is not None:
+            self._record(True)
+        else:
+            self._record(False)
+            try:
+                embedding = compute()
+                with self._lock:
+                    self._entries[key] = (embedding, time.monotonic() + self.ttl_seconds)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+                event.set()
+
+        if request_memo is not None:
+            request_memo[key] = embedding
+        return embedding
+
+
+# Process wide memo, shared by all sessions
+query_embedding_memo = QueryEmbeddingMemo()
@@ -0,0 +1,544 @@
+import gc
+import os
+import sys
+import json
+import types
+import functools
+import time
+import uuid
+import logging
+import builtins
+import threading
+import contextvars
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# This module only depends on the standard library, so it can be imported at startup without
+# importing LlamaIndex. The LlamaIndex callback handler is defined in `trace_callbacks`.
+
+# Trace of the query that is currently being answered in this thread (or asyncio task)
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+# Logger used for writing one JSON line per finished query trace
+trace_logger = logging.getLogger('rag.trace')
+
+
+def percentile(sorted_values, q):
+    """
+    Computes a percentile of a sorted list using the nearest-rank method.
+    Args:
+        sorted_values (list of float): The values, sorted in ascending order.
+        q (float): The percentile to compute, between 0 and 100.
+    Returns:
+        float: The percentile, or None if the list is empty.
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(q / 100.0 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class MetricsRegistry:
+    """
+    A thread-safe registry that aggregates the durations and counters of traced stages.
+    The most recent durations of each stage are kept in a bounded window, from which the
+    p50/p95/p99 latency histograms are computed.
+    Attributes:
+        window_size (int): The number of recent samples kept per stage.
+    Methods:
+        observe(stage, duration_ms, **counters):
+        snapshot():
+        reset():
+    """
+
+    def __init__(self, window_size=10000):
+        self.window_size = window_size
+        self._lock = threading.Lock()
+        self._durations = defaultdict(lambda: deque(maxlen=self.window_size))
+        self._counts = defaultdict(int)
+        self._counters = defaultdict(lambda: defaultdict(int))
+
+    def observe(self, stage, duration_ms, **counters):
+        """
+        Records a finished stage.
+        Args:
+            stage (str): The name of the stage, e.g. 'retrieve.vector'.
+            duration_ms (float): The duration of the stage in milliseconds.
+            **counters: Additional integer counters (e.g. prompt_tokens) to accumulate for the stage.
+        """
+        with self._lock:
+            self._durations[stage].append(duration_ms)
+            self._counts[stage] += 1
+            for key, value in counters.items():
+                if isinstance(value, (int, float)):
+                    self._counters[stage][key] += value
+
+    def snapshot(self):
+        """
+        Returns the current aggregated metrics of all stages.
+        Returns:
+            dict: A dictionary that maps each stage name to its count, latency percentiles (ms)
+                  and accumulated counters.
+        """
+        with self._lock:
+            durations = {stage: sorted(values) for stage, values in self._durations.items()}
+            counts = dict(self._counts)
+            counters = {stage: dict(values) for stage, values in self._counters.items()}
+
+        stages = {}
+        for stage, values in durations.items():
+            stages[stage] = {
+                "count": counts[stage],
+                "mean_ms": sum(values) / len(values) if values else None,
+                "p50_ms": percentile(values, 50),
+                "p95_ms": percentile(values, 95),
+                "p99_ms": percentile(values, 99),
+                "max_ms": values[-1] if values else None,
+                **counters.get(stage, {})
+            }
+        return stages
+
+    def reset(self):
+        """
+        Removes all recorded metrics.
+        """
+        with self._lock:
+            self._durations.clear()
+            self._counts.clear()
+            self._counters.clear()
+
+
+# Process wide registry, shared by all sessions
+metrics_registry = MetricsRegistry()
+
+
+class Trace:
+    """
+    The spans and counters collected while answering one query.
+    Attributes:
+        trace_id (str): A unique identifier of the trace.
+        name (str): The name of the traced operation.
+        attributes (dict): Additional information about the traced operation (e.g. the mode).
+        spans (list of dict): The finished spans, each with a name, start offset, duration and attributes.
+        counters (dict): Accumulated counters, such as the number of LLM calls and tokens.
+    """
+
+    def __init__(self, name, **attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attributes = attributes
+        self.spans = []
+        self.counters = defaultdict(int)
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, name, start, duration_ms, **attributes):
+        """
+        Adds a finished span to the trace.
+        """
+        with self._lock:
+            self.spans.append({
+                "name": name,
+                "start_ms": round((start - self._start) * 1000, 3),
+                "duration_ms": round(duration_ms, 3),
+                **attributes
+            })
+
+    def add_counters(self, **counters):
+        """
+        Accumulates counters of the trace.
+        """
+        with self._lock:
+            for key, value in counters.items():
+                self.counters[key] += value
+
+    def to_dict(self, duration_ms):
+        """
+        Returns the trace as a JSON serializable dictionary.
+        """
+        with self._lock:
+            return {
+                "trace_id": self.trace_id,
+                "name": self.name,
+                "duration_ms": round(duration_ms, 3),
+                **self.attributes,
+                "counters": dict(self.counters),
+                "spans": sorted(self.spans, key=lambda span: span["start_ms"])
+            }
+
+
+def current_trace():
+    """
+    Returns the trace of the query that is currently being answered, or None if no query is traced.
+    """
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Measures the duration of a stage. The duration is added to the histogram of the stage and,
+    if a query is being traced, to the spans of its trace.
+    Args:
+        name (str): The name of the stage.
+        **attributes: Additional information stored with the span (e.g. the collection name).
+    Yields:
+        dict: The attributes of the span, which may be extended inside the block.
+    """
+    start = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        duration_ms = (time.perf_counter() - start) * 1000
+        metrics_registry.observe(name, duration_ms)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_span(name, start, duration_ms, **attributes)
+
+
+@contextmanager
+def trace_query(name, **attributes):
+    """
+    Traces one query. All spans recorded inside the block (also in worker threads started with a
+    copy of the current context) are collected into a single trace, which is written as one JSON
+    line to the 'rag.trace' logger when the block exits.
+    Args:
+        name (str): The name of the traced operation.
+        **attributes: Additional information stored with the trace.
+    Yields:
+        Trace: The trace of the query.
+    """
+    trace = Trace(name, **attributes)
+    token = _current_trace.set(trace)
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        duration_ms = (time.perf_counter() - start) * 1000
+        metrics_registry.observe(name, duration_ms, **trace.counters)
+        trace_logger.info(json.dumps(trace.to_dict(duration_ms), default=str))
+
+
+class BuildReport(Trace):
+    """
+    The metrics collected while a collection is built: the durations and counters of every stage (fetching,
+    parsing, splitting, embedding batches, writing to Chroma and the chunk store, building the keyword index)
+    and the fetch latencies and downloaded bytes per host. Unlike query traces, spans are aggregated instead
+    of kept, since a build records a span for every page and every embedding batch. The report can be read
+    while the build is running, e.g. to show its progress.
+    Attributes:
+        status (str): 'running', 'completed' or 'failed'.
+    Methods:
+        add_span(name, start, duration_ms, **attributes):
+        finish(status):
+        to_dict(duration_ms=None):
+        to_markdown(max_hosts=10):
+    """
+
+    def __init__(self, name='ingest.build', **attributes):
+        super().__init__(name, **attributes)
+        self.status = 'running'
+        self.created = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self._end = None
+        self._stages = {}
+        self._hosts = {}
+
+    @staticmethod
+    def _new_entry():
+        return {"count": 0, "total_ms": 0.0, "durations": deque(maxlen=10000), "counters": defaultdict(int)}
+
+    @staticmethod
+    def _add_to_entry(entry, duration_ms, attributes):
+        entry["count"] += 1
+        entry["total_ms"] += duration_ms
+        entry["durations"].append(duration_ms)
+        for key, value in attributes.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                entry["counters"][key] += value
+
+    @staticmethod
+    def _summarize(entry):
+        values = sorted(entry["durations"])
+        return {
+            "count": entry["count"],
+            "total_ms": round(entry["total_ms"], 3),
+            "mean_ms": round(entry["total_ms"] / entry["count"], 3) if entry["count"] else None,
+            "p50_ms": percentile(values, 50),
+            "p95_ms": percentile(values, 95),
+            "max_ms": values[-1] if values else None,
+            **entry["counters"]
+        }
+
+    def add_span(self, name, start, duration_ms, **attributes):
+        """
+        Adds a finished span to the statistics of its stage, and of its host if it has one.
+        """
+        with self._lock:
+            self._add_to_entry(self._stages.setdefault(name, self._new_entry()), duration_ms, attributes)
+            if attributes.get('host'):
+                self._add_to_entry(self._hosts.setdefault(attributes['host'], self._new_entry()), duration_ms, attributes)
+
+    def finish(self, status):
+        """
+        Marks the build as finished.
+        """
+        self.status = status
+        self._end = time.perf_counter()
+
+    def to_dict(self, duration_ms=None):
+        """
+        Returns the report as a JSON serializable dictionary.
+        Args:
+            duration_ms (float, optional): The duration of the build. Defaults to the time since it started (or until it finished).
+        """
+        if duration_ms is None:
+            duration_ms = ((self._end or time.perf_counter()) - self._start) * 1000
+        with self._lock:
+            return {
+                "trace_id": self.trace_id,
+                "name": self.name,
+                "status": self.status,
+                "created": self.created,
+                "duration_ms": round(duration_ms, 3),
+                **self.attributes,
+                "counters": dict(self.counters),
+                "stages": {name: self._summarize(entry) for name, entry in sorted(self._stages.items())},
+                "hosts": {host: self._summarize(entry) for host, entry in sorted(self._hosts.items())}
+            }
+
+    def to_markdown(self, max_hosts=10):
+        """
+        Returns the report as Markdown tables, e.g. to show the progress of a build in the interface.
+        Args:
+            max_hosts (int): The maximum number of hosts shown, those with the most pages first.
+        """
+        report = self.to_dict()
+        stages = report["stages"]
+        seconds = report["duration_ms"] / 1000
+        num_chunks = stages.get("ingest.split", {}).get("num_chunks", 0)
+        lines = [
+            "**{}** {}: {:.1f} s, {} of {} pages fetched, {} chunks, {} tokens embedded ({:.1f} chunks/s)".format(
+                report.get("collection", ""), report["status"], seconds,
+                stages.get("ingest.fetch", {}).get("count", 0) - stages.get("ingest.fetch", {}).get("errors", 0),
+                report.get("pages", "?"), num_chunks, report["counters"].get("embedding_tokens", 0),
+                num_chunks / seconds if seconds > 0 else 0.0
+            ),
+            "",
+            "| Stage | Count | Total s | p50 ms | p95 ms | Counters |",
+            "|---|---|---|---|---|---|"
+        ]
+        for name, stage in stages.items():
+            counters = ', '.join('{}={}'.format(key, value) for key, value in stage.items()
+                                 if key not in ("count", "total_ms", "mean_ms", "p50_ms", "p95_ms", "max_ms"))
+            lines.append("| {} | {} | {:.2f} | {:.0f} | {:.0f} | {} |".format(
+                name, stage["count"], stage["total_ms"] / 1000, stage["p50_ms"] or 0, stage["p95_ms"] or 0, counters))
+
+        hosts = sorted(report["hosts"].items(), key=lambda item: -item[1]["count"])[:max_hosts]
+        if hosts:
+            lines += ["", "| Host | Pages | Errors | KB | p50 ms | p95 ms |", "|---|---|---|---|---|---|"]
+            for host, stats in hosts:
+                lines.append("| {} | {} | {} | {:.0f} | {:.0f} | {:.0f} |".format(
+                    host, stats["count"], stats.get("errors", 0), stats.get("bytes", 0) / 1024, stats["p50_ms"] or 0, stats["p95_ms"] or 0))
+        return "\n".join(lines)
+
+
+@contextmanager
+def trace_build(report):
+    """
+    Collects the spans recorded inside the block (also in worker threads started with a copy of the
+    current context) into the report of a build.
+    Args:
+        report (BuildReport): The report of the build.
+    Yields:
+        BuildReport: The same report.
+    """
+    token = _current_trace.set(report)
+    status = 'failed'
+    try:
+        yield report
+        status = 'completed'
+    finally:
+        _current_trace.reset(token)
+        report.finish(status)
+        metrics_registry.observe(report.name, report.to_dict()["duration_ms"], **report.counters)
+
+
+class ImportProfiler:
+    """
+    Measures the time spent in import statements, grouped by top-level package, e.g. to find which
+    packages slow down the startup of the application. The time of an import does not include the
+    time of the imports it triggers, so the times of all packages add up to the total import time.
+    Methods:
+        start():
+        stop():
+        report(top=20):
+        log_report(path='Data/logs/import-profile.json', top=20):
+    """
+
+    def __init__(self):
+        self._original_import = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._seconds = defaultdict(float)
+        self._start = None
+        self._stop = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level > 0 and globals:
+            package = (globals.get('__package__') or '').split('.')[0]
+        else:
+            package = name.split('.')[0]
+
+        # Time of the imports started by this import, per thread
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self._lock:
+                self._seconds[package] += elapsed - nested
+
+    def start(self):
+        """
+        Starts measuring imports.
+        """
+        self._start = time.perf_counter()
+        self._original_import = builtins.__import__
+        builtins.__import__ = self._import
+
+    def stop(self):
+        """
+        Stops measuring imports.
+        """
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+            self._stop = time.perf_counter()
+
+    def report(self, top=20):
+        """
+        Returns the measured import times.
+        Args:
+            top (int): The number of packages with the longest import times to include.
+        Returns:
+            dict: The time between `start` and `stop`, the total import time and the import time of each
+                  of the slowest packages, in seconds.
+        """
+        with self._lock:
+            seconds = sorted(self._seconds.items(), key=lambda item: item[1], reverse=True)
+        end = self._stop if self._stop is not None else time.perf_counter()
+        return {
+            "elapsed_seconds": round(end - self._start, 3),
+            "import_seconds": round(sum(value for _, value in seconds), 3),
+            "packages": [{"package": package, "seconds": round(value, 3)} for package, value in seconds[:top]]
+        }
+
+    def log_report(self, path='Data/logs/import-profile.json', top=20):
+        """
+        Logs the report and saves it as JSON.
+        Args:
+            path (str): The path of the JSON file, or None for only logging the report.
+            top (int): The number of packages with the longest import times to include.
+        """
+        report = self.report(top=top)
+        logging.info('>    Startup took {:.2f} s, of which {:.2f} s were spent importing: {}'.format(
+            report["elapsed_seconds"], report["import_seconds"],
+            ', '.join('{} {:.2f} s'.format(item["package"], item["seconds"]) for item in report["packages"][:10])))
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'w') as file:
+                json.dump(report, file, indent=4)
+
+
+# Types of the objects that `object_size` does not count
+_unsized_types = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType, functools.partial)
+
+def object_size(root, exclude=()):
+    """
+    Estimates the memory used by an object and all the objects it references, e.g. the state of a session.
+    Modules, classes, functions and methods are not counted (they reference shared state, e.g. tokenizers),
+    and neither are the excluded objects nor the objects that are only reachable through them.
+    Args:
+        root: The object.
+        exclude (iterable): Objects that are shared with other roots and are not counted.
+    Returns:
+        int: The estimated number of bytes.
+    """
+    seen = {id(obj) for obj in exclude}
+    pending = [root]
+    size = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, _unsized_types):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj, 0)
+        pending.extend(gc.get_referents(obj))
+    return size
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the aggregated metrics as JSON on '/metrics'.
+    """
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/metrics':
+            self.send_error(404)
+            return
+        body = json.dumps(metrics_registry.snapshot(), default=str).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('>    Metrics endpoint: ' + format % args)
+
+
+def start_metrics_server(host='127.0.0.1', port=9464):
+    """
+    Starts a local HTTP server in a daemon thread that serves the aggregated metrics on '/metrics'.
+    Args:
+        host (str): The host to bind to.
+        port (int): The port to bind to.
+    Returns:
+        ThreadingHTTPServer: The started server.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+    logging.info('>    Metrics endpoint is served on http://{}:{}/metrics'.format(host, port))
+    return server
+
+
+def configure_instrumentation(config):
+    """
+    Configures the trace log and the metrics endpoint.
+    Args:
+        config (dict): The 'Instrumentation' section of the program configuration, with the keys
+                       'trace_log' (path of a JSON lines file, or null) and 'metrics_host'/'metrics_port'
+                       (address of the metrics endpoint, no endpoint is started if the port is null).
+    Returns:
+        None
+    """
+    trace_log = config.get('trace_log')
+    if trace_log and not any(getattr(handler, 'baseFilename', None) == os.path.abspath(trace_log) for handler in trace_logger.handlers):
+        os.makedirs(os.path.dirname(trace_log) or '.', exist_ok=True)
+        file_handler = logging.FileHandler(trace_log)
+        file_handler.setFormatter(logging.Formatter('%(message)s'))
+        trace_logger.addHandler(file_handler)
+
+    if config.get('metrics_port') is not None:
+        try:
+            start_metrics_server(host=config.get('metrics_host', '127.0.0.1'), port=config['metrics_port'])
+        except OSError as e:
+            logging.error('>    Metrics endpoint could not be started: {}'.format(e))
@@ -0,0 +1,116 @@
+import logging
+
+from instrumentation import metrics_registry
+
+# The candidate set of a query is cut where the similarity scores drop sharply, or once the
+# candidates hold most of the relevance mass, so that easy queries with a few clearly dominant
+# chunks are retrieved, reranked and synthesized from fewer nodes.
+
+
+class AdaptiveDepth:
+    """
+    Chooses how many of the vector search results of a query are kept, from the curve of their
+    similarity scores. Scores are taken relative to the lowest score of the `max_k` candidates:
+    - gap: if the largest drop between two consecutive scores is at least `gap_ratio` of the whole
+      score range, the candidates after the drop are removed;
+    - mass: the candidates are cut as soon as they hold `mass` of the total relative score.
+    The smaller of both cuts is kept, bounded by `min_k` and `max_k`.
+    Attributes:
+        min_k (int): The minimum number of vector search results.
+        max_k (int): The maximum number of vector search results, i.e. the number of retrieved candidates.
+        gap_ratio (float): The minimum share of the score range of a drop that cuts the candidates.
+        mass (float): The share of the relative score that the kept candidates must hold.
+    Methods:
+        cutoff(scores):
+        keyword_k(k, k_keyword):
+    """
+
+    def __init__(self, min_k=4, max_k=18, gap_ratio=0.5, mass=0.9):
+        if not 1 <= min_k <= max_k:
+            raise ValueError('Adaptive retrieval needs 1 <= min_k <= max_k, got min_k={} and max_k={}.'.format(min_k, max_k))
+        self.min_k = min_k
+        self.max_k = max_k
+        self.gap_ratio = gap_ratio
+        self.mass = mass
+
+    @classmethod
+    def from_config(cls, config, collection_details=None):
+        """
+        Creates the adaptive depth of a collection.
+        Args:
+            config (dict): The 'AdaptiveRetrieval' section of the configuration file, with 'enabled', 'min_k',
+                           'max_k', 'gap_ratio' and 'mass'.
+            collection_details (dict, optional): The details of the collection in the catalog. Its optional
+                                                 'retrieval' entry overrides 'min_k' and 'max_k'.
+        Returns:
+            AdaptiveDepth: The adaptive depth, or None if adaptive retrieval is disabled.
+        """
+        if not config or not config.get('enabled', False):
+            return None
+        bounds = dict(config)
+        bounds.update((collection_details or {}).get('retrieval', {}))
+        return cls(
+            min_k=bounds.get('min_k', 4),
+            max_k=bounds.get('max_k', 18),
+            gap_ratio=bounds.get('gap_ratio', 0.5),
+            mass=bounds.get('mass', 0.9)
+        )
+
+    def cutoff(self, scores):
+        """
+        Returns the number of candidates to keep.
+        Args:
+            scores (list of float): The similarity scores of the candidates, from the highest to the lowest.
+        Returns:
+            int: The number of candidates to keep, between `min_k` and `max_k` (or all candidates if there are fewer).
+        """
+        scores = scores[:self.max_k]
+        if len(scores) <= self.min_k:
+            return len(scores)
+
+        relative = [score - scores[-1] for score in scores]
+        score_range = relative[0]
+        if score_range <= 0:
+            # All candidates are equally similar, none of them can be preferred
+            return len(scores)
+
+        k = len(scores)
+        gaps = [(relative[idx - 1] - relative[idx], idx) for idx in range(self.min_k, len(scores))]
+        largest_gap, gap_idx = max(gaps)
+        if largest_gap >= self.gap_ratio * score_range:
+            k = gap_idx
+
+        total = sum(relative)
+        cumulative = 0.0
+        for idx, score in enumerate(relative):
+            cumulative += score
+            if cumulative >= self.mass * total:
+                k = min(k, idx + 1)
+                break
+
+        return max(self.min_k, min(k, self.max_k))
+
+    def keyword_k(self, k, k_keyword):
+        """
+        Scales the number of keyword search results like the number of vector search results.
+        Args:
+            k (int): The chosen number of vector search results.
+            k_keyword (int): The number of keyword search results of the full depth.
+        Returns:
+            int: The number of keyword search results to keep, at least 1.
+        """
+        return max(1, round(k_keyword * k / self.max_k))
+
+
+def log_depth(collection, num_candidates, k, k_keyword):
+    """
+    Logs and records the depth chosen for a query, for tuning the bounds of a collection.
+    Args:
+        collection (str): The name of the collection.
+        num_candidates (int): The number of vector search results before the cut.
+        k (int): The number of kept vector search results.
+        k_keyword (int): The number of kept keyword search results.
+    """
+    logging.info('>    Adaptive retrieval in {}: kept {} of {} vector results and {} keyword results.'.format(collection, k, num_candidates, k_keyword))
+    # The average depth is kept / count, and kept / candidates is the share of the candidates that is kept
+    metrics_registry.observe('retrieve.adaptive_k', 0.0, candidates=num_candidates, kept=k, kept_keyword=k_keyword)
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from openai import AuthenticationError
+
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.schema import QueryBundle
+
+# Worker threads for answering sub-questions. A dedicated pool is used instead of the event
+# loop's default executor, because `asyncio.run` waits for the default executor on exit, which
+# would make the caller wait for sub-questions that already timed out.
+_query_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='subquestion')
+
+# Seconds between two attempts of an asynchronous caller to take a slot of the semaphore
+_slot_poll_interval = 0.02
+
+
+class BoundedQueryEngine(BaseQueryEngine):
+    """
+    A query engine wrapper that lets asynchronous callers (such as the SubQuestionQueryEngine with
+    `use_async=True`) run a synchronous query engine concurrently with a bounded degree of parallelism
+    and a per-call timeout.
+    Attributes:
+        query_engine_name (str): The name of the wrapped query engine, used for logging.
+        _query_engine (BaseQueryEngine): The wrapped query engine.
+        _semaphore (threading.BoundedSemaphore): Semaphore limiting the number of concurrent queries.
+        _timeout (float): Maximum number of seconds for a single query, or None for no limit.
+    Methods:
+        __init__(query_engine, query_engine_name, semaphore, timeout=None):
+        _query(query_bundle: QueryBundle):
+        _aquery(query_bundle: QueryBundle):
+    """
+
+    def __init__(self, query_engine, query_engine_name, semaphore, timeout=None) -> None:
+        """
+        Initializes the BoundedQueryEngine. The semaphore is shared between all query engines of
+        an agent, so the parallelism limit applies to all sub-questions of a query together.
+        """
+        self.query_engine_name = query_engine_name
+        self._query_engine = query_engine
+        self._semaphore = semaphore
+        self._timeout = timeout
+        super().__init__(callback_manager=query_engine.callback_manager)
+
+    def _get_prompt_modules(self):
+        """
+        Returns the prompt modules of the wrapped query engine.
+        """
+        return {"query_engine": self._query_engine}
+
+    def _query_with_limit(self, query_bundle: QueryBundle):
+        """
+        Runs the wrapped query engine once a slot of the shared semaphore is available.
+        """
+        with self._semaphore:
+            return self._query_engine.query(query_bundle)
+
+    def _query(self, query_bundle: QueryBundle):
+        """
+        Runs the wrapped query engine synchronously, respecting the parallelism limit.
+        """
+        return self._query_with_limit(query_bundle)
+
+    async def _aquery(self, query_bundle: QueryBundle):
+        """
+        Runs the wrapped query engine in a worker thread, so several sub-questions can be answered
+        at the same time, and gives up after the configured timeout.
+        Args:
+            query_bundle (QueryBundle): The query bundle containing the sub-question.
+        Returns:
+            RESPONSE_TYPE: The response of the wrapped query engine.
+        Raises:
+            ValueError: If the query timed out or failed. The SubQuestionQueryEngine skips sub-questions
+                        that raise ValueError, so the answer is synthesized from the remaining ones.
+        """
+        # The slot is taken before the timer starts, so waiting for the other sub-questions does not count
+        # towards the timeout. The semaphore is shared with threads, so it is polled instead of blocking the loop.
+        while not self._semaphore.acquire(blocking=False):
+            await asyncio.sleep(_slot_poll_interval)
+        context = contextvars.copy_context()
+        try:
+            future = _query_executor.submit(context.run, self._query_engine.query, query_bundle)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        # A query that timed out keeps running in its worker thread, so its slot is only released when it finishes
+        future.add_done_callback(lambda _: self._semaphore.release())
+        try:
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=self._timeout)
+        except asyncio.TimeoutError:
+            logging.warning('>    Query engine {} timed out after {} seconds.'.format(self.query_engine_name, self._timeout))
+            raise ValueError('Query engine {} timed out.'.format(self.query_engine_name))
+        except (ValueError, AuthenticationError):
+            raise
+        except Exception as e:
+            logging.warning('>    Query engine {} failed: {}'.format(self.query_engine_name, e))
+            raise ValueError('Query engine {} failed: {}'.format(self.query_engine_name, e))
+
+
+def create_query_semaphore(max_parallel):
+    """
+    Creates the semaphore shared by the bounded query engines of one agent.
+    Args:
+        max_parallel (int): Maximum number of query engines that may run at the same time.
+    Returns:
+        threading.BoundedSemaphore: The shared semaphore.
+    """
+    return threading.BoundedSemaphore(max(1, int(max_parallel)))
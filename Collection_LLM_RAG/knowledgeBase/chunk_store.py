@@ -0,0 +1,145 @@
+import os
+import sqlite3
+import hashlib
+import threading
+
+
+def text_hash(text):
+    """
+    Returns the content address of a chunk text.
+    Args:
+        text (str): The text of a chunk.
+    Returns:
+        str: The hexadecimal SHA-256 digest of the text.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def strip_nodes(nodes, keep_embedding=True):
+    """
+    Returns copies of nodes without their text, to be stored in an index that references the
+    text in a ChunkStore by node id.
+    Args:
+        nodes (list of TextNode): The nodes.
+        keep_embedding (bool): Whether the copies keep the embeddings of the nodes.
+    Returns:
+        list of TextNode: The copies without text (and without embedding if `keep_embedding` is False).
+    """
+    update = {"text": ""}
+    if not keep_embedding:
+        update["embedding"] = None
+    return [node.model_copy(update=update) for node in nodes]
+
+
+class ChunkStore:
+    """
+    A content-addressed store of the chunk texts of a collection in a SQLite file. Each distinct text
+    is stored once under its SHA-256 digest, and nodes reference it by node id, so the vector and keyword
+    indices only keep the metadata of the nodes and the texts are fetched when nodes are retrieved.
+    Attributes:
+        path (str): The path of the SQLite file.
+        read_only (bool): Whether the store is opened only for reading.
+    Methods:
+        add_nodes(nodes):
+        delete_nodes(node_ids):
+        get_texts(node_ids):
+        hydrate(nodes):
+    """
+
+    # Maximum number of parameters per SQL statement
+    batch_size = 500
+
+    # Read-only connections map the file into memory, so that the processes serving the same
+    # collection share its pages through the page cache instead of each reading them
+    mmap_size = 1 << 30
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self._local = threading.local()
+
+        if not read_only:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with self._connection() as connection:
+                # Texts are large rows, which SQLite stores more compactly in rowid tables
+                connection.execute("CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, text TEXT NOT NULL)")
+                connection.execute("CREATE TABLE IF NOT EXISTS nodes (node_id TEXT PRIMARY KEY, hash TEXT NOT NULL) WITHOUT ROWID")
+
+    def _connection(self):
+        """
+        Returns the connection of the current thread, since SQLite connections cannot be shared between threads.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if self.read_only:
+                connection = sqlite3.connect('file:{}?mode=ro'.format(self.path), uri=True)
+                connection.execute('PRAGMA mmap_size={}'.format(self.mmap_size))
+            else:
+                connection = sqlite3.connect(self.path)
+            self._local.connection = connection
+        return connection
+
+    def add_nodes(self, nodes):
+        """
+        Stores the texts of nodes.
+        Args:
+            nodes (list of TextNode): The nodes, with their text.
+        """
+        chunks = {}
+        references = []
+        for node in nodes:
+            digest = text_hash(node.text)
+            chunks[digest] = node.text
+            references.append((node.node_id, digest))
+
+        with self._connection() as connection:
+            connection.executemany("INSERT OR IGNORE INTO chunks (hash, text) VALUES (?, ?)", chunks.items())
+            connection.executemany("INSERT OR REPLACE INTO nodes (node_id, hash) VALUES (?, ?)", references)
+
+    def delete_nodes(self, node_ids):
+        """
+        Deletes nodes, and the texts no other node references.
+        Args:
+            node_ids (list of str): The ids of the nodes.
+        """
+        node_ids = list(node_ids)
+        with self._connection() as connection:
+            for start in range(0, len(node_ids), self.batch_size):
+                batch = node_ids[start:start + self.batch_size]
+                connection.execute("DELETE FROM nodes WHERE node_id IN ({})".format(','.join('?' * len(batch))), batch)
+            connection.execute("DELETE FROM chunks WHERE hash NOT IN (SELECT hash FROM nodes)")
+
+    def get_texts(self, node_ids):
+        """
+        Fetches the texts of nodes.
+        Args:
+            node_ids (list of str): The ids of the nodes.
+        Returns:
+            dict: A dictionary that maps the ids of the found nodes to their text.
+        """
+        node_ids = list(node_ids)
+        texts = {}
+        connection = self._connection()
+        for start in range(0, len(node_ids), self.batch_size):
+            batch = node_ids[start:start + self.batch_size]
+            rows = connection.execute(
+                "SELECT nodes.node_id, chunks.text FROM nodes JOIN chunks ON nodes.hash = chunks.hash "
+                "WHERE nodes.node_id IN ({})".format(','.join('?' * len(batch))),
+                batch
+            )
+            texts.update(rows)
+        return texts
+
+    def hydrate(self, nodes):
+        """
+        Fills in the text of retrieved nodes that were stored without it.
+        Args:
+            nodes (list of NodeWithScore): The retrieved nodes. Their text is set in place.
+        Returns:
+            list of NodeWithScore: The same nodes.
+        """
+        missing = [node.node for node in nodes if not node.node.text]
+        if missing:
+            texts = self.get_texts({node.node_id for node in missing})
+            for node in missing:
+                node.text = texts.get(node.node_id, "")
+        return nodes
@@ -1,21 +1,74 @@
 import os
 import shutil
 import json
+import time
+import socket
 import logging
-from openai import AuthenticationError
-
-import chromadb
-from llama_index.core import Document
-from llama_index.vector_stores.chroma import ChromaVectorStore
-from llama_index.core.node_parser import TokenTextSplitter
-from llama_index.core.ingestion import IngestionPipeline
-from llama_index.core import SimpleKeywordTableIndex
-from llama_index.core.storage import StorageContext
-from llama_index.core import load_index_from_storage
-from llama_index.core import VectorStoreIndex
+import threading
+from contextlib import contextmanager
 
 from knowledgeBase.text_extraction_webpages import scrape_articles, scrape_pdfs
+from knowledgeBase.chunk_store import ChunkStore, strip_nodes, text_hash
+from knowledgeBase.shards import partition_documents, run_parallel, sharding_settings, get_worker_pool, shard_of
 from utils import format_collection_name
+from instrumentation import span, trace_build, BuildReport
+from profiling import profiled
+
+# LlamaIndex, Chroma and OpenAI are imported inside the functions that use them, so that the
+# list of collections can be read at startup without importing them.
+
+
+def create_text_splitter():
+    """
+    Creates the text splitter used to split documents of collections into chunks.
+    Returns:
+        TokenTextSplitter: A splitter that splits documents into chunks of up to 800 tokens.
+    """
+    from llama_index.core.node_parser import TokenTextSplitter
+
+    return TokenTextSplitter(chunk_size=800, chunk_overlap=0, separator=" ")
+
+def documents_from_scraped_data(data):
+    """
+    Converts the scraped content of a collection to Document objects.
+    Args:
+        data (dict): The scraped data, with a 'data' list whose entities contain 'Name', 'Link' and 'Content'.
+    Returns:
+        list of Document: One document per entity, with the name and link of the source as metadata.
+    """
+    from llama_index.core import Document
+
+    documents = []
+    for entity_i in data['data']:
+        documents.append(Document(
+            text=entity_i['Content'], 
+            metadata={'Link': entity_i['Link'], 'Name': entity_i['Name']}, 
+            excluded_llm_metadata_keys=[
+                    "Name",
+                    "Link",
+                ],
+            excluded_embed_metadata_keys=[
+                    "Link"                    
+                ],
+            )
+        ) 
+    return documents
+
+def page_hashes(data):
+    """
+    Returns the content hash of every page of scraped data, to find the pages that changed when a collection is crawled again.
+    Args:
+        data (dict): The scraped data, with a 'data' list whose entities contain 'Link' and 'Content'.
+    Returns:
+        dict: A dictionary that maps the link of each page to the SHA-256 digest of its content.
+    """
+    return {entity['Link']: text_hash(entity['Content']) for entity in data['data']}
+
+
+# Vector and keyword indices loaded from disk, shared by all query engines of the process.
+# Keyed by the storage paths and the name of the collection.
+_shared_indices = {}
+_shared_indices_lock = threading.Lock()
 
 
 class CollectionManager:
@@ -23,19 +76,180 @@ class CollectionManager:
     def __init__(self, scraped_data_path='Data/output-processed-sources', 
                  vector_index_save_path='Data/query-engines/collections', 
                  keyword_index_save_path='Data/query-engines/keyword-index/', 
-                 query_engines_info_json='Data/query-engines/query_engines_list.json'):
+                 query_engines_info_json='Data/query-engines/query_engines_list.json',
+                 chunk_store_save_path='Data/query-engines/chunk-store'):
         self.scraped_data_path = scraped_data_path
         self.vector_index_save_path = vector_index_save_path
         self.keyword_index_save_path = keyword_index_save_path
         self.query_engines_info_json = query_engines_info_json
+        self.chunk_store_save_path = chunk_store_save_path
+
+    def chunk_store_path(self, collection_name):
+        """
+        Returns the path of the chunk store of a collection.
+        Args:
+            collection_name (str): The name of the collection.
+        Returns:
+            str: The path of the SQLite file that stores the chunk texts of the collection.
+        """
+        return os.path.join(self.chunk_store_save_path, collection_name + '.sqlite3')
 
-    def create_new_collection(self, user_models, path_json_file, type_json):
+    def vector_index_path(self, collection_name):
+        """
+        Returns the path of the Chroma directory of a collection or of a shard.
+        Args:
+            collection_name (str): The name of the collection, or the storage name of a shard.
+        Returns:
+            str: The path of the directory.
+        """
+        return os.path.join(self.vector_index_save_path, collection_name)
+
+    def storage_paths(self):
+        """
+        Returns the storage paths of the collection manager, e.g. to create the same collection manager in another process.
+        Returns:
+            tuple: (argument, path) pairs of the arguments of CollectionManager.
+        """
+        return (
+            ('scraped_data_path', self.scraped_data_path),
+            ('vector_index_save_path', self.vector_index_save_path),
+            ('keyword_index_save_path', self.keyword_index_save_path),
+            ('query_engines_info_json', self.query_engines_info_json),
+            ('chunk_store_save_path', self.chunk_store_save_path)
+        )
+
+    def num_shards(self, collection_name):
+        """
+        Returns the number of shards of a collection.
+        Args:
+            collection_name (str): The name of the collection.
+        Returns:
+            int: The number of shards, 1 for collections that are not sharded.
+        """
+        details = self.get_query_engines_detail_by_name([collection_name])
+        return details[0].get('num_shards', 1) if details else 1
+
+    def storage_base_name(self, collection_name, storage_version=None):
+        """
+        Returns the name under which a version of the indices of a collection is stored. Refreshing a collection
+        stores its updated indices as a new version, so the current version is served until they are ready.
+        Args:
+            collection_name (str): The name of the collection.
+            storage_version (int, optional): The version. Defaults to the current version in the list of query engines.
+        Returns:
+            str: The name of the collection for its first version (0), '<collection>.v<version>' for the others.
+        """
+        if storage_version is None:
+            details = self.get_query_engines_detail_by_name([collection_name])
+            storage_version = details[0].get('storage_version', 0) if details else 0
+        return collection_name if not storage_version else '{}.v{}'.format(collection_name, storage_version)
+
+    def shard_storage_names(self, collection_name, num_shards=None, storage_version=None):
+        """
+        Returns the names under which the shards of a collection are stored. Each shard has its own
+        Chroma directory, keyword store and chunk store, named after its storage name.
+        Args:
+            collection_name (str): The name of the collection.
+            num_shards (int, optional): The number of shards. Defaults to the number of shards in the list of query engines.
+            storage_version (int, optional): The version of the indices. Defaults to the current version in the list of query engines.
+        Returns:
+            list of str: '<base name>.shard-<i>' for each shard, or the base name if the collection is not sharded
+                         (see `storage_base_name`).
+        """
+        if num_shards is None:
+            num_shards = self.num_shards(collection_name)
+        base_name = self.storage_base_name(collection_name, storage_version)
+        if num_shards <= 1:
+            return [base_name]
+        return ['{}.shard-{:02d}'.format(base_name, shard) for shard in range(num_shards)]
+
+    def page_hashes_path(self, storage_base_name):
+        """
+        Returns the path of the content hashes of the pages of a version of a collection.
+        Args:
+            storage_base_name (str): The base name of the version (see `storage_base_name`).
+        Returns:
+            str: The path of the JSON file, next to the chunk stores.
+        """
+        return os.path.join(self.chunk_store_save_path, storage_base_name + '.pages.json')
+
+    def load_page_hashes(self, collection_name, storage_version=None):
+        """
+        Loads the content hashes of the pages indexed in a version of a collection.
+        Args:
+            collection_name (str): The name of the collection.
+            storage_version (int, optional): The version. Defaults to the current version.
+        Returns:
+            dict: The 'pages' (link to content hash) and the time the pages were last 'crawled' (seconds since the
+                  epoch), or None for collections created before page hashes were saved.
+        """
+        path = self.page_hashes_path(self.storage_base_name(collection_name, storage_version))
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as file:
+            return json.load(file)
+
+    def save_page_hashes(self, collection_name, storage_version, pages, crawled=None):
+        """
+        Saves the content hashes of the pages indexed in a version of a collection.
+        Args:
+            collection_name (str): The name of the collection.
+            storage_version (int): The version.
+            pages (dict): A dictionary that maps the link of each page to the content hash (see `page_hashes`).
+            crawled (float, optional): The time the pages were crawled, in seconds since the epoch. Defaults to now.
+        """
+        path = self.page_hashes_path(self.storage_base_name(collection_name, storage_version))
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary_path, 'w') as file:
+            json.dump({"crawled": time.time() if crawled is None else crawled, "pages": pages}, file)
+        os.replace(temporary_path, path)
+
+    def build_report_path(self, collection_name):
+        """
+        Returns the path of the build report of a collection.
+        Args:
+            collection_name (str): The name of the collection.
+        Returns:
+            str: The path of the JSON file, next to the vector indices.
+        """
+        return os.path.join(self.vector_index_save_path, collection_name + '.build-report.json')
+
+    def save_build_report(self, collection_name, report):
+        """
+        Saves the metrics of the build of a collection.
+        Args:
+            collection_name (str): The name of the collection.
+            report (BuildReport): The report of the build.
+        """
+        path = self.build_report_path(collection_name)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary_path, 'w') as file:
+            json.dump(report.to_dict(), file, indent=2)
+        os.replace(temporary_path, path)
+
+    def keyword_store_path(self, collection_name):
+        """
+        Returns the path of the keyword store of a collection.
+        Args:
+            collection_name (str): The name of the collection.
+        Returns:
+            str: The path of the SQLite file that stores the keyword index of the collection.
+        """
+        return os.path.join(self.keyword_index_save_path, collection_name + '.sqlite3')
+
+    @profiled('create_new_collection')
+    def create_new_collection(self, user_models, path_json_file, type_json, num_shards=None, report=None):
         """
         Creates a new collection by processing the input JSON file and generating vector and keyword indices.
         Args:
             user_models (UserModels): The user models used for creating the collection.
             path_json_file (str): The path to the input JSON file containing the data.
             type_json (str): The type of JSON file, either 'Webpages' or 'PDFs'.
+            num_shards (int, optional): The number of shards of the collection. Defaults to the sharding settings.
+            report (BuildReport, optional): The report in which the metrics of the build are recorded, e.g. to show
+                                            them while the collection is built. Defaults to a new report.
         Raises:
             ValueError: If the type_json is not 'Webpages' or 'PDFs'.
             FileNotFoundError: If the output file is not found.
@@ -50,111 +264,151 @@ class CollectionManager:
 
         file_name_no_exten = format_collection_name(name=file_name_no_exten)
 
-        # Extract text content of each entities in input json file
-        output_file = None
-        if type_json == 'Webpages':
-            try:
-                output_file = scrape_articles(
-                    json_file=path_json_file, 
-                    output_file=os.path.join(self.scraped_data_path, file_name)
-                )
-            except Exception as e:
-                logging.error("An error occured: {}".format(e))
-                output_file = None
-        elif type_json == 'PDFs':
+        # Every stage of the build is recorded in its report, which is saved next to the collection
+        report = report if report is not None else BuildReport()
+        report.attributes.update(collection=file_name_no_exten, source_type=type_json)
+        with trace_build(report):
+            # Extract text content of each entities in input json file
+            output_file = None
+            if type_json == 'Webpages':
+                try:
+                    output_file = scrape_articles(
+                        json_file=path_json_file, 
+                        output_file=os.path.join(self.scraped_data_path, file_name)
+                    )
+                except Exception as e:
+                    logging.error("An error occured: {}".format(e))
+                    output_file = None
+            elif type_json == 'PDFs':
+                try:
+                    output_file = scrape_pdfs(
+                        json_file=path_json_file, 
+                        output_file=os.path.join(self.scraped_data_path, file_name)
+                    )
+                except Exception as e:
+                    logging.error("An error occured: {}".format(e))
+                    output_file = None
+            else:
+                raise ValueError('Selected Type of JSON file is incorrect.')
+
             try:
-                output_file = scrape_pdfs(
-                    json_file=path_json_file, 
-                    output_file=os.path.join(self.scraped_data_path, file_name)
+                with open(output_file, "r") as file:
+                    data = json.load(file)
+            except FileNotFoundError:
+                raise FileNotFoundError("The file was not found: {}.",format(output_file))  # Raising error here
+            except json.JSONDecodeError:
+                raise ValueError("Invalid JSON format: {}.".format(output_file))
+
+            # Create vector and keyword indices and save the details of the collection, with its
+            # source so that it can be crawled again
+            self.build_collection(
+                    user_models=user_models, 
+                    data=data, 
+                    collection_name=file_name_no_exten,
+                    num_shards=num_shards,
+                    source={"path": path_json_file, "type": type_json}
                 )
-            except Exception as e:
-                logging.error("An error occured: {}".format(e))
-                output_file = None
-        else:
-            raise ValueError('Selected Type of JSON file is incorrect.')
 
-        try:
-            with open(output_file, "r") as file:
-                data = json.load(file)
-        except FileNotFoundError:
-            raise FileNotFoundError("The file was not found: {}.",format(output_file))  # Raising error here
-        except json.JSONDecodeError:
-            raise ValueError("Invalid JSON format: {}.".format(output_file))
+        self.save_build_report(file_name_no_exten, report)
+        logging.info('>    {} was built in {:.1f} s.'.format(file_name_no_exten, report.to_dict()["duration_ms"] / 1000))
+
+    def build_collection(self, user_models, data, collection_name, num_shards=None, source=None):
+        """
+        Builds the vector index and keyword index of a collection from its scraped data, and adds the
+        collection to the list of query engines. The documents of a sharded collection are hash-partitioned
+        by their link, and the shards are built in parallel.
+        Args:
+            user_models (UserModels): The user models used for creating the collection.
+            data (dict): The scraped data, with a 'description' and a 'data' list whose entities contain
+                         'Name', 'Link' and 'Content'.
+            collection_name (str): The name of the collection.
+            num_shards (int, optional): The number of shards. Defaults to the sharding settings.
+            source (dict, optional): The 'path' and 'type' ('Webpages' or 'PDFs') of the input JSON file the data
+                                     was scraped from, saved so that the collection can be refreshed.
+        Returns:
+            None
+        """
+        settings = sharding_settings()
+        if num_shards is None:
+            num_shards = settings['num_shards']
+        num_shards = max(1, int(num_shards))
 
         # Convert text to Document object
-        documents = []
-        for entity_i in data['data']:
-            documents.append(Document(
-                text=entity_i['Content'], 
-                metadata={'Link': entity_i['Link'], 'Name': entity_i['Name']}, 
-                excluded_llm_metadata_keys=[
-                        "Name",
-                        "Link",
-                    ],
-                excluded_embed_metadata_keys=[
-                        "Link"                    
-                    ],
+        documents = documents_from_scraped_data(data)
+        partitions = partition_documents(documents, num_shards) if num_shards > 1 else [documents]
+        storage_names = self.shard_storage_names(collection_name, num_shards, storage_version=0)
+
+        def build_shard(shard):
+            storage_name, shard_documents = shard
+
+            # Create vector index and store the chunk texts
+            nodes = self.__create_vector_index(
+                    user_models=user_models, 
+                    documents=shard_documents, 
+                    collection_name=collection_name,
+                    storage_name=storage_name
+                )
+            
+            # Create keyword index
+            self.__create_keyword_index(
+                    nodes=nodes, 
+                    collection_name=storage_name, 
+                    model_llm=user_models.model_llm
                 )
-            ) 
 
-        # Create vector index
-        nodes = self.__create_vector_index(
-                user_models=user_models, 
-                documents=documents, 
-                collection_name=file_name_no_exten
-            )
-        
-        # Create keyword index
-        self.__create_keyword_index(
-                nodes=nodes, 
-                collection_name=file_name_no_exten, 
-                model_llm=user_models.model_llm
-            )
+        run_parallel(build_shard, list(zip(storage_names, partitions)), max_workers=settings['build_workers'])
+        self.save_page_hashes(collection_name, 0, page_hashes(data))
 
         # Save the details of the created vector store
         self.__save_query_engine_info(
                 user_models=user_models, 
-                collection_name=file_name_no_exten, 
-                collection_description=data['description']
+                collection_name=collection_name, 
+                collection_description=data['description'],
+                num_shards=num_shards,
+                source=source
             )
 
-    def __create_vector_index(self, user_models, documents, collection_name):
+    def __create_vector_index(self, user_models, documents, collection_name, storage_name=None):
         """
         Creates a vector index for the given documents using the specified user models and collection name.
+        The texts of the chunks are stored once in the chunk store of the collection, and the vector index
+        only stores their embeddings and metadata.
         Args:
             user_models (object): An object containing user-defined models for embedding.
             documents (list): A list of documents to be indexed.
             collection_name (str): The name of the collection to be created in the vector database.
+            storage_name (str, optional): The storage name of the shard. Defaults to the name of the collection.
         Returns:
             list: A list of nodes resulting from the transformation pipeline.
         Raises:
             ValueError: If an authentication error occurs or any other unexpected error is encountered.
         """
+        import chromadb
+        from openai import AuthenticationError
+        from llama_index.vector_stores.chroma import ChromaVectorStore
+
+        storage_name = storage_name or collection_name
+
         # Path to save collection
-        collection_path = os.path.join(self.vector_index_save_path, collection_name)
+        collection_path = self.vector_index_path(storage_name)
 
         #Vector based database to store docs, their embeddings, ...
-        logging.info(">    Creating {} Vector Index ...".format(collection_name))
+        logging.info(">    Creating {} Vector Index ...".format(storage_name))
         chroma_client = chromadb.PersistentClient(path=collection_path)
         chroma_collection = chroma_client.create_collection(name=collection_name)
         # Define a storage context object using the created vector database.
         vector_store = ChromaVectorStore(chroma_collection=chroma_collection)    
 
-        token_spliter = TokenTextSplitter(chunk_size=800, chunk_overlap=0, separator=" ")
-        
-        # Create the pipeline to apply the transformation on each document,
-        # and store the transformed nodes in the vector store.
-        pipeline = IngestionPipeline(
-            transformations=[
-                token_spliter, # Split documents to chunks
-                user_models.model_embd, # Convert to embedding vector
-            ],
-            vector_store=vector_store
-        )
-
-        # Run the transformation pipeline.
+        # Run the transformation pipeline, and store the texts in the chunk store 
+        # and the embeddings in the vector store.
         try:
-            nodes = pipeline.run(documents=documents, show_progress=True)
+            with span("ingest.vector_index", collection=storage_name, num_documents=len(documents)) as attributes:
+                nodes = self.__embed_documents(user_models, documents)
+                attributes["num_nodes"] = len(nodes)
+                with span("ingest.chunk_store_write", num_nodes=len(nodes)):
+                    ChunkStore(self.chunk_store_path(storage_name)).add_nodes(nodes)
+                with span("ingest.chroma_write", num_nodes=len(nodes)):
+                    vector_store.add(strip_nodes(nodes))
         except AuthenticationError:
             raise ValueError("Authentication error: Incorrect API key provided.")
         except Exception as e:
@@ -162,11 +416,30 @@ class CollectionManager:
 
         return nodes
 
+    def __embed_documents(self, user_models, documents):
+        """
+        Splits documents into chunks and embeds them. Splitting and embedding are recorded as separate
+        stages, and every call of the embedding model as an 'embedding' span.
+        Args:
+            user_models (object): An object containing user-defined models for embedding.
+            documents (list): The documents.
+        Returns:
+            list: The nodes of the chunks, with their embeddings.
+        """
+        # Split documents to chunks
+        with span("ingest.split", num_documents=len(documents)) as attributes:
+            nodes = create_text_splitter()(documents, show_progress=True)
+            attributes["num_chunks"] = len(nodes)
+
+        # Convert to embedding vector
+        with span("ingest.embed", num_chunks=len(nodes)):
+            return user_models.model_embd(nodes, show_progress=True)
+
     def __create_keyword_index(self, nodes, collection_name, model_llm):
         """
         Creates a keyword index for the given nodes and collection name.
         This method initializes a SimpleKeywordTableIndex with the provided nodes and LLM model,
-        logs the creation process, and persists the index to a specified directory.
+        logs the creation process, and writes the index to a KeywordStore.
         Args:
             nodes (list): A list of nodes to be indexed.
             collection_name (str): The name of the collection for which the keyword index is being created.
@@ -174,18 +447,22 @@ class CollectionManager:
         Returns:
             None
         """
+        from llama_index.core import SimpleKeywordTableIndex
+        from knowledgeBase.keyword_store import KeywordStore
+
         logging.info(">    Creating {} Keyword Index ...".format(collection_name))
-        # Initialize the SimpleKeywordTableIndex with the service context
-        keyword_index = SimpleKeywordTableIndex(nodes=nodes, llm=model_llm, show_progress=True)
+        with span("ingest.keyword_index", collection=collection_name, num_nodes=len(nodes)):
+            # Initialize the SimpleKeywordTableIndex with the service context
+            keyword_index = SimpleKeywordTableIndex(nodes=nodes, llm=model_llm, show_progress=True)
 
-        # Define the directory path
-        os.makedirs(self.keyword_index_save_path, exist_ok=True)
+            # The texts are in the chunk store and the embeddings in the vector index, so the
+            # docstore of the keyword index only keeps the metadata of the nodes
+            keyword_index.docstore.add_documents(strip_nodes(nodes, keep_embedding=False), allow_update=True)
 
-        # Persist the index with a specific ID
-        persist_directory = os.path.join(self.keyword_index_save_path, collection_name)
-        keyword_index.storage_context.persist(persist_directory)
+            # Persist the index in a SQLite file, which is opened without reading it
+            KeywordStore.from_index(self.keyword_store_path(collection_name), keyword_index)
 
-    def __save_query_engine_info(self, user_models, collection_name, collection_description):
+    def __save_query_engine_info(self, user_models, collection_name, collection_description, num_shards=1, source=None):
         """
         Saves information about the query engine to a JSON file.
         This method adds details of the created vector store to a list of vector stores
@@ -195,31 +472,31 @@ class CollectionManager:
             user_models: An object containing user model information, specifically the embedding name.
             collection_name (str): The name of the collection to be saved.
             collection_description (str): A description of the collection to be saved.
+            num_shards (int): The number of shards of the collection, saved if the collection is sharded.
+            source (dict, optional): The input JSON file of the collection, saved if it is given.
         Raises:
             IOError: If there is an error reading or writing to the JSON file.
         """        
         # Add detail of created vector store to list of vector stores
-        if not os.path.exists(self.query_engines_info_json):
-            with open(self.query_engines_info_json, 'w') as file:
-                json.dump([], file)
-        vec_store_desc=[]
-        with open(self.query_engines_info_json, 'r') as file:
-            vec_store_desc = json.load(file)
-            new_entry = {
-                        "name": collection_name,
-                        "description": collection_description,
-                        "embedding_name": user_models.embedding_name
-                    }
-            vec_store_desc.append(new_entry)
-        with open(self.query_engines_info_json, 'w') as file:
-                json.dump(vec_store_desc, file)
+        vec_store_desc = self.get_query_engines_detail()
+        new_entry = {
+                    "name": collection_name,
+                    "description": collection_description,
+                    "embedding_name": user_models.embedding_name
+                }
+        if num_shards > 1:
+            new_entry["num_shards"] = num_shards
+        if source is not None:
+            new_entry["source"] = source
+        vec_store_desc.append(new_entry)
+        self.write_query_engines_detail(vec_store_desc)
 
     def delete_query_engine_by_name(self, name):
         """
         Deletes a query engine by its name.
         This method performs the following actions:
         1. Deletes the vector store associated with the query engine.
-        2. Deletes the keyword index directory associated with the query engine.
+        2. Deletes the keyword index directory and the chunk store associated with the query engine.
         3. Updates the list of query engines by removing the entry with the specified name.
         Args:
             name (str): The name of the query engine to be deleted.
@@ -228,37 +505,407 @@ class CollectionManager:
             json.JSONDecodeError: If the query engines info JSON file contains invalid JSON.
         """
 
-        # Path to save collection
-        collection_path = os.path.join(self.vector_index_save_path, name)
-        
-        # Delete the vector store
-        if os.path.exists(collection_path):
-            shutil.rmtree(collection_path)
-            print("The folder has been deleted successfully!")
-        else:
-            print("The folder does not exist.")
-
-        # Delete the keyword index
-        directory_path = self.keyword_index_save_path
-        persist_directory = os.path.join(directory_path, name)
-        os.system("rm -rf {}".format(persist_directory))
+        # The current version of the indices, the previous one kept after a refresh, and the next one of an
+        # interrupted re-embedding
+        details = self.get_query_engines_detail_by_name([name])
+        storage_version = details[0].get('storage_version', 0) if details else 0
+        for version in sorted({max(0, storage_version - 1), storage_version, storage_version + 1}):
+            self.__delete_storage(name, version)
+        for path in (self.reembed_checkpoint_path(name), self.build_report_path(name)):
+            if os.path.exists(path):
+                os.remove(path)
 
         # Update the list of query engines
-        with open(self.query_engines_info_json, 'r') as file:
-            vec_store_desc = json.load(file)
-            vec_store_desc = [i for i in vec_store_desc if i['name'] != name]
-        with open(self.query_engines_info_json, 'w') as file:
-            json.dump(vec_store_desc, file)
+        vec_store_desc = [i for i in self.get_query_engines_detail() if i['name'] != name]
+        self.write_query_engines_detail(vec_store_desc)
+
+    def __delete_storage(self, name, storage_version, num_shards=None):
+        """
+        Deletes the vector indices, keyword indices, chunk stores and page hashes of a version of a collection.
+        Args:
+            name (str): The name of the collection.
+            storage_version (int): The version.
+            num_shards (int, optional): The number of shards. Defaults to the number of shards in the list of query engines.
+        """
+        storage_names = self.shard_storage_names(name, num_shards=num_shards, storage_version=storage_version)
+        for storage_name in storage_names:
+            # Path to save collection
+            collection_path = self.vector_index_path(storage_name)
+            
+            # Delete the vector store
+            if os.path.exists(collection_path):
+                shutil.rmtree(collection_path)
+                print("The folder has been deleted successfully!")
+            else:
+                print("The folder does not exist.")
+
+            # Delete the keyword index
+            directory_path = self.keyword_index_save_path
+            persist_directory = os.path.join(directory_path, storage_name)
+            os.system("rm -rf {}".format(persist_directory))
+            if os.path.exists(self.keyword_store_path(storage_name)):
+                os.remove(self.keyword_store_path(storage_name))
+
+            # Delete the chunk store
+            if os.path.exists(self.chunk_store_path(storage_name)):
+                os.remove(self.chunk_store_path(storage_name))
+
+            # Forget the loaded indices of the collection
+            self.evict_shared_indices(storage_name)
+
+        page_hashes_path = self.page_hashes_path(self.storage_base_name(name, storage_version))
+        if os.path.exists(page_hashes_path):
+            os.remove(page_hashes_path)
+
+    def refresh_collection(self, user_models, collection_name, data, listed_links=None):
+        """
+        Updates a collection with newly crawled data. Only the pages whose content changed are embedded and
+        indexed again: the indices are copied to a new version, the chunks of the changed and removed pages
+        are deleted from the copy and the chunks of the changed and new pages added to it. The collection is
+        then switched to the new version by rewriting its entry in the list of query engines, so queries are
+        served from the previous version until the new one is complete. The previous version is kept for the
+        queries that are still using it, and the version before it is deleted. Collections without page
+        hashes or with keyword indices in JSON files are built again in full as the new version.
+        Args:
+            user_models (UserModels): The user models, with the embedding model of the collection.
+            collection_name (str): The name of the collection.
+            data (dict): The newly scraped data, with a 'description' and a 'data' list whose entities contain
+                         'Name', 'Link' and 'Content'.
+            listed_links (list of str, optional): All links of the input JSON file. Listed pages that are missing
+                                                  from `data` (e.g. because they could not be fetched) keep their
+                                                  indexed content instead of being removed. Defaults to the links of `data`.
+        Returns:
+            dict: The numbers of 'changed', 'added', 'removed' and 'unchanged' pages, whether the collection was
+                  'rebuilt' in full, and the 'storage_version' served after the refresh.
+        Raises:
+            ValueError: If the collection does not exist, is being embedded again or another process is
+                        refreshing it (see `build_lock`).
+        """
+        with self.build_lock(collection_name):
+            return self.__refresh_collection(user_models, collection_name, data, listed_links)
 
-    def load_vector_index_from_file(self, query_engine_name, model_embd):
+    def __refresh_collection(self, user_models, collection_name, data, listed_links):
+        """
+        Updates a collection with newly crawled data, while its build lock is held (see `refresh_collection`).
+        """
+        import chromadb
+        from llama_index.vector_stores.chroma import ChromaVectorStore
+        from llama_index.core import SimpleKeywordTableIndex
+        from knowledgeBase.keyword_store import KeywordStore
+
+        details = self.get_query_engines_detail_by_name([collection_name])
+        if not details:
+            raise ValueError('Unknown collection: {}.'.format(collection_name))
+        if os.path.exists(self.reembed_checkpoint_path(collection_name)):
+            raise ValueError('{} is being embedded again and cannot be refreshed until it is done.'.format(collection_name))
+        details = details[0]
+        num_shards = details.get('num_shards', 1)
+        version = details.get('storage_version', 0)
+        old_names = self.shard_storage_names(collection_name, num_shards=num_shards, storage_version=version)
+        new_names = self.shard_storage_names(collection_name, num_shards=num_shards, storage_version=version + 1)
+
+        # Pages whose content hash changed, pages that were added and pages no longer listed in the input file
+        indexed = self.load_page_hashes(collection_name, version)
+        old_pages = indexed['pages'] if indexed is not None else {}
+        new_pages = page_hashes(data)
+        for link in (listed_links or []):
+            if link not in new_pages and link in old_pages:
+                new_pages[link] = old_pages[link]
+        stale = {link for link in old_pages if new_pages.get(link) != old_pages[link]}
+        fresh = {link for link in new_pages if old_pages.get(link) != new_pages[link]}
+        summary = {
+            "changed": len(stale & fresh),
+            "added": len(fresh - stale),
+            "removed": len(stale - fresh),
+            "unchanged": len(set(new_pages) - fresh),
+            "rebuilt": False,
+            "storage_version": version
+        }
+
+        if indexed is not None and not stale and not fresh:
+            self.save_page_hashes(collection_name, version, old_pages)
+            return summary
+
+        incremental = indexed is not None and all(os.path.exists(self.keyword_store_path(name)) and os.path.exists(self.chunk_store_path(name))
+                                                  for name in old_names)
+        summary["rebuilt"] = not incremental
+        self.__delete_storage(collection_name, version + 1, num_shards=num_shards)
+        try:
+            with span("refresh.collection", collection=collection_name, changed_pages=len(fresh), removed_pages=len(stale - fresh), incremental=incremental):
+                if not incremental:
+                    # Build the new version from all pages
+                    documents = documents_from_scraped_data(data)
+                    partitions = partition_documents(documents, num_shards) if num_shards > 1 else [documents]
+                    for storage_name, shard_documents in zip(new_names, partitions):
+                        nodes = self.__create_vector_index(user_models=user_models, documents=shard_documents,
+                                                           collection_name=collection_name, storage_name=storage_name)
+                        self.__create_keyword_index(nodes=nodes, collection_name=storage_name, model_llm=user_models.model_llm)
+                else:
+                    documents = documents_from_scraped_data({"data": [entity for entity in data['data'] if entity['Link'] in fresh]})
+                    nodes = self.__embed_documents(user_models, documents) if documents else []
+                    for shard, (old_name, new_name) in enumerate(zip(old_names, new_names)):
+                        # Copy the current version, which is only read by the running queries
+                        shutil.copytree(self.vector_index_path(old_name), self.vector_index_path(new_name))
+                        shutil.copy2(self.keyword_store_path(old_name), self.keyword_store_path(new_name))
+                        shutil.copy2(self.chunk_store_path(old_name), self.chunk_store_path(new_name))
+
+                        in_shard = lambda link: num_shards == 1 or shard_of(link, num_shards) == shard
+                        stale_links = sorted(link for link in stale if in_shard(link))
+                        shard_nodes = [node for node in nodes if in_shard(node.metadata['Link'])]
+
+                        chroma_collection = chromadb.PersistentClient(path=self.vector_index_path(new_name)).get_collection(name=collection_name)
+                        keyword_store = KeywordStore(self.keyword_store_path(new_name))
+                        chunk_store = ChunkStore(self.chunk_store_path(new_name))
+
+                        # Delete the chunks of the changed and removed pages
+                        for start in range(0, len(stale_links), ChunkStore.batch_size):
+                            node_ids = chroma_collection.get(where={"Link": {"$in": stale_links[start:start + ChunkStore.batch_size]}}, include=[])['ids']
+                            if node_ids:
+                                chroma_collection.delete(ids=node_ids)
+                                keyword_store.delete_nodes(node_ids)
+                                chunk_store.delete_nodes(node_ids)
+
+                        # Add the chunks of the changed and new pages
+                        if shard_nodes:
+                            chunk_store.add_nodes(shard_nodes)
+                            ChromaVectorStore(chroma_collection=chroma_collection).add(strip_nodes(shard_nodes))
+                            keyword_index = SimpleKeywordTableIndex(nodes=shard_nodes, llm=user_models.model_llm)
+                            keyword_store.write(keyword_index.index_struct.table, strip_nodes(shard_nodes, keep_embedding=False))
+        except Exception:
+            self.__delete_storage(collection_name, version + 1, num_shards=num_shards)
+            raise
+
+        self.save_page_hashes(collection_name, version + 1, new_pages)
+
+        self.__switch_storage_version(collection_name, version + 1, num_shards, description=data.get('description', details['description']))
+
+        summary["storage_version"] = version + 1
+        logging.info('>    {} was refreshed: {} changed, {} added and {} removed pages ({}).'.format(
+            collection_name, summary["changed"], summary["added"], summary["removed"], 'rebuilt' if summary["rebuilt"] else 'incremental'))
+        return summary
+
+    def __switch_storage_version(self, collection_name, storage_version, num_shards, **updates):
+        """
+        Switches a collection to a new version of its indices in a single write of the list of query engines,
+        and deletes the version before the previous one. The previous version is kept for the queries that
+        are still using it.
+        Args:
+            collection_name (str): The name of the collection.
+            storage_version (int): The new version.
+            num_shards (int): The number of shards.
+            **updates: Other fields of the entry of the collection to update, e.g. its 'embedding_name'.
+        """
+        vec_store_desc = self.get_query_engines_detail()
+        for entry in vec_store_desc:
+            if entry['name'] == collection_name:
+                entry['storage_version'] = storage_version
+                entry.update(updates)
+        self.write_query_engines_detail(vec_store_desc)
+        if storage_version >= 2:
+            self.__delete_storage(collection_name, storage_version - 2, num_shards=num_shards)
+
+    def reembed_checkpoint_path(self, collection_name):
+        """
+        Returns the path of the checkpoint of the re-embedding of a collection, which exists while it is in progress.
+        Args:
+            collection_name (str): The name of the collection.
+        Returns:
+            str: The path of the JSON file, next to the chunk stores.
+        """
+        return os.path.join(self.chunk_store_save_path, collection_name + '.reembed.json')
+
+    def build_lock_path(self, collection_name):
+        """
+        Returns the path of the build lock of a collection, which exists while it is refreshed or embedded again.
+        Args:
+            collection_name (str): The name of the collection.
+        Returns:
+            str: The path of the lock file, next to the checkpoints of the re-embeddings.
+        """
+        return os.path.join(self.chunk_store_save_path, collection_name + '.lock')
+
+    def is_build_locked(self, collection_name):
+        """
+        Returns whether a collection is being refreshed or embedded again, by this or another process.
+        """
+        return os.path.exists(self.build_lock_path(collection_name)) and not self.__release_stale_lock(collection_name)
+
+    def __release_stale_lock(self, collection_name):
+        """
+        Deletes the build lock of a collection if the process that holds it no longer runs on this machine,
+        e.g. because it was killed. Returns whether the lock was deleted.
+        """
+        path = self.build_lock_path(collection_name)
+        try:
+            with open(path, 'r') as file:
+                owner = json.load(file)
+        except (FileNotFoundError, ValueError):
+            # Deleted in the meantime, or being written by its owner
+            return False
+        if owner.get('host') != socket.gethostname():
+            return False
+        try:
+            os.kill(owner['pid'], 0)
+            return False
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            return False
+        logging.warning('>    The build lock of {} was left by process {}, which no longer runs; it is released.'.format(collection_name, owner['pid']))
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    @contextmanager
+    def build_lock(self, collection_name):
+        """
+        Holds the build lock of a collection, so that it is not refreshed and embedded again at the same time
+        (by this or another process), which would both write its next version. The lock is a file created
+        exclusively next to the checkpoints; a lock left by a process that no longer runs is released.
+        Args:
+            collection_name (str): The name of the collection.
+        Raises:
+            ValueError: If the lock is held.
+        """
+        path = self.build_lock_path(collection_name)
+        os.makedirs(self.chunk_store_save_path, exist_ok=True)
+        for attempt in range(2):
+            try:
+                descriptor = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                if attempt == 1 or not self.__release_stale_lock(collection_name):
+                    raise ValueError('{} is being refreshed or embedded again and cannot be updated until it is done.'.format(collection_name))
+        try:
+            with os.fdopen(descriptor, 'w') as file:
+                json.dump({"pid": os.getpid(), "host": socket.gethostname(), "started": time.time()}, file)
+            yield
+        finally:
+            os.remove(path)
+
+    def reembed_collection(self, collection_name, embedding_name, model_embd, batch_size=256, restart=False):
+        """
+        Embeds the chunks of a collection again with another embedding model, from their stored texts and without
+        scraping the pages again. The new vectors are written to a new version of the collection, next to the
+        current one, whose keyword indices and chunk stores are copied. Progress is saved to a checkpoint after
+        every batch, so an interrupted migration resumes where it stopped. Once every chunk is embedded, the
+        collection is switched to the new version and embedding model in a single write of the list of query
+        engines; queries are served from the current version until then.
+        Args:
+            collection_name (str): The name of the collection.
+            embedding_name (str): The name of the new embedding model, saved in the list of query engines.
+            model_embd (BaseEmbedding): The new embedding model.
+            batch_size (int, optional): The number of chunks embedded per call of the model and per checkpoint. Defaults to 256.
+            restart (bool, optional): Whether the progress of an interrupted migration is discarded. Defaults to False.
+        Returns:
+            dict: The number of 'embedded' chunks and the 'storage_version' served after the migration.
+        Raises:
+            ValueError: If the collection does not exist or another process is refreshing it or embedding it
+                        again (see `build_lock`).
+        """
+        with self.build_lock(collection_name):
+            return self.__reembed_collection(collection_name, embedding_name, model_embd, batch_size, restart)
+
+    def __reembed_collection(self, collection_name, embedding_name, model_embd, batch_size, restart):
+        """
+        Embeds the chunks of a collection again with another embedding model, while its build lock is held (see `reembed_collection`).
+        """
+        import chromadb
+        from llama_index.core.schema import MetadataMode
+        from llama_index.core.vector_stores.utils import metadata_dict_to_node
+
+        details = self.get_query_engines_detail_by_name([collection_name])
+        if not details:
+            raise ValueError('Unknown collection: {}.'.format(collection_name))
+        details = details[0]
+        num_shards = details.get('num_shards', 1)
+        version = details.get('storage_version', 0)
+        old_names = self.shard_storage_names(collection_name, num_shards=num_shards, storage_version=version)
+        new_names = self.shard_storage_names(collection_name, num_shards=num_shards, storage_version=version + 1)
+
+        # The checkpoint is only valid for the same source version and model
+        checkpoint_path = self.reembed_checkpoint_path(collection_name)
+        checkpoint = None
+        if os.path.exists(checkpoint_path) and not restart:
+            with open(checkpoint_path, 'r') as file:
+                checkpoint = json.load(file)
+            if checkpoint['source_version'] != version or checkpoint['embedding_name'] != embedding_name:
+                checkpoint = None
+        if checkpoint is None:
+            self.__delete_storage(collection_name, version + 1, num_shards=num_shards)
+            checkpoint = {"embedding_name": embedding_name, "source_version": version, "offsets": {}}
+
+        def save_checkpoint():
+            os.makedirs(self.chunk_store_save_path, exist_ok=True)
+            temporary_path = '{}.{}.tmp'.format(checkpoint_path, os.getpid())
+            with open(temporary_path, 'w') as file:
+                json.dump(checkpoint, file)
+            os.replace(temporary_path, checkpoint_path)
+
+        save_checkpoint()
+        embedded = 0
+        with span("reembed.collection", collection=collection_name, embedding=embedding_name) as attributes:
+            for old_name, new_name in zip(old_names, new_names):
+                source = chromadb.PersistentClient(path=self.vector_index_path(old_name)).get_collection(name=collection_name)
+                target = chromadb.PersistentClient(path=self.vector_index_path(new_name)).get_or_create_collection(name=collection_name)
+                chunk_store = ChunkStore(self.chunk_store_path(old_name), read_only=True) if os.path.exists(self.chunk_store_path(old_name)) else None
+
+                # Vectors are the only part of the indices that depends on the embedding model
+                offset = checkpoint["offsets"].get(new_name, 0)
+                total = source.count()
+                while offset < total:
+                    batch = source.get(offset=offset, limit=batch_size, include=['metadatas', 'documents'])
+                    if not batch['ids']:
+                        break
+                    texts = chunk_store.get_texts(batch['ids']) if chunk_store is not None else {}
+                    embed_texts = []
+                    for node_id, metadata, document in zip(batch['ids'], batch['metadatas'], batch['documents']):
+                        node = metadata_dict_to_node(metadata, text=texts.get(node_id, document or ""))
+                        embed_texts.append(node.get_content(metadata_mode=MetadataMode.EMBED))
+                    embeddings = model_embd.get_text_embedding_batch(embed_texts)
+                    target.upsert(ids=batch['ids'], embeddings=embeddings, metadatas=batch['metadatas'], documents=batch['documents'])
+
+                    offset += len(batch['ids'])
+                    embedded += len(batch['ids'])
+                    checkpoint["offsets"][new_name] = offset
+                    save_checkpoint()
+                    logging.info('>    {}: {}/{} chunks embedded with {}.'.format(new_name, offset, total, embedding_name))
+
+                # The keyword indices and chunk texts do not change
+                if os.path.exists(self.keyword_store_path(old_name)):
+                    shutil.copy2(self.keyword_store_path(old_name), self.keyword_store_path(new_name))
+                elif os.path.isdir(os.path.join(self.keyword_index_save_path, old_name)):
+                    shutil.rmtree(os.path.join(self.keyword_index_save_path, new_name), ignore_errors=True)
+                    shutil.copytree(os.path.join(self.keyword_index_save_path, old_name), os.path.join(self.keyword_index_save_path, new_name))
+                if chunk_store is not None:
+                    shutil.copy2(self.chunk_store_path(old_name), self.chunk_store_path(new_name))
+            attributes["num_nodes"] = embedded
+
+        old_hashes = self.load_page_hashes(collection_name, version)
+        if old_hashes is not None:
+            self.save_page_hashes(collection_name, version + 1, old_hashes['pages'], crawled=old_hashes['crawled'])
+
+        self.__switch_storage_version(collection_name, version + 1, num_shards, embedding_name=embedding_name)
+        os.remove(checkpoint_path)
+        logging.info('>    {} is now embedded with {}.'.format(collection_name, embedding_name))
+        return {"embedded": embedded, "storage_version": version + 1}
+
+    def load_vector_index_from_file(self, query_engine_name, model_embd, storage_name=None):
         """
         Load a vector index from a file based on the query engine name and embedding model.
         Args:
             query_engine_name (str): The name of the query engine to load.
             model_embd: The embedding model to use for the vector store index.
+            storage_name (str, optional): The storage name of the shard to load. Defaults to the current version of the collection.
         Returns:
             VectorStoreIndex: The loaded vector store index if the query engine is found, otherwise None.
         """
+        import chromadb
+        from llama_index.vector_stores.chroma import ChromaVectorStore
+        from llama_index.core import VectorStoreIndex
+
                 
         qe_details = self.get_query_engines_detail()
         
@@ -272,7 +919,7 @@ class CollectionManager:
             return None
 
         # Path to save collection
-        collection_path = os.path.join(self.vector_index_save_path, query_engine_name)
+        collection_path = self.vector_index_path(storage_name or self.storage_base_name(query_engine_name, qe_details[loc].get('storage_version', 0)))
 
         # Load query engine from database
         chroma_client = chromadb.PersistentClient(path=collection_path)
@@ -281,25 +928,154 @@ class CollectionManager:
         vector_store_index = VectorStoreIndex.from_vector_store(vector_store, embed_model=model_embd)
         return vector_store_index
 
-    def load_keyword_index_from_file(self, query_engine_name, model_llm):
+    def load_keyword_index_from_file(self, query_engine_name, model_llm, storage_name=None):
         """
         Load the keyword index from a file.
-        This method rebuilds the storage context using the specified query engine name
-        and loads the keyword index from the storage using the provided LLM model.
+        If the collection has a keyword store, it is opened for reading. Otherwise (collections created
+        before keyword stores were introduced), this method rebuilds the storage context using the specified
+        query engine name and loads the keyword index from the storage using the provided LLM model.
+        Both have an `as_retriever` method.
         Args:
             query_engine_name (str): The name of the query engine.
             model_llm (Any): The language model to be used for loading the index.
+            storage_name (str, optional): The storage name of the shard to load. Defaults to the current version of the collection.
         Returns:
-            keyword_index: The loaded keyword index.
+            keyword_index: The keyword store or the loaded keyword index.
         """
+        from llama_index.core.storage import StorageContext
+        from llama_index.core import load_index_from_storage
+        from knowledgeBase.keyword_store import KeywordStore
+
+        storage_name = storage_name or self.storage_base_name(query_engine_name)
+        path = self.keyword_store_path(storage_name)
+        if os.path.exists(path):
+            return KeywordStore(path, read_only=True)
 
         # Rebuild the storage context
         storage_context = StorageContext.from_defaults(
-                persist_dir=os.path.join(self.keyword_index_save_path, query_engine_name)
+                persist_dir=os.path.join(self.keyword_index_save_path, storage_name)
             )
         keyword_index = load_index_from_storage(storage_context=storage_context, index_id=None, llm=model_llm)
         return keyword_index
 
+    def convert_keyword_index(self, query_engine_name):
+        """
+        Converts the keyword index of a collection from the JSON files of a persisted SimpleKeywordTableIndex
+        to a keyword store, and deletes the JSON files.
+        Args:
+            query_engine_name (str): The name of the query engine.
+        """
+        from llama_index.core.llms import MockLLM
+        from knowledgeBase.keyword_store import KeywordStore
+
+        storage_name = self.storage_base_name(query_engine_name)
+        persist_directory = os.path.join(self.keyword_index_save_path, storage_name)
+        if os.path.exists(self.keyword_store_path(storage_name)) or not os.path.exists(persist_directory):
+            return
+
+        keyword_index = self.load_keyword_index_from_file(query_engine_name=query_engine_name, model_llm=MockLLM(), storage_name=storage_name)
+        KeywordStore.from_index(self.keyword_store_path(storage_name), keyword_index)
+        shutil.rmtree(persist_directory)
+        self.evict_shared_indices(storage_name)
+        logging.info('>    Keyword index of {} was converted to a keyword store.'.format(query_engine_name))
+
+    def load_shared_indices(self, query_engine_name, model_llm, model_embd, storage_name=None):
+        """
+        Returns the vector index and keyword index of a collection, loading them from disk only the
+        first time they are requested in this process. The returned indices are shared by all query
+        engines, so retrievers must be given their own embedding model instead of relying on the
+        one the vector index was loaded with.
+        Args:
+            query_engine_name (str): The name of the query engine.
+            model_llm: The language model used when the keyword index is loaded, or None.
+            model_embd: The embedding model used when the vector index is loaded, or None.
+            storage_name (str, optional): The storage name of the shard to load. Defaults to the current version of the collection.
+        Returns:
+            tuple: The vector index (None if the collection is not in the list of query engines), the
+                   keyword index, and the chunk store (None for collections that store the texts in the indices).
+        """
+        storage_name = storage_name or self.storage_base_name(query_engine_name)
+        key = (os.path.abspath(self.vector_index_save_path), os.path.abspath(self.keyword_index_save_path), storage_name)
+        with _shared_indices_lock:
+            indices = _shared_indices.get(key)
+            if indices is None:
+                # Indices can be loaded before any model exists (e.g. to prewarm them at startup). The
+                # models of shared indices are not used for querying: the vector retrievers get their own
+                # embedding model and the keyword retrievers extract keywords without an LLM.
+                if model_embd is None:
+                    from llama_index.core.embeddings import MockEmbedding
+                    model_embd = MockEmbedding(embed_dim=1)
+                if model_llm is None:
+                    from llama_index.core.llms import MockLLM
+                    model_llm = MockLLM()
+                vector_index =self.load_vector_index_from_file(query_engine_name=query_engine_name, model_embd=model_embd, storage_name=storage_name)
+                keyword_index = self.load_keyword_index_from_file(query_engine_name=query_engine_name, model_llm=model_llm, storage_name=storage_name)
+                indices = (vector_index, keyword_index, self.load_chunk_store(storage_name))
+                if vector_index is not None:
+                    _shared_indices[key] = indices
+                    logging.info('>    Indices of {} were loaded and shared.'.format(storage_name))
+        return indices
+
+    def load_shard_searchers(self, query_engine_name, storage_names=None):
+        """
+        Loads the shards of a collection in parallel, each independently of the others, and returns their searchers.
+        The indices of the shards are shared like the indices of collections that are not sharded.
+        Args:
+            query_engine_name (str): The name of the query engine.
+            storage_names (list of str, optional): The storage names of the shards to load. Defaults to all shards.
+        Returns:
+            list of ShardSearcher: The searchers of the shards, in the order of `storage_names`.
+        Raises:
+            ValueError: If the collection is not in the list of query engines.
+        """
+        from knowledgeBase.shards import ShardSearcher
+
+        def load_shard(storage_name):
+            vector_index, keyword_index, chunk_store = self.load_shared_indices(
+                query_engine_name=query_engine_name, model_llm=None, model_embd=None, storage_name=storage_name)
+            if vector_index is None:
+                raise ValueError('Unknown collection: {}.'.format(query_engine_name))
+            return ShardSearcher(storage_name, vector_index, keyword_index, chunk_store)
+
+        storage_names = storage_names or self.shard_storage_names(query_engine_name)
+        return run_parallel(load_shard, storage_names, max_workers=len(storage_names))
+
+    def preload_collection(self, query_engine_name):
+        """
+        Loads the indices of a collection, so that the first queries do not wait for them. The shards of
+        sharded collections are only loaded if they are searched in this process.
+        Args:
+            query_engine_name (str): The name of the query engine.
+        """
+        if self.num_shards(query_engine_name) > 1:
+            if get_worker_pool() is None:
+                self.load_shard_searchers(query_engine_name)
+        else:
+            self.load_shared_indices(query_engine_name=query_engine_name, model_llm=None, model_embd=None)
+
+    def load_chunk_store(self, query_engine_name):
+        """
+        Opens the chunk store of a collection for reading.
+        Args:
+            query_engine_name (str): The name of the query engine.
+        Returns:
+            ChunkStore: The chunk store, or None if the collection was created before chunk stores were
+                        introduced and its texts are stored in the vector and keyword indices.
+        """
+        path = self.chunk_store_path(query_engine_name)
+        if not os.path.exists(path):
+            return None
+        return ChunkStore(path, read_only=True)
+
+    def evict_shared_indices(self, query_engine_name):
+        """
+        Removes the shared indices of a collection, so they are loaded again from disk the next time.
+        Args:
+            query_engine_name (str): The name of the query engine.
+        """
+        key = (os.path.abspath(self.vector_index_save_path), os.path.abspath(self.keyword_index_save_path), query_engine_name)
+        with _shared_indices_lock:
+            _shared_indices.pop(key, None)
 
     def get_query_engines_detail(self):
         """
@@ -320,6 +1096,49 @@ class CollectionManager:
 
         return vec_store_desc
 
+    def write_query_engines_detail(self, vec_store_desc):
+        """
+        Replaces the list of query engines. The JSON file is written next to the list and renamed over it, so
+        other processes reading the list (e.g. the workers of the API) never see a partially written file.
+        Args:
+            vec_store_desc (list of dict): The details of all query engines.
+        """
+        os.makedirs(os.path.dirname(self.query_engines_info_json) or '.', exist_ok=True)
+        temporary_path = '{}.{}.tmp'.format(self.query_engines_info_json, os.getpid())
+        with open(temporary_path, 'w') as file:
+            json.dump(vec_store_desc, file)
+        os.replace(temporary_path, self.query_engines_info_json)
+
+    def catalog_version(self):
+        """
+        Returns the version of the list of query engines, which changes whenever a collection is created or deleted.
+        Returns:
+            int: The modification time of the JSON file in nanoseconds, or None if it does not exist.
+        """
+        try:
+            return os.stat(self.query_engines_info_json).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def storage_version(self, query_engine_name):
+        """
+        Returns the version of the stored indices of a collection, which changes when the collection is built again
+        under the same name.
+        Args:
+            query_engine_name (str): The name of the query engine.
+        Returns:
+            int: The modification time in nanoseconds of the chunk store (or, for collections without one, of the
+                 vector index directory) of its first shard, or None if it does not exist.
+        """
+        storage_name = self.shard_storage_names(query_engine_name)[0]
+        path = self.chunk_store_path(storage_name)
+        if not os.path.exists(path):
+            path = self.vector_index_path(storage_name)
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
     def get_query_engines_detail_by_name(self, query_engine_names):
         """
         Retrieves detailed information about specific query engines by their names.
@@ -0,0 +1,135 @@
+import re
+import math
+from collections import Counter
+from typing import List, Optional
+
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.utils import get_tokenizer
+
+from instrumentation import span, current_trace
+
+# Default maximum number of tokens of the retrieved context that is sent to the LLM per collection
+DEFAULT_CONTEXT_TOKEN_BUDGET = 3000
+
+_sentence_end = re.compile(r'(?<=[.!?])\s+')
+_word = re.compile(r'\w+')
+
+
+def split_sentences(text, max_words=60):
+    """
+    Splits a text into sentences. Sentences longer than `max_words` words (e.g. code blocks, whose
+    whitespace was normalized during scraping) are split into pieces of `max_words` words.
+    Args:
+        text (str): The text.
+        max_words (int): The maximum number of words of a sentence.
+    Returns:
+        list of str: The sentences, in the order of the text.
+    """
+    sentences = []
+    for sentence in _sentence_end.split(text.strip()):
+        words = sentence.split(' ')
+        for start in range(0, len(words), max_words):
+            piece = ' '.join(words[start:start + max_words]).strip()
+            if piece:
+                sentences.append(piece)
+    return sentences
+
+def bm25_scores(query, sentences, k1=1.2, b=0.75):
+    """
+    Scores sentences against a query with BM25, using the sentences themselves as the corpus.
+    Args:
+        query (str): The query.
+        sentences (list of str): The sentences.
+        k1 (float): The term frequency saturation of BM25.
+        b (float): The length normalization of BM25.
+    Returns:
+        list of float: The score of each sentence.
+    """
+    query_terms = set(_word.findall(query.lower()))
+    documents = [Counter(_word.findall(sentence.lower())) for sentence in sentences]
+    if not documents or not query_terms:
+        return [0.0] * len(sentences)
+
+    average_length = sum(sum(document.values()) for document in documents) / len(documents) or 1
+    idf = {}
+    for term in query_terms:
+        document_frequency = sum(1 for document in documents if term in document)
+        idf[term] = math.log(1 + (len(documents) - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    scores = []
+    for document in documents:
+        length = sum(document.values())
+        score = 0.0
+        for term in query_terms:
+            frequency = document.get(term, 0)
+            if frequency:
+                score += idf[term] * frequency * (k1 + 1) / (frequency + k1 * (1 - b + b * length / average_length))
+        scores.append(score)
+    return scores
+
+
+class SentenceCompressor(BaseNodePostprocessor):
+    """
+    Compresses the reranked nodes to a token budget before synthesis by keeping the sentences of
+    each node that are most relevant to the query, scored locally with BM25. The best sentence of
+    every node is selected first (in the order of the nodes), so that the sources of all nodes remain
+    in the references while the budget allows it; the remaining budget is filled with the best
+    sentences overall. The selected sentences of a node are kept in their original order, and the
+    compressed nodes keep the metadata and score of the original nodes.
+    Attributes:
+        token_budget (int): The maximum number of tokens of the texts of the returned nodes.
+    """
+    token_budget: int = Field(default=DEFAULT_CONTEXT_TOKEN_BUDGET, description="Maximum number of tokens of the compressed context.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "SentenceCompressor"
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        if query_bundle is None or not nodes:
+            return nodes
+
+        with span("compress", num_nodes=len(nodes), token_budget=self.token_budget) as attributes:
+            tokenizer = get_tokenizer()
+            sentences = []
+            for node_idx, node in enumerate(nodes):
+                for sentence in split_sentences(node.node.get_content()):
+                    sentences.append((node_idx, sentence, len(tokenizer(sentence))))
+
+            tokens_in = sum(num_tokens for _, _, num_tokens in sentences)
+            if tokens_in <= self.token_budget:
+                attributes.update(tokens_in=tokens_in, tokens_out=tokens_in)
+                return nodes
+
+            scores = bm25_scores(query_bundle.query_str, [sentence for _, sentence, _ in sentences])
+            ranking = sorted(range(len(sentences)), key=lambda idx: scores[idx], reverse=True)
+
+            best_of_node = {}
+            for idx in ranking:
+                best_of_node.setdefault(sentences[idx][0], idx)
+            candidates = sorted(best_of_node.values(), key=lambda idx: sentences[idx][0]) + ranking
+
+            selected = set()
+            tokens_out = 0
+            for idx in candidates:
+                if idx not in selected and tokens_out + sentences[idx][2] <= self.token_budget:
+                    selected.add(idx)
+                    tokens_out += sentences[idx][2]
+
+            selected_sentences = [[] for _ in nodes]
+            for idx in sorted(selected):
+                selected_sentences[sentences[idx][0]].append(sentences[idx][1])
+
+            compressed_nodes = []
+            for node, node_sentences in zip(nodes, selected_sentences):
+                text = ' '.join(node_sentences)
+                if text:
+                    compressed_nodes.append(NodeWithScore(node=node.node.model_copy(update={"text": text}), score=node.score))
+
+            attributes.update(tokens_in=tokens_in, tokens_out=tokens_out, num_nodes_out=len(compressed_nodes))
+            trace = current_trace()
+            if trace is not None:
+                trace.add_counters(context_tokens_in=tokens_in, context_tokens_out=tokens_out)
+        return compressed_nodes
@@ -1,32 +1,45 @@
-from llama_index.core.postprocessor.rankGPT_rerank import RankGPTRerank
 from llama_index.core.retrievers import BaseRetriever
 from llama_index.core.schema import NodeWithScore
 from llama_index.core import QueryBundle
 
-from llama_index.core import get_response_synthesizer
 from llama_index.core.query_engine import RetrieverQueryEngine
-from llama_index.core.retrievers import VectorIndexRetriever, KeywordTableSimpleRetriever
+from llama_index.core.retrievers import VectorIndexRetriever
 
+import dataclasses
 from typing import List
 from knowledgeBase.collection import CollectionManager
+from knowledgeBase.context_compression import SentenceCompressor, DEFAULT_CONTEXT_TOKEN_BUDGET
+from knowledgeBase.synthesis import create_response_synthesizer, SINGLE_CALL_MODE
+from knowledgeBase.adaptive_retrieval import AdaptiveDepth, log_depth
+from knowledgeBase.reranking import WindowedRankGPTRerank
+from knowledgeBase.shards import search_shards, merge_results, get_worker_pool
+from instrumentation import span
+from embedding_memo import query_embedding_memo
+from trace_callbacks import trace_callback_manager
+
 
 class HybridRetriever(BaseRetriever):
     """
     A retriever that combines vector-based and keyword-based retrieval methods to
-    retrieve relevant nodes based on a given query.
+    retrieve relevant nodes based on a given query. The shards of a sharded collection are searched
+    concurrently, in threads or in the worker processes that own them, and their results are merged.
     Attributes:
         query_engine_name (str): The name of the query engine.
         query_engine_description (str): A description of the query engine.
         model_llm: The language model used for keyword-based retrieval.
         model_embd: The embedding model used for vector-based retrieval.
         _vector_retriever (VectorIndexRetriever): The retriever for vector-based retrieval.
-        _keyword_retriever (KeywordTableSimpleRetriever): The retriever for keyword-based retrieval.
+        _keyword_retriever (BaseRetriever): The retriever for keyword-based retrieval.
+        _chunk_store (ChunkStore): The store of the texts of the retrieved nodes, or None if the indices store them.
+        _shard_names (list of str): The storage names of the shards of a sharded collection, or None.
+        _shard_searchers (list of ShardSearcher): The searchers of the shards searched in this process, or None.
+        _adaptive_depth (AdaptiveDepth): Chooses the number of results of each query from their scores, or None for fixed numbers.
     Methods:
-        __init__(model_llm, model_embd, query_engine_name, query_engine_description, k_semantic=16, k_keyword=6):
+        __init__(model_llm, model_embd, query_engine_name, query_engine_description, k_semantic=16, k_keyword=6, collection_manager=None, adaptive_depth=None):
         _retrieve(query_bundle: QueryBundle) -> List[NodeWithScore]:
     """
     
-    def __init__(self, model_llm, model_embd, query_engine_name, query_engine_description, k_semantic=16, k_keyword=6)-> None:
+    def __init__(self, model_llm, model_embd, query_engine_name, query_engine_description, k_semantic=16, k_keyword=6, collection_manager=None, adaptive_depth=None)-> None:
         """
         Initializes the HybridRetriever with the given models, query engine details, and retrieval parameters.
         """
@@ -34,15 +47,37 @@ class HybridRetriever(BaseRetriever):
         self.query_engine_description = query_engine_description
         self.model_llm = model_llm
         self.model_embd = model_embd
+        self.k_semantic = k_semantic
+        self.k_keyword = k_keyword
+        self._adaptive_depth = adaptive_depth
+        self._collection_manager = collection_manager
+        self._shard_names = None
+        self._shard_searchers = None
+
+        # In adaptive mode, the maximum number of candidates is retrieved and cut after looking at their scores
+        if adaptive_depth is not None:
+            k_semantic = self.k_semantic = adaptive_depth.max_k
         
-        collection_manager = CollectionManager()
+        if collection_manager is None:
+            collection_manager = self._collection_manager = CollectionManager()
 
-        # Load the vector index and keyword index
-        vector_index = collection_manager.load_vector_index_from_file(query_engine_name=query_engine_name, model_embd=model_embd)
-        keyword_index = collection_manager.load_keyword_index_from_file(query_engine_name=query_engine_name, model_llm=model_llm)
+        # The shards of a sharded collection are loaded by the worker processes that search them, or in parallel here
+        if collection_manager.num_shards(query_engine_name) > 1:
+            self._shard_names = collection_manager.shard_storage_names(query_engine_name)
+            if get_worker_pool() is None:
+                self._shard_searchers = collection_manager.load_shard_searchers(query_engine_name)
+            self._chunk_store = None
+            return
 
-        self._vector_retriever = VectorIndexRetriever(index=vector_index, similarity_top_k=k_semantic)
-        self._keyword_retriever = KeywordTableSimpleRetriever(index=keyword_index, num_chunks_per_query=k_keyword)
+        # Load the vector index and keyword index, shared with the other query engines of the process
+        vector_index, keyword_index, self._chunk_store = collection_manager.load_shared_indices(
+                query_engine_name=query_engine_name, 
+                model_llm=model_llm, 
+                model_embd=model_embd
+            )
+
+        self._vector_retriever = VectorIndexRetriever(index=vector_index, similarity_top_k=k_semantic, embed_model=model_embd)
+        self._keyword_retriever = keyword_index.as_retriever(retriever_mode="simple", num_chunks_per_query=k_keyword)
 
     def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
         """
@@ -54,8 +89,35 @@ class HybridRetriever(BaseRetriever):
             List[NodeWithScore]: A list of nodes with scores that match the query,
                                  combining results from both vector and keyword retrieval.
         """
-        vector_nodes = self._vector_retriever.retrieve(query_bundle)
-        keyword_nodes = self._keyword_retriever.retrieve(query_bundle)
+        # The query is embedded once per request, however many collections it is sent to
+        if query_bundle.embedding is None:
+            embedding_strs = query_bundle.embedding_strs
+            embedding = query_embedding_memo.get(
+                model_embd=self.model_embd,
+                texts=embedding_strs,
+                compute=lambda: self.model_embd.get_agg_embedding_from_queries(embedding_strs)
+            )
+            query_bundle = dataclasses.replace(query_bundle, embedding=embedding)
+
+        if self._shard_names is not None:
+            vector_nodes, keyword_nodes = self._search_shards(query_bundle)
+        else:
+            with span("retrieve.vector", collection=self.query_engine_name) as attributes:
+                vector_nodes = self._vector_retriever.retrieve(query_bundle)
+                attributes["num_nodes"] = len(vector_nodes)
+            with span("retrieve.keyword", collection=self.query_engine_name) as attributes:
+                keyword_nodes = self._keyword_retriever.retrieve(query_bundle)
+                attributes["num_nodes"] = len(keyword_nodes)
+
+        # Fewer results are kept for queries with a few clearly dominant chunks
+        if self._adaptive_depth is not None:
+            with span("retrieve.adaptive_k", collection=self.query_engine_name, num_candidates=len(vector_nodes)) as attributes:
+                k = self._adaptive_depth.cutoff([node.score or 0.0 for node in vector_nodes])
+                k_keyword = self._adaptive_depth.keyword_k(k, self.k_keyword)
+                attributes.update(k=k, k_keyword=k_keyword)
+            log_depth(self.query_engine_name, len(vector_nodes), k, k_keyword)
+            vector_nodes = vector_nodes[:k]
+            keyword_nodes = keyword_nodes[:k_keyword]
 
         resulting_nodes = []
         node_ids_added = set()
@@ -71,10 +133,43 @@ class HybridRetriever(BaseRetriever):
                 resulting_nodes.append(keyword_node)
                 node_ids_added.add(keyword_node.node.node_id)
 
+        # Fetch the texts of the nodes from the chunk store of the collection
+        if self._chunk_store is not None:
+            with span("retrieve.fetch_text", collection=self.query_engine_name, num_nodes=len(resulting_nodes)):
+                self._chunk_store.hydrate(resulting_nodes)
+
         return resulting_nodes
 
+    def _search_shards(self, query_bundle):
+        """
+        Searches the shards of the collection concurrently and merges their results.
+        Args:
+            query_bundle (QueryBundle): The query bundle, with the embedding of the query.
+        Returns:
+            tuple: The best `k_semantic` vector search results and `k_keyword` keyword search results of all shards.
+        """
+        with span("retrieve.shards", collection=self.query_engine_name, num_shards=len(self._shard_names)) as attributes:
+            worker_pool = get_worker_pool() if self._shard_searchers is None else None
+            if worker_pool is not None:
+                results = worker_pool.search(
+                    paths=self._collection_manager.storage_paths(),
+                    collection_name=self.query_engine_name,
+                    storage_names=self._shard_names,
+                    query_str=query_bundle.query_str,
+                    embedding=query_bundle.embedding,
+                    k_semantic=self.k_semantic,
+                    k_keyword=self.k_keyword
+                )
+            else:
+                results = search_shards(self._shard_searchers, query_bundle.query_str, query_bundle.embedding, self.k_semantic, self.k_keyword)
+            vector_nodes, keyword_nodes = merge_results(results, self.k_semantic, self.k_keyword)
+            attributes.update(num_vector_nodes=len(vector_nodes), num_keyword_nodes=len(keyword_nodes))
+        return vector_nodes, keyword_nodes
+
 
-def load_hybrid_query_engine(model_llm, model_embd, query_engine_name, query_engine_description, k_semantic=18, k_keyword=6):
+def load_hybrid_query_engine(model_llm, model_embd, query_engine_name, query_engine_description, k_semantic=18, k_keyword=6, collection_manager=None,
+                             context_token_budget=DEFAULT_CONTEXT_TOKEN_BUDGET, synthesis_mode=SINGLE_CALL_MODE, max_prompt_tokens=None,
+                             adaptive_retrieval=None, reranking=None):
     """
     Load a hybrid query engine that combines vector-based and keyword-based retrieval methods.
     Args:
@@ -84,10 +179,35 @@ def load_hybrid_query_engine(model_llm, model_embd, query_engine_name, query_eng
         query_engine_description (str): A description of the query engine.
         k_semantic (int, optional): The number of top results to retrieve using semantic search. Defaults to 18.
         k_keyword (int, optional): The number of top results to retrieve using keyword search. Defaults to 6.
+        collection_manager (CollectionManager, optional): The collection manager used for loading the indices.
+                                                          Defaults to a collection manager with the default paths.
+        context_token_budget (int, optional): The maximum number of tokens of the reranked nodes passed to the response
+                                              synthesizer, which are compressed to the most relevant sentences to fit it.
+                                              0 or None disables the compression. Defaults to 3000.
+        synthesis_mode (str, optional): "single_call" to answer with exactly one LLM call, or a response mode of
+                                        LlamaIndex (e.g. "compact"). Defaults to "single_call".
+        max_prompt_tokens (int, optional): The maximum number of tokens of the prompt in "single_call" mode.
+                                           Defaults to the context window of the LLM.
+        adaptive_retrieval (dict, optional): The 'AdaptiveRetrieval' section of the configuration. If it is enabled, the
+                                             number of vector search results is chosen per query from their scores,
+                                             within the bounds of the collection, and replaces k_semantic; the numbers
+                                             of keyword search results and reranked nodes follow it. Defaults to None.
+        reranking (dict, optional): The 'Reranking' section of the configuration, with the 'window_size', 'passage_tokens',
+                                    'passage_mode' and 'max_parallel' of the reranker. Defaults to the defaults of
+                                    WindowedRankGPTRerank.
     Returns:
         object: An instance of the hybrid query engine.
     """
 
+    # Adaptive depth, whose bounds may be set per collection in the catalog
+    adaptive_depth = None
+    if adaptive_retrieval and adaptive_retrieval.get('enabled', False):
+        if collection_manager is None:
+            collection_manager = CollectionManager()
+        details = collection_manager.get_query_engines_detail_by_name([query_engine_name])
+        adaptive_depth = AdaptiveDepth.from_config(adaptive_retrieval, details[0] if details else None)
+        k_semantic = adaptive_depth.max_k
+
     # Hybrid retriever to combine vector and keyword-based retrieval
     hybrid_retriever = HybridRetriever(
                             model_llm=model_llm,
@@ -95,20 +215,34 @@ def load_hybrid_query_engine(model_llm, model_embd, query_engine_name, query_eng
                             query_engine_name=query_engine_name, 
                             query_engine_description=query_engine_description, 
                             k_semantic=k_semantic, 
-                            k_keyword=k_keyword
+                            k_keyword=k_keyword,
+                            collection_manager=collection_manager,
+                            adaptive_depth=adaptive_depth
                         )
     
     # Reranker to sort retrieved results according to relevance to query by using the language model
     k_total = k_semantic + k_keyword
     num_keep_nodes = max(1, k_total//2)
-    rankGPT  = RankGPTRerank(top_n=num_keep_nodes, llm=model_llm, verbose=True)
+    # Shortened passages are ranked in parallel windows, and reranking is skipped when there are at most num_keep_nodes nodes
+    rankGPT  = WindowedRankGPTRerank(top_n=num_keep_nodes, llm=model_llm, verbose=True, adaptive_top_n=adaptive_depth is not None, **(reranking or {}))
+    node_postprocessors = [rankGPT]
+
+    # Compression of the reranked nodes, so that the size of the context does not grow with k
+    if context_token_budget:
+        node_postprocessors.append(SentenceCompressor(token_budget=context_token_budget))
     
-    response_synthesizer = get_response_synthesizer(llm=model_llm)
+    response_synthesizer = create_response_synthesizer(
+        llm=model_llm,
+        synthesis_mode=synthesis_mode,
+        max_prompt_tokens=max_prompt_tokens,
+        callback_manager=trace_callback_manager
+    )
     
     hybrid_query_engine = RetrieverQueryEngine(
         retriever=hybrid_retriever,
         response_synthesizer=response_synthesizer,
-        node_postprocessors=[rankGPT]
+        node_postprocessors=node_postprocessors,
+        callback_manager=trace_callback_manager
     )
 
     return hybrid_query_engine
\ No newline at end of file
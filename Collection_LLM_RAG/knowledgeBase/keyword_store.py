@@ -0,0 +1,211 @@
+import os
+import json
+import sqlite3
+import threading
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.indices.keyword_table.utils import simple_extract_keywords
+from llama_index.core.schema import NodeWithScore
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
+from llama_index.core.utils import globals_helper
+
+from trace_callbacks import trace_callback_manager
+
+
+class KeywordStore:
+    """
+    A keyword index persisted in a SQLite file, as an alternative to the JSON files of a persisted
+    SimpleKeywordTableIndex. Opening it does not read anything: the postings of the keywords of a
+    query and the nodes they point to are fetched when the query is retrieved.
+    Attributes:
+        path (str): The path of the SQLite file.
+        read_only (bool): Whether the store is opened only for reading.
+    Methods:
+        write(table, nodes):
+        delete_nodes(node_ids):
+        match(keywords, limit, with_counts=False):
+        get_nodes(node_ids):
+        search(query_str, limit, max_keywords=10):
+        as_retriever(retriever_mode="simple", num_chunks_per_query=10, max_keywords_per_query=10, **kwargs):
+    """
+
+    # Maximum number of parameters per SQL statement
+    batch_size = 500
+
+    # Read-only connections map the file into memory, so that the processes serving the same
+    # collection share its pages through the page cache instead of each reading them
+    mmap_size = 1 << 30
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self._local = threading.local()
+
+        if read_only:
+            # The stopwords of the keyword extraction are loaded lazily by NLTK, which fails when the first
+            # queries of a process load them at the same time, so they are loaded before the store is searched
+            globals_helper.stopwords
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with self._connection() as connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS postings (keyword TEXT NOT NULL, node_id TEXT NOT NULL, PRIMARY KEY (keyword, node_id)) WITHOUT ROWID")
+                connection.execute("CREATE TABLE IF NOT EXISTS nodes (node_id TEXT PRIMARY KEY, node TEXT NOT NULL)")
+
+    def _connection(self):
+        """
+        Returns the connection of the current thread, since SQLite connections cannot be shared between threads.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if self.read_only:
+                connection = sqlite3.connect('file:{}?mode=ro'.format(self.path), uri=True)
+                connection.execute('PRAGMA mmap_size={}'.format(self.mmap_size))
+            else:
+                connection = sqlite3.connect(self.path)
+            self._local.connection = connection
+        return connection
+
+    @classmethod
+    def from_index(cls, path, keyword_index):
+        """
+        Writes a keyword index built in memory (or loaded from its JSON files) to a new store.
+        Args:
+            path (str): The path of the SQLite file. An existing file is replaced.
+            keyword_index (SimpleKeywordTableIndex): The keyword index.
+        Returns:
+            KeywordStore: The store, opened for writing.
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        store = cls(path)
+        table = keyword_index.index_struct.table
+        node_ids = {node_id for node_ids in table.values() for node_id in node_ids}
+        store.write(table, keyword_index.docstore.get_nodes(list(node_ids)))
+        return store
+
+    def write(self, table, nodes):
+        """
+        Adds keywords and the nodes they point to.
+        Args:
+            table (dict): A dictionary that maps each keyword to the set of ids of the nodes that contain it.
+            nodes (list of BaseNode): The nodes referenced by the table.
+        """
+        postings = ((keyword, node_id) for keyword, node_ids in table.items() for node_id in node_ids)
+        with self._connection() as connection:
+            connection.executemany("INSERT OR IGNORE INTO postings (keyword, node_id) VALUES (?, ?)", postings)
+            connection.executemany(
+                "INSERT OR REPLACE INTO nodes (node_id, node) VALUES (?, ?)",
+                ((node.node_id, json.dumps(doc_to_json(node))) for node in nodes)
+            )
+
+    def delete_nodes(self, node_ids):
+        """
+        Deletes nodes and their keywords.
+        Args:
+            node_ids (list of str): The ids of the nodes.
+        """
+        node_ids = list(node_ids)
+        with self._connection() as connection:
+            for start in range(0, len(node_ids), self.batch_size):
+                batch = node_ids[start:start + self.batch_size]
+                placeholders = ','.join('?' * len(batch))
+                connection.execute("DELETE FROM postings WHERE node_id IN ({})".format(placeholders), batch)
+                connection.execute("DELETE FROM nodes WHERE node_id IN ({})".format(placeholders), batch)
+
+    def match(self, keywords, limit, with_counts=False):
+        """
+        Returns the nodes that contain the most keywords.
+        Args:
+            keywords (list of str): The keywords.
+            limit (int): The maximum number of node ids.
+            with_counts (bool): Whether the number of keywords contained by each node is returned too.
+        Returns:
+            list: The ids of the nodes (str), or (node id, number of keywords) pairs if `with_counts` is true,
+                  sorted by decreasing number of keywords the nodes contain.
+        """
+        keywords = list(keywords)[:self.batch_size]
+        if not keywords or limit <= 0:
+            return []
+        rows = self._connection().execute(
+            "SELECT node_id, COUNT(*) FROM postings WHERE keyword IN ({}) GROUP BY node_id "
+            "ORDER BY COUNT(*) DESC, node_id LIMIT ?".format(','.join('?' * len(keywords))),
+            keywords + [limit]
+        )
+        if with_counts:
+            return list(rows)
+        return [node_id for node_id, _ in rows]
+
+    def get_nodes(self, node_ids):
+        """
+        Fetches nodes.
+        Args:
+            node_ids (list of str): The ids of the nodes.
+        Returns:
+            list of BaseNode: The found nodes, in the order of `node_ids`.
+        """
+        node_ids = list(node_ids)
+        nodes = {}
+        connection = self._connection()
+        for start in range(0, len(node_ids), self.batch_size):
+            batch = node_ids[start:start + self.batch_size]
+            rows = connection.execute(
+                "SELECT node_id, node FROM nodes WHERE node_id IN ({})".format(','.join('?' * len(batch))),
+                batch
+            )
+            nodes.update((node_id, json_to_doc(json.loads(node))) for node_id, node in rows)
+        return [nodes[node_id] for node_id in node_ids if node_id in nodes]
+
+    def search(self, query_str, limit, max_keywords=10):
+        """
+        Extracts the keywords of a query like KeywordTableSimpleRetriever and returns the nodes that contain the most of them.
+        Args:
+            query_str (str): The query.
+            limit (int): The maximum number of nodes.
+            max_keywords (int): The maximum number of keywords extracted from the query.
+        Returns:
+            list of tuple: (node, number of keywords of the query it contains) pairs, sorted by decreasing number of keywords.
+        """
+        keywords = simple_extract_keywords(query_str, max_keywords=max_keywords)
+        counts = dict(self.match(sorted(keywords), limit=limit, with_counts=True))
+        return [(node, counts[node.node_id]) for node in self.get_nodes(list(counts))]
+
+    def as_retriever(self, retriever_mode="simple", num_chunks_per_query=10, max_keywords_per_query=10, **kwargs):
+        """
+        Returns a retriever that extracts the keywords of queries like KeywordTableSimpleRetriever.
+        Args:
+            retriever_mode (str): Only "simple" is supported, as with the SimpleKeywordTableIndex it replaces.
+            num_chunks_per_query (int): Maximum number of retrieved nodes.
+            max_keywords_per_query (int): Maximum number of keywords extracted from a query.
+        Returns:
+            KeywordStoreRetriever: The retriever.
+        Raises:
+            ValueError: If the retriever mode is not "simple".
+        """
+        if retriever_mode != "simple":
+            raise ValueError('Keyword stores only support the "simple" retriever mode.')
+        return KeywordStoreRetriever(
+            keyword_store=self,
+            num_chunks_per_query=num_chunks_per_query,
+            max_keywords_per_query=max_keywords_per_query,
+            **kwargs
+        )
+
+
+class KeywordStoreRetriever(BaseRetriever):
+    """
+    Retrieves the nodes of a KeywordStore that contain the most keywords of the query.
+    Attributes:
+        keyword_store (KeywordStore): The store.
+        num_chunks_per_query (int): Maximum number of retrieved nodes.
+        max_keywords_per_query (int): Maximum number of keywords extracted from a query.
+    """
+
+    def __init__(self, keyword_store, num_chunks_per_query=10, max_keywords_per_query=10, callback_manager=None, **kwargs):
+        self.keyword_store = keyword_store
+        self.num_chunks_per_query = num_chunks_per_query
+        self.max_keywords_per_query = max_keywords_per_query
+        super().__init__(callback_manager=callback_manager or trace_callback_manager, **kwargs)
+
+    def _retrieve(self, query_bundle):
+        matches = self.keyword_store.search(query_bundle.query_str, limit=self.num_chunks_per_query, max_keywords=self.max_keywords_per_query)
+        return [NodeWithScore(node=node) for node, _ in matches]
@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from knowledgeBase.text_extraction_webpages import scrape_articles, scrape_pdfs
+
+
+class RefreshScheduler:
+    """
+    Crawls the sources of collections again on a schedule and updates the collections with the pages that
+    changed (see `CollectionManager.refresh_collection`). A collection is due when its pages were last
+    crawled more than its refresh interval ago; the interval is the 'refresh_interval_hours' of the
+    collection in the list of query engines, or the interval of the scheduler. Collections without a
+    saved source (e.g. created before sources were saved), collections being embedded again with
+    another model and collections whose build lock is held (see `CollectionManager.build_lock`) are not refreshed. Collections are refreshed one at a time in a background thread,
+    and queries keep being served from their previous version.
+    Attributes:
+        collection_manager (CollectionManager): The manager of the collections.
+        models_factory (callable): Returns the user models (with the embedding model and the LLM) for the details of a collection.
+        interval_hours (float): The default time between two crawls of a collection.
+        check_seconds (float): The time between two checks for due collections.
+        on_refresh (callable): Called with the name of each collection that was switched to a new version.
+    Methods:
+        due_collections(now=None):
+        crawl(details):
+        refresh(collection_name, force=False):
+        run_once(collections=None, force=False):
+        run():
+        start():
+        stop():
+    """
+
+    def __init__(self, collection_manager, models_factory, interval_hours=24, check_seconds=600, on_refresh=None):
+        self.collection_manager = collection_manager
+        self.models_factory = models_factory
+        self.interval_hours = interval_hours
+        self.check_seconds = check_seconds
+        self.on_refresh = on_refresh
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def due_collections(self, now=None):
+        """
+        Returns the collections whose pages should be crawled again.
+        Args:
+            now (float, optional): The current time in seconds since the epoch. Defaults to now.
+        Returns:
+            list of str: The names of the due collections with a saved source that are not being updated.
+        """
+        now = time.time() if now is None else now
+        due = []
+        for details in self.collection_manager.get_query_engines_detail():
+            if 'source' not in details or os.path.exists(self.collection_manager.reembed_checkpoint_path(details['name'])):
+                continue
+            if self.collection_manager.is_build_locked(details['name']):
+                continue
+            indexed = self.collection_manager.load_page_hashes(details['name'], details.get('storage_version', 0))
+            interval_hours = details.get('refresh_interval_hours', self.interval_hours)
+            if indexed is None or now - indexed['crawled'] >= interval_hours * 3600:
+                due.append(details['name'])
+        return due
+
+    def crawl(self, details):
+        """
+        Scrapes the pages of the source of a collection.
+        Args:
+            details (dict): The details of the collection, with its 'source'.
+        Returns:
+            tuple: The scraped data, and the links of all pages listed in the input JSON file.
+        Raises:
+            ValueError: If the type of the source is incorrect.
+            FileNotFoundError: If the input JSON file is not found.
+        """
+        source = details['source']
+        with open(source['path'], 'r', encoding='utf-8') as file:
+            listed_links = [entity.get('Link', '') for entity in json.load(file)['data']]
+
+        # The scraped data replaces the one saved when the collection was created
+        output_file = os.path.join(self.collection_manager.scraped_data_path, os.path.basename(source['path']))
+        os.makedirs(self.collection_manager.scraped_data_path, exist_ok=True)
+        if source['type'] == 'Webpages':
+            scrape_articles(json_file=source['path'], output_file=output_file)
+        elif source['type'] == 'PDFs':
+            scrape_pdfs(json_file=source['path'], output_file=output_file)
+        else:
+            raise ValueError('Selected Type of JSON file is incorrect.')
+
+        with open(output_file, 'r', encoding='utf-8') as file:
+            return json.load(file), listed_links
+
+    def refresh(self, collection_name, force=False):
+        """
+        Crawls the source of a collection and updates the collection with the pages that changed.
+        Args:
+            collection_name (str): The name of the collection.
+            force (bool, optional): Whether the collection is refreshed even if it is not due. Defaults to False.
+        Returns:
+            dict: The summary of the refresh (see `CollectionManager.refresh_collection`), or None if the
+                  collection was not refreshed.
+        """
+        details = self.collection_manager.get_query_engines_detail_by_name([collection_name])
+        if not details or 'source' not in details[0]:
+            logging.info('>    {} has no saved source and cannot be refreshed.'.format(collection_name))
+            return None
+        details = details[0]
+        if not force and collection_name not in self.due_collections():
+            return None
+
+        data, listed_links = self.crawl(details)
+        if listed_links and not data['data']:
+            # Nothing could be fetched, e.g. because the network is down, which must not empty the collection
+            logging.warning('>    No page of {} could be crawled, the collection is kept as it is.'.format(collection_name))
+            return None
+
+        summary = self.collection_manager.refresh_collection(
+            user_models=self.models_factory(details),
+            collection_name=collection_name,
+            data=data,
+            listed_links=listed_links
+        )
+        if summary['storage_version'] != details.get('storage_version', 0) and self.on_refresh is not None:
+            self.on_refresh(collection_name)
+        return summary
+
+    def run_once(self, collections=None, force=False):
+        """
+        Refreshes the due collections, one at a time. A failed refresh is logged and does not stop the others.
+        Args:
+            collections (list of str, optional): The names of the collections. Defaults to all due collections.
+            force (bool, optional): Whether the collections are refreshed even if they are not due. Defaults to False.
+        Returns:
+            dict: The summary of the refresh of each refreshed collection, keyed by name.
+        """
+        names = collections if collections is not None else self.due_collections()
+        summaries = {}
+        for name in names:
+            if self._stop_event.is_set():
+                break
+            try:
+                summary = self.refresh(name, force=force or collections is None)
+            except Exception as e:
+                logging.error('>    Refreshing {} failed: {}'.format(name, e))
+                continue
+            if summary is not None:
+                summaries[name] = summary
+        return summaries
+
+    def run(self):
+        """
+        Refreshes the due collections whenever they are due, until the scheduler is stopped.
+        """
+        while not self._stop_event.is_set():
+            self.run_once()
+            self._stop_event.wait(self.check_seconds)
+
+    def start(self):
+        """
+        Starts refreshing the due collections in a background thread.
+        """
+        if self._thread is None:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self.run, name='collection-refresh', daemon=True)
+            self._thread.start()
+            logging.info('>    Collections are crawled again every {} hours.'.format(self.interval_hours))
+
+    def stop(self):
+        """
+        Stops the background thread once the collection being refreshed, if any, is done.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,237 @@
+import math
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.postprocessor.rankGPT_rerank import RankGPTRerank
+from llama_index.core.schema import NodeWithScore
+from llama_index.core.utils import print_text
+
+from knowledgeBase.context_compression import split_sentences, bm25_scores
+from knowledgeBase.synthesis import model_tokenizer
+from instrumentation import span, current_trace
+
+# Worker threads for ranking the windows of the candidates. Reranking runs in the threads of the
+# sub-question pool too, so the windows get a pool of their own.
+_rerank_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='rerank')
+
+# Default size of the windows and of the passages sent to the LLM
+DEFAULT_WINDOW_SIZE = 8
+DEFAULT_PASSAGE_TOKENS = 200
+
+
+class WindowedRankGPTRerank(RankGPTRerank):
+    """
+    A RankGPT reranker that sends shortened passages in small windows, ranked concurrently, instead
+    of all candidates in full in one prompt. Each passage is cut to its first `passage_tokens` tokens
+    ("prefix"), or to its sentences most relevant to the query ("sentences", scored locally with BM25
+    and kept in their original order). The candidates are split, in retrieval order, into windows of
+    `window_size` passages, and every window is ranked by one LLM call. The winners of the windows are
+    ranked again by a final LLM call: every window contributes half as many nodes again as its equal
+    share of the `top_n` nodes, so that a window holding many of the most relevant candidates can place
+    more of them than the others. The winners are sent in window order (the first node of every window,
+    then the second ones, and so on), so the result does not depend on which call returns first. A
+    window whose response cannot be parsed keeps its retrieval order, and if the final response cannot
+    be parsed, the winners are kept in window order. If there are at most `top_n` candidates, nothing is reranked.
+    With `adaptive_top_n`, half of the received nodes are kept (at most `top_n`). Reranking is
+    recorded as a traced stage.
+    Attributes:
+        window_size (int): The maximum number of passages ranked by one LLM call.
+        passage_tokens (int): The maximum number of tokens of a passage.
+        passage_mode (str): How passages are shortened: "prefix" or "sentences".
+        max_parallel (int): The maximum number of windows ranked at the same time.
+        adaptive_top_n (bool): Whether half of the received nodes are kept instead of `top_n`.
+    """
+    window_size: int = Field(default=DEFAULT_WINDOW_SIZE, description="Maximum number of passages per LLM call.")
+    passage_tokens: int = Field(default=DEFAULT_PASSAGE_TOKENS, description="Maximum number of tokens of a passage.")
+    passage_mode: str = Field(default="prefix", description="How passages are shortened: 'prefix' or 'sentences'.")
+    max_parallel: int = Field(default=4, description="Maximum number of windows ranked at the same time.")
+    adaptive_top_n: bool = Field(default=False, description="Whether half of the received nodes are kept instead of top_n.")
+    _tokenizer = PrivateAttr(default=None)
+
+    def __init__(self, window_size=DEFAULT_WINDOW_SIZE, passage_tokens=DEFAULT_PASSAGE_TOKENS, passage_mode="prefix",
+                 max_parallel=4, adaptive_top_n=False, **kwargs):
+        if passage_mode not in ("prefix", "sentences"):
+            raise ValueError('Unknown passage mode {}, expected "prefix" or "sentences".'.format(passage_mode))
+        super().__init__(**kwargs)
+        self.window_size = max(2, window_size)
+        self.passage_tokens = passage_tokens
+        self.passage_mode = passage_mode
+        self.max_parallel = max(1, max_parallel)
+        self.adaptive_top_n = adaptive_top_n
+        # Looking up the tokenizer of OpenAI models loads the encoding again, so it is looked up once
+        self._tokenizer = model_tokenizer(self.llm)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "WindowedRankGPTRerank"
+
+    def _top_n(self, num_nodes):
+        """
+        Returns the number of nodes to keep out of `num_nodes`.
+        """
+        return min(self.top_n, max(1, num_nodes//2)) if self.adaptive_top_n else self.top_n
+
+    def _shorten(self, text, query_str):
+        """
+        Shortens a passage to `passage_tokens` tokens.
+        """
+        tokenizer = self._tokenizer
+        if len(tokenizer(text)) <= self.passage_tokens:
+            return text
+
+        if self.passage_mode == "sentences":
+            sentences = split_sentences(text)
+            scores = bm25_scores(query_str, sentences)
+            selected = set()
+            num_tokens = 0
+            for idx in sorted(range(len(sentences)), key=lambda idx: scores[idx], reverse=True):
+                sentence_tokens = len(tokenizer(sentences[idx]))
+                if num_tokens + sentence_tokens <= self.passage_tokens:
+                    selected.add(idx)
+                    num_tokens += sentence_tokens
+            if selected:
+                return ' '.join(sentences[idx] for idx in sorted(selected))
+
+        # Keep as many words of the beginning of the passage as fit
+        words = text.split(' ')
+        low, high = 0, len(words)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if len(tokenizer(' '.join(words[:middle]))) <= self.passage_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return ' '.join(words[:low])
+
+    def _windows(self, nodes, query_str):
+        """
+        Splits the candidates into windows and returns the nodes, the shortened passages and the permutation
+        instruction of each window.
+        """
+        num_windows = math.ceil(len(nodes) / self.window_size)
+        # Windows of (almost) equal size, so that no window only holds a few leftover candidates
+        size = math.ceil(len(nodes) / num_windows)
+        windows = []
+        for start in range(0, len(nodes), size):
+            window = nodes[start:start + size]
+            items = {
+                "query": query_str,
+                "hits": [{"content": self._shorten(node.node.get_content(), query_str)} for node in window]
+            }
+            windows.append((window, items, self.create_permutation_instruction(item=items)))
+        return windows
+
+    def _window_ranking(self, window, items, response):
+        """
+        Returns the nodes of a window in the order of the LLM response, or in retrieval order if it has no content.
+        """
+        if response is None or response.message is None or response.message.content is None:
+            return list(window)
+        ranks = self._receive_permutation(items, str(response.message.content))
+        if self.verbose:
+            print_text("After Reranking, new rank list for nodes: {}\n".format(ranks))
+        return [window[idx] for idx in ranks]
+
+    @staticmethod
+    def _interleave(rankings):
+        """
+        Merges the rankings of the windows round-robin: the first node of every window, in window order, then the second ones, and so on.
+        """
+        merged = []
+        for position in range(max(len(ranking) for ranking in rankings)):
+            for ranking in rankings:
+                if position < len(ranking):
+                    merged.append(NodeWithScore(node=ranking[position].node, score=ranking[position].score))
+        return merged
+
+    def _final_pass(self, windows, rankings, top_n, query_str):
+        """
+        Returns the winners of the windows and the items of their final ranking, or None for the items if
+        the winners do not need to be ranked again (a single window, or at most `top_n` winners).
+        """
+        share = math.ceil(top_n / len(rankings))
+        winners = self._interleave([ranking[:share + math.ceil(share / 2)] for ranking in rankings])
+        if len(rankings) == 1 or len(winners) <= top_n:
+            return winners, None
+
+        # The passages were shortened for the windows already
+        passages = {}
+        for window, items, _ in windows:
+            for node, hit in zip(window, items["hits"]):
+                passages[node.node.node_id] = hit["content"]
+        items = {
+            "query": query_str,
+            "hits": [{"content": passages[node.node.node_id]} for node in winners]
+        }
+        return winners, items
+
+    def _postprocess_nodes(self, nodes, query_bundle=None):
+        if query_bundle is None:
+            raise ValueError("Query bundle must be provided.")
+        top_n = self._top_n(len(nodes))
+        if len(nodes) <= top_n:
+            return nodes
+
+        with span("rerank", num_nodes=len(nodes), top_n=top_n) as attributes:
+            windows = self._windows(nodes, query_bundle.query_str)
+            attributes["num_windows"] = len(windows)
+            if len(windows) == 1:
+                responses = [self.run_llm(messages=windows[0][2])]
+            else:
+                semaphore = threading.BoundedSemaphore(self.max_parallel)
+
+                def rank(messages):
+                    with semaphore:
+                        return self.run_llm(messages=messages)
+
+                # Every window is ranked in the context of the caller, so its LLM call is traced with the query
+                futures = [_rerank_executor.submit(contextvars.copy_context().run, rank, messages) for _, _, messages in windows]
+                responses = [future.result() for future in futures]
+            rankings = [self._window_ranking(window, items, response) for (window, items, _), response in zip(windows, responses)]
+
+            winners, items = self._final_pass(windows, rankings, top_n, query_bundle.query_str)
+            attributes["num_winners"] = len(winners)
+            if items is not None:
+                response = self.run_llm(messages=self.create_permutation_instruction(item=items))
+                winners = self._window_ranking(winners, items, response)
+            self._record_windows(len(windows) + (items is not None))
+            return winners[:top_n]
+
+    async def _apostprocess_nodes(self, nodes, query_bundle=None):
+        if query_bundle is None:
+            raise ValueError("Query bundle must be provided.")
+        top_n = self._top_n(len(nodes))
+        if len(nodes) <= top_n:
+            return nodes
+
+        with span("rerank", num_nodes=len(nodes), top_n=top_n) as attributes:
+            windows = self._windows(nodes, query_bundle.query_str)
+            attributes["num_windows"] = len(windows)
+            semaphore = asyncio.Semaphore(self.max_parallel)
+
+            async def rank(messages):
+                async with semaphore:
+                    return await self.arun_llm(messages=messages)
+
+            responses = await asyncio.gather(*(rank(messages) for _, _, messages in windows))
+            rankings = [self._window_ranking(window, items, response) for (window, items, _), response in zip(windows, responses)]
+
+            winners, items = self._final_pass(windows, rankings, top_n, query_bundle.query_str)
+            attributes["num_winners"] = len(winners)
+            if items is not None:
+                response = await self.arun_llm(messages=self.create_permutation_instruction(item=items))
+                winners = self._window_ranking(winners, items, response)
+            self._record_windows(len(windows) + (items is not None))
+            return winners[:top_n]
+
+    @staticmethod
+    def _record_windows(num_windows):
+        """
+        Counts the LLM calls of the reranking (the windows and the final pass) in the trace of the current query.
+        """
+        trace = current_trace()
+        if trace is not None:
+            trace.add_counters(rerank_windows=num_windows)
@@ -0,0 +1,255 @@
+import hashlib
+import logging
+import threading
+import contextvars
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from instrumentation import span
+
+# This module only depends on the standard library at import time, so sharding can be configured at
+# startup without importing LlamaIndex.
+#
+# A sharded collection is split into `num_shards` shards by hashing the link of every document. Each
+# shard has its own Chroma directory, keyword store and chunk store, named '<collection>.shard-<i>'
+# (see `CollectionManager.shard_storage_names`), so shards are built in parallel and loaded and
+# searched independently of each other. Shards are searched in threads of the process, or in worker
+# processes that each own a fixed subset of the shards.
+
+# Settings of the 'Sharding' section of the configuration file
+_sharding = {"num_shards": 1, "build_workers": 4, "search_processes": 0}
+
+# Threads that search the shards of a query, and the worker processes that own shards
+_search_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='shard')
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+
+def configure_sharding(config):
+    """
+    Sets up sharding from the 'Sharding' section of the configuration file.
+    Args:
+        config (dict): The configuration, with 'num_shards' (shards of new collections), 'build_workers'
+                       (shards built at the same time) and 'search_processes' (worker processes that search
+                       the shards, 0 to search them in threads of this process).
+    """
+    _sharding.update(config)
+    logging.info('>    New collections have {} shard(s), searched in {}.'.format(
+        _sharding['num_shards'],
+        '{} worker processes'.format(_sharding['search_processes']) if _sharding['search_processes'] else 'threads'))
+
+def sharding_settings():
+    """
+    Returns the sharding settings of the process.
+    Returns:
+        dict: The 'num_shards', 'build_workers' and 'search_processes' settings.
+    """
+    return dict(_sharding)
+
+def shard_of(key, num_shards):
+    """
+    Returns the shard of a document. The shard only depends on the key, so a document always lands
+    in the same shard when a collection is built again.
+    Args:
+        key (str): The key of the document, e.g. its link.
+        num_shards (int): The number of shards.
+    Returns:
+        int: The index of the shard.
+    """
+    digest = hashlib.sha1(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % num_shards
+
+def partition_documents(documents, num_shards):
+    """
+    Hash-partitions documents into shards by their link.
+    Args:
+        documents (list of Document): The documents, with a 'Link' metadata.
+        num_shards (int): The number of shards.
+    Returns:
+        list of list of Document: The documents of each shard.
+    """
+    partitions = [[] for _ in range(num_shards)]
+    for document in documents:
+        key = document.metadata.get('Link') or document.get_content()
+        partitions[shard_of(key, num_shards)].append(document)
+    return partitions
+
+def run_parallel(function, arguments, max_workers):
+    """
+    Calls a function on each argument in threads, in the context of the caller (so the spans of the
+    calls are added to the current trace).
+    Args:
+        function (callable): The function.
+        arguments (list): The arguments, one per call.
+        max_workers (int): The maximum number of calls at the same time.
+    Returns:
+        list: The results, in the order of the arguments.
+    """
+    if len(arguments) == 1:
+        return [function(arguments[0])]
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(arguments)))) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, function, argument) for argument in arguments]
+        return [future.result() for future in futures]
+
+
+def merge_results(results, k_semantic, k_keyword):
+    """
+    Merges the search results of the shards of a collection. Every shard returns its own top k, so the
+    merged results are the top k of the whole collection.
+    Args:
+        results (list of tuple): The vector search results and the (keyword search result, number of
+                                 matched keywords) pairs of each shard.
+        k_semantic (int): The number of vector search results to keep.
+        k_keyword (int): The number of keyword search results to keep.
+    Returns:
+        tuple: The best vector search results by similarity and the best keyword search results by
+               number of matched keywords. Ties are broken by shard, then by rank within the shard.
+    """
+    vector_nodes = [node for vector_nodes, _ in results for node in vector_nodes]
+    keyword_matches = [match for _, keyword_matches in results for match in keyword_matches]
+    vector_nodes = sorted(vector_nodes, key=lambda node: -(node.score or 0.0))[:k_semantic]
+    keyword_matches = sorted(keyword_matches, key=lambda match: -match[1])[:k_keyword]
+    return vector_nodes, [node for node, _ in keyword_matches]
+
+
+class ShardSearcher:
+    """
+    Searches one shard of a collection. The texts of the found nodes are fetched from the chunk store
+    of the shard, so the results can be sent to another process.
+    Attributes:
+        storage_name (str): The name of the storage of the shard, e.g. 'Papers.shard-03'.
+    Methods:
+        search(query_str, embedding, k_semantic, k_keyword):
+    """
+
+    def __init__(self, storage_name, vector_index, keyword_index, chunk_store):
+        from llama_index.core.embeddings import MockEmbedding
+
+        self.storage_name = storage_name
+        self._vector_index = vector_index
+        self._keyword_index = keyword_index
+        self._chunk_store = chunk_store
+        # Queries are embedded before they are sent to the shards
+        self._embed_model = MockEmbedding(embed_dim=1)
+
+    def search(self, query_str, embedding, k_semantic, k_keyword):
+        """
+        Searches the shard.
+        Args:
+            query_str (str): The query.
+            embedding (list of float): The embedding of the query.
+            k_semantic (int): The number of vector search results.
+            k_keyword (int): The number of keyword search results.
+        Returns:
+            tuple: The vector search results (list of NodeWithScore) and the keyword search results as
+                   (NodeWithScore, number of matched keywords) pairs.
+        """
+        from llama_index.core import QueryBundle
+        from llama_index.core.retrievers import VectorIndexRetriever
+        from llama_index.core.schema import NodeWithScore
+
+        with span("retrieve.shard", shard=self.storage_name):
+            query_bundle = QueryBundle(query_str=query_str, embedding=embedding)
+            vector_nodes = VectorIndexRetriever(index=self._vector_index, similarity_top_k=k_semantic, embed_model=self._embed_model).retrieve(query_bundle)
+            # The number of matched keywords orders the keyword search results of different shards
+            keyword_matches = [(NodeWithScore(node=node), count) for node, count in self._keyword_index.search(query_str, limit=k_keyword)]
+            if self._chunk_store is not None:
+                self._chunk_store.hydrate(vector_nodes + [node for node, _ in keyword_matches])
+        return vector_nodes, keyword_matches
+
+
+# Searchers of the shards owned by this worker process, keyed by the storage paths and the storage name
+_process_searchers = {}
+
+def _search_in_worker(paths, collection_name, storage_name, query_str, embedding, k_semantic, k_keyword):
+    """
+    Searches a shard in a worker process, loading it the first time.
+    """
+    from knowledgeBase.collection import CollectionManager
+
+    key = (paths, storage_name)
+    searcher = _process_searchers.get(key)
+    if searcher is None:
+        collection_manager = CollectionManager(**dict(paths))
+        searcher = collection_manager.load_shard_searchers(collection_name, storage_names=[storage_name])[0]
+        _process_searchers[key] = searcher
+    return searcher.search(query_str, embedding, k_semantic, k_keyword)
+
+
+class ShardWorkerPool:
+    """
+    Worker processes that search shards. Every shard is always searched by the same process, the one
+    at the index of the shard modulo the number of processes, so each shard is loaded by only one process.
+    Attributes:
+        num_processes (int): The number of worker processes.
+    Methods:
+        search(paths, collection_name, storage_names, query_str, embedding, k_semantic, k_keyword):
+        shutdown():
+    """
+
+    def __init__(self, num_processes):
+        self.num_processes = num_processes
+        # Worker processes are spawned, since forking a process with running threads is unsafe
+        context = multiprocessing.get_context('spawn')
+        self._executors = [ProcessPoolExecutor(max_workers=1, mp_context=context) for _ in range(num_processes)]
+
+    def search(self, paths, collection_name, storage_names, query_str, embedding, k_semantic, k_keyword):
+        """
+        Searches shards in their worker processes.
+        Args:
+            paths (tuple): The storage paths of the collection manager, as (argument, path) pairs.
+            collection_name (str): The name of the collection.
+            storage_names (list of str): The storage names of the shards.
+            query_str (str): The query.
+            embedding (list of float): The embedding of the query.
+            k_semantic (int): The number of vector search results per shard.
+            k_keyword (int): The number of keyword search results per shard.
+        Returns:
+            list of tuple: The vector and keyword search results of each shard.
+        """
+        futures = [
+            self._executors[shard % self.num_processes].submit(
+                _search_in_worker, paths, collection_name, storage_name, query_str, embedding, k_semantic, k_keyword)
+            for shard, storage_name in enumerate(storage_names)
+        ]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        """
+        Stops the worker processes.
+        """
+        for executor in self._executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+def get_worker_pool():
+    """
+    Returns the worker processes of this process, starting them the first time.
+    Returns:
+        ShardWorkerPool: The worker processes, or None if shards are searched in threads.
+    """
+    global _worker_pool
+    if not _sharding['search_processes']:
+        return None
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = ShardWorkerPool(_sharding['search_processes'])
+        return _worker_pool
+
+
+def search_shards(searchers, query_str, embedding, k_semantic, k_keyword):
+    """
+    Searches the shards of a collection concurrently in threads of this process.
+    Args:
+        searchers (list of ShardSearcher): The searchers of the shards.
+        query_str (str): The query.
+        embedding (list of float): The embedding of the query.
+        k_semantic (int): The number of vector search results per shard.
+        k_keyword (int): The number of keyword search results per shard.
+    Returns:
+        list of tuple: The vector and keyword search results of each shard.
+    """
+    if len(searchers) == 1:
+        return [searchers[0].search(query_str, embedding, k_semantic, k_keyword)]
+    futures = [_search_executor.submit(contextvars.copy_context().run, searcher.search, query_str, embedding, k_semantic, k_keyword)
+               for searcher in searchers]
+    return [future.result() for future in futures]
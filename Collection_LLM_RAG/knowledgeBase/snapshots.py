@@ -0,0 +1,340 @@
+import io
+import os
+import gzip
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import tarfile
+
+from utils import format_collection_name
+
+# A snapshot is a gzipped tar archive of everything a collection needs to be queried: its entry in
+# the list of query engines, the Chroma directories with the vectors, the keyword indices and the
+# chunk stores of its shards. The first member is 'manifest.json', with the format version, the
+# catalog entry, the embedding model and the size and SHA-256 digest of every other member, so an
+# archive can be verified and extracted in a single pass while it is being downloaded.
+
+SNAPSHOT_FORMAT_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+
+# Size of the blocks copied while files are hashed and extracted
+_block_size = 1 << 20
+
+
+def _storage_roots(collection_manager):
+    """
+    Returns the directory of each kind of stored files, keyed by their top-level directory in snapshots.
+    """
+    return {
+        'collections': collection_manager.vector_index_save_path,
+        'keyword-index': collection_manager.keyword_index_save_path,
+        'chunk-store': collection_manager.chunk_store_save_path
+    }
+
+def _collection_entries(collection_manager, details):
+    """
+    Returns the files and directories of a collection, as (top-level directory in the snapshot, name) pairs.
+    """
+    storage_version = details.get('storage_version', 0)
+    storage_names = collection_manager.shard_storage_names(details['name'], num_shards=details.get('num_shards', 1), storage_version=storage_version)
+    # The Chroma directory, the keyword store (or the JSON files of older keyword indices) and the chunk store of every
+    # shard, the content hashes of the pages, with which the imported collection can be refreshed, and the build report
+    entries = [
+        ('chunk-store', collection_manager.storage_base_name(details['name'], storage_version) + '.pages.json'),
+        ('collections', details['name'] + '.build-report.json')
+    ]
+    for storage_name in storage_names:
+        entries += [
+            ('collections', storage_name),
+            ('keyword-index', storage_name + '.sqlite3'),
+            ('keyword-index', storage_name),
+            ('chunk-store', storage_name + '.sqlite3')
+        ]
+    return entries
+
+def _collection_files(collection_manager, details):
+    """
+    Returns the files of a collection, as (path in the snapshot, path on disk) pairs.
+    """
+    roots = _storage_roots(collection_manager)
+    entries = _collection_entries(collection_manager, details)
+
+    files = []
+    for prefix, entry in entries:
+        path = os.path.join(roots[prefix], entry)
+        if os.path.isfile(path):
+            files.append(('{}/{}'.format(prefix, entry), path))
+        elif os.path.isdir(path):
+            for directory, _, file_names in sorted(os.walk(path)):
+                for file_name in sorted(file_names):
+                    file_path = os.path.join(directory, file_name)
+                    relative = os.path.relpath(file_path, roots[prefix]).replace(os.sep, '/')
+                    files.append(('{}/{}'.format(prefix, relative), file_path))
+    return files
+
+def _file_digest(path):
+    """
+    Returns the size and the hexadecimal SHA-256 digest of a file.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(_block_size), b''):
+            digest.update(block)
+            size += len(block)
+    return size, digest.hexdigest()
+
+def _embedding_dimension(collection_manager, details):
+    """
+    Returns the dimension of the embeddings of a collection, or None if it has no vectors.
+    """
+    import chromadb
+
+    storage_name = collection_manager.shard_storage_names(details['name'], num_shards=details.get('num_shards', 1),
+                                                          storage_version=details.get('storage_version', 0))[0]
+    client = chromadb.PersistentClient(path=collection_manager.vector_index_path(storage_name))
+    embeddings = client.get_collection(name=details['name']).get(limit=1, include=['embeddings'])['embeddings']
+    return len(embeddings[0]) if embeddings is not None and len(embeddings) > 0 else None
+
+def _check_collection_details(details):
+    """
+    Checks the catalog entry of a snapshot, from which the paths of its files are derived.
+    Raises:
+        ValueError: If the name, the number of shards or the storage version of the collection is invalid.
+    """
+    name = details.get('name') if isinstance(details, dict) else None
+    if not isinstance(name, str) or name != format_collection_name(name) or any(part in name for part in ('/', '\\', '..')):
+        raise ValueError('Invalid collection name in snapshot: {}.'.format(name))
+    num_shards = details.get('num_shards', 1)
+    if not isinstance(num_shards, int) or isinstance(num_shards, bool) or num_shards < 1:
+        raise ValueError('Invalid number of shards in snapshot: {}.'.format(num_shards))
+    storage_version = details.get('storage_version', 0)
+    if not isinstance(storage_version, int) or isinstance(storage_version, bool) or storage_version < 0:
+        raise ValueError('Invalid storage version in snapshot: {}.'.format(storage_version))
+
+def _member_checker(collection_manager, details):
+    """
+    Returns a function which checks that the path of a member of a snapshot is one of the files of the collection
+    of the snapshot, so that a snapshot cannot replace the files of other collections, and returns its parts.
+    """
+    allowed = {'{}/{}'.format(prefix, entry) for prefix, entry in _collection_entries(collection_manager, details)}
+
+    def check(name):
+        parts = name.split('/')
+        # Files are either entries themselves (stores, page hashes, build report) or inside an entry (Chroma directories,
+        # older keyword indices)
+        if '' in parts or '.' in parts or '..' in parts or len(parts) < 2 or '/'.join(parts[:2]) not in allowed:
+            raise ValueError('Invalid path in snapshot: {}.'.format(name))
+        return parts
+
+    return check
+
+
+def export_collection_snapshot(collection_manager, collection_name, output):
+    """
+    Writes a snapshot of a collection.
+    Args:
+        collection_manager (CollectionManager): The manager of the collection.
+        collection_name (str): The name of the collection.
+        output (str or file object): The path of the archive, or a binary file object (e.g. standard output) to
+                                     which the archive is streamed.
+    Returns:
+        dict: The manifest of the snapshot.
+    Raises:
+        ValueError: If the collection does not exist.
+    """
+    details = collection_manager.get_query_engines_detail_by_name([collection_name])
+    if not details:
+        raise ValueError('Unknown collection: {}.'.format(collection_name))
+    details = details[0]
+
+    # The digests are computed before the archive is written, so that the manifest can be its first member
+    files = _collection_files(collection_manager, details)
+    manifest = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "created": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "collection": details,
+        "embedding": {"name": details.get('embedding_name'), "dimension": _embedding_dimension(collection_manager, details)},
+        "files": {}
+    }
+    for name, path in files:
+        size, sha256 = _file_digest(path)
+        manifest["files"][name] = {"size": size, "sha256": sha256}
+
+    manifest_bytes = json.dumps(manifest, indent=2).encode('utf-8')
+    if isinstance(output, str):
+        archive = tarfile.open(output, mode='w:gz')
+    else:
+        archive = tarfile.open(fileobj=output, mode='w|gz')
+    with archive:
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(manifest_bytes)
+        info.mtime = int(time.time())
+        archive.addfile(info, io.BytesIO(manifest_bytes))
+        for name, path in files:
+            info = archive.gettarinfo(path, arcname=name)
+            with open(path, 'rb') as file:
+                archive.addfile(info, file)
+
+    logging.info('>    Snapshot of {} with {} files was exported.'.format(collection_name, len(files)))
+    return manifest
+
+
+def _read_snapshot(collection_manager, source, write_member):
+    """
+    Reads a snapshot in a single pass, checks the size and digest of every member against the manifest, and
+    passes the blocks of every member to `write_member(name, blocks)`. Only the files of the collection of the
+    snapshot, named as in `collection_manager`, are accepted.
+    Returns:
+        dict: The manifest of the snapshot.
+    Raises:
+        ValueError: If the snapshot is invalid, incomplete or corrupted.
+    """
+    try:
+        return _read_archive(collection_manager, source, write_member)
+    except (tarfile.TarError, EOFError, gzip.BadGzipFile) as e:
+        raise ValueError('The snapshot archive is truncated or damaged: {}.'.format(e))
+
+def _read_archive(collection_manager, source, write_member):
+    """
+    Reads and checks a snapshot archive, see `_read_snapshot`.
+    """
+    if isinstance(source, str):
+        archive = tarfile.open(source, mode='r:*')
+    else:
+        archive = tarfile.open(fileobj=source, mode='r|*')
+
+    with archive:
+        manifest = None
+        seen = set()
+        for member in archive:
+            if manifest is None:
+                if member.name != MANIFEST_NAME:
+                    raise ValueError('The first member of a snapshot must be {}.'.format(MANIFEST_NAME))
+                manifest = json.loads(archive.extractfile(member).read().decode('utf-8'))
+                if manifest.get('format_version') != SNAPSHOT_FORMAT_VERSION:
+                    raise ValueError('Unsupported snapshot format version: {}.'.format(manifest.get('format_version')))
+                # Nothing is written before the manifest is known to only list files of its own collection
+                _check_collection_details(manifest.get('collection'))
+                check_member = _member_checker(collection_manager, manifest['collection'])
+                for name in manifest.get('files', {}):
+                    check_member(name)
+                continue
+            if member.isdir():
+                continue
+            if not member.isfile():
+                raise ValueError('Unsupported member in snapshot: {}.'.format(member.name))
+            check_member(member.name)
+            expected = manifest['files'].get(member.name)
+            if expected is None:
+                raise ValueError('File not listed in the manifest: {}.'.format(member.name))
+
+            digest = hashlib.sha256()
+            size = 0
+            file = archive.extractfile(member)
+
+            def blocks():
+                nonlocal size
+                for block in iter(lambda: file.read(_block_size), b''):
+                    digest.update(block)
+                    size += len(block)
+                    yield block
+
+            write_member(member.name, blocks())
+            if size != expected['size'] or digest.hexdigest() != expected['sha256']:
+                raise ValueError('Checksum mismatch for {}.'.format(member.name))
+            seen.add(member.name)
+
+    if manifest is None:
+        raise ValueError('The snapshot is empty.')
+    missing = set(manifest['files']) - seen
+    if missing:
+        raise ValueError('Files missing from the snapshot: {}.'.format(', '.join(sorted(missing))))
+    return manifest
+
+
+def verify_collection_snapshot(collection_manager, source):
+    """
+    Checks that a snapshot is complete and not corrupted, without extracting it.
+    Args:
+        collection_manager (CollectionManager): The manager into which the collection would be imported.
+        source (str or file object): The path of the archive, or a binary file object from which it is streamed.
+    Returns:
+        dict: The manifest of the snapshot.
+    Raises:
+        ValueError: If the snapshot is invalid, incomplete or corrupted.
+    """
+    def discard(name, blocks):
+        for _ in blocks:
+            pass
+
+    return _read_snapshot(collection_manager, source, discard)
+
+
+def import_collection_snapshot(collection_manager, source, overwrite=False, embedding_names=None):
+    """
+    Extracts a snapshot into the storage directories of a collection manager, verifying it while it is
+    streamed. The files are extracted next to their destination and only moved into place, and the
+    collection only added to the list of query engines, once the whole snapshot was verified, so a
+    failed import leaves the existing collections untouched.
+    Args:
+        collection_manager (CollectionManager): The manager into which the collection is imported.
+        source (str or file object): The path of the archive, or a binary file object from which it is streamed.
+        overwrite (bool, optional): Whether an existing collection with the same name is replaced. Defaults to False.
+        embedding_names (list of str, optional): The names of the embedding models available to query the
+                                                 collection. A warning is logged if the collection was
+                                                 embedded with another one. Defaults to no check.
+    Returns:
+        dict: The manifest of the snapshot.
+    Raises:
+        ValueError: If the snapshot is invalid, incomplete or corrupted, or the collection exists and
+                    `overwrite` is False.
+    """
+    roots = _storage_roots(collection_manager)
+    token = '.import-{}'.format(uuid.uuid4().hex[:12])
+    staging = {prefix: os.path.join(root, token) for prefix, root in roots.items()}
+
+    def extract(name, blocks):
+        # The path was checked against the files of the collection by `_read_snapshot`
+        parts = name.split('/')
+        path = os.path.join(staging[parts[0]], *parts[1:])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            for block in blocks:
+                file.write(block)
+
+    try:
+        manifest = _read_snapshot(collection_manager, source, extract)
+        details = manifest['collection']
+        name = details['name']
+
+        existing = collection_manager.get_query_engines_detail_by_name([name])
+        if existing and not overwrite:
+            raise ValueError('Collection {} already exists.'.format(name))
+        if embedding_names is not None and manifest['embedding']['name'] not in embedding_names:
+            logging.warning('>    Collection {} was embedded with {}, which is not an available embedding model.'.format(
+                name, manifest['embedding']['name']))
+        if existing:
+            collection_manager.delete_query_engine_by_name(name)
+
+        for prefix, directory in staging.items():
+            if not os.path.isdir(directory):
+                continue
+            for entry in os.listdir(directory):
+                destination = os.path.join(roots[prefix], entry)
+                if os.path.isdir(destination):
+                    shutil.rmtree(destination)
+                os.replace(os.path.join(directory, entry), destination)
+    finally:
+        for directory in staging.values():
+            shutil.rmtree(directory, ignore_errors=True)
+
+    # The collection becomes visible to the running processes once it is in the list of query engines
+    vec_store_desc = [entry for entry in collection_manager.get_query_engines_detail() if entry['name'] != name]
+    vec_store_desc.append(details)
+    collection_manager.write_query_engines_detail(vec_store_desc)
+    logging.info('>    Snapshot of {} with {} files was imported.'.format(name, len(manifest['files'])))
+    return manifest
@@ -0,0 +1,171 @@
+from typing import Any, Generator, Sequence, cast
+
+from llama_index.core import get_response_synthesizer
+from llama_index.core.constants import DEFAULT_NUM_OUTPUTS
+from llama_index.core.prompts.default_prompt_selectors import DEFAULT_TEXT_QA_PROMPT_SEL
+from llama_index.core.response_synthesizers.base import BaseSynthesizer
+from llama_index.core.utils import get_tokenizer
+
+from instrumentation import span
+
+# Synthesis mode that answers with exactly one LLM call. The other modes are the response modes of LlamaIndex.
+SINGLE_CALL_MODE = "single_call"
+
+# Tokens added by the chat format to every message and to the reply
+_tokens_per_message = 4
+_tokens_per_reply = 3
+
+
+def model_tokenizer(llm):
+    """
+    Returns the tokenizer of a model (e.g. the tiktoken encoding of OpenAI models), or the default
+    tokenizer of LlamaIndex for models whose tokenizer is unknown.
+    Args:
+        llm: The language model.
+    Returns:
+        callable: A function that returns the tokens of a text.
+    """
+    try:
+        tokenizer = getattr(llm, '_tokenizer', None)
+    except Exception:
+        tokenizer = None
+    if tokenizer is not None and hasattr(tokenizer, 'encode'):
+        return tokenizer.encode
+    return get_tokenizer()
+
+
+class SingleCallSynthesizer(BaseSynthesizer):
+    """
+    A response synthesizer that always answers with a single LLM call, so its latency does not depend
+    on the size of the retrieved context. The text chunks, given in ranking order, are packed greedily
+    into the prompt: a chunk that does not fit in the remaining budget is skipped and the next ones are
+    tried. Tokens are counted with the tokenizer of the model on the messages that are sent to it.
+    If even the first chunk does not fit, it is truncated.
+    Attributes:
+        max_prompt_tokens (int): Maximum number of tokens of the prompt, in addition to the limit set by the context
+                                 window of the model and the tokens reserved for the answer. None uses the whole window.
+    """
+
+    def __init__(self, llm=None, callback_manager=None, text_qa_template=None, max_prompt_tokens=None, streaming=False) -> None:
+        super().__init__(llm=llm, callback_manager=callback_manager, streaming=streaming)
+        self._text_qa_template = text_qa_template or DEFAULT_TEXT_QA_PROMPT_SEL
+        self.max_prompt_tokens = max_prompt_tokens
+        self._tokenizer = model_tokenizer(self._llm)
+
+    def _get_prompts(self):
+        """Get prompts."""
+        return {"text_qa_template": self._text_qa_template}
+
+    def _update_prompts(self, prompts) -> None:
+        """Update prompts."""
+        if "text_qa_template" in prompts:
+            self._text_qa_template = prompts["text_qa_template"]
+
+    def prompt_budget(self):
+        """
+        Returns the maximum number of tokens of the prompt.
+        Returns:
+            int: The context window of the model without the tokens reserved for the answer, limited to `max_prompt_tokens`.
+        """
+        metadata = self._llm.metadata
+        num_output = metadata.num_output if metadata.num_output and metadata.num_output > 0 else DEFAULT_NUM_OUTPUTS
+        budget = metadata.context_window - num_output
+        if self.max_prompt_tokens:
+            budget = min(budget, self.max_prompt_tokens)
+        return budget
+
+    def count_prompt_tokens(self, query_str, context_str):
+        """
+        Counts the tokens of the prompt that is sent to the model for a query and a context.
+        Args:
+            query_str (str): The query.
+            context_str (str): The context.
+        Returns:
+            int: The number of tokens.
+        """
+        template = self._text_qa_template
+        if self._llm.metadata.is_chat_model:
+            messages = self._llm._get_messages(template, query_str=query_str, context_str=context_str)
+            return sum(len(self._tokenizer(message.content or "")) + _tokens_per_message for message in messages) + _tokens_per_reply
+        return len(self._tokenizer(self._llm._get_prompt(template, query_str=query_str, context_str=context_str)))
+
+    def pack(self, query_str, text_chunks):
+        """
+        Packs the text chunks into the context of the prompt.
+        Args:
+            query_str (str): The query.
+            text_chunks (list of str): The text chunks, from the most to the least relevant.
+        Returns:
+            tuple: The context (str), the number of packed chunks and the number of tokens of the prompt.
+        """
+        budget = self.prompt_budget()
+        separator = "\n\n"
+        remaining = budget - self.count_prompt_tokens(query_str, "") - len(self._tokenizer(separator)) * len(text_chunks)
+
+        packed = []
+        for chunk in text_chunks:
+            num_tokens = len(self._tokenizer(chunk))
+            if num_tokens <= remaining:
+                packed.append(chunk)
+                remaining -= num_tokens
+
+        # Tokens at the boundaries of the chunks may merge, so the packed prompt is counted again
+        context_str = separator.join(packed)
+        num_tokens = self.count_prompt_tokens(query_str, context_str)
+        while packed and num_tokens > budget:
+            packed.pop()
+            context_str = separator.join(packed)
+            num_tokens = self.count_prompt_tokens(query_str, context_str)
+
+        if not packed and text_chunks:
+            # Keep as many words of the most relevant chunk as fit
+            words = text_chunks[0].split(' ')
+            low, high = 0, len(words)
+            while low < high:
+                middle = (low + high + 1) // 2
+                if self.count_prompt_tokens(query_str, ' '.join(words[:middle])) <= budget:
+                    low = middle
+                else:
+                    high = middle - 1
+            context_str = ' '.join(words[:low])
+            num_tokens = self.count_prompt_tokens(query_str, context_str)
+            packed = [context_str] if low else []
+
+        return context_str, len(packed), num_tokens
+
+    def get_response(self, query_str: str, text_chunks: Sequence[str], **response_kwargs: Any):
+        with span("synthesize.pack", num_chunks=len(text_chunks)) as attributes:
+            context_str, num_packed, num_tokens = self.pack(query_str, list(text_chunks))
+            attributes.update(num_packed=num_packed, prompt_tokens=num_tokens)
+
+        if not self._streaming:
+            response = self._llm.predict(self._text_qa_template, query_str=query_str, context_str=context_str, **response_kwargs)
+            return response or "Empty Response"
+        return cast(Generator, self._llm.stream(self._text_qa_template, query_str=query_str, context_str=context_str, **response_kwargs))
+
+    async def aget_response(self, query_str: str, text_chunks: Sequence[str], **response_kwargs: Any):
+        with span("synthesize.pack", num_chunks=len(text_chunks)) as attributes:
+            context_str, num_packed, num_tokens = self.pack(query_str, list(text_chunks))
+            attributes.update(num_packed=num_packed, prompt_tokens=num_tokens)
+
+        if not self._streaming:
+            response = await self._llm.apredict(self._text_qa_template, query_str=query_str, context_str=context_str, **response_kwargs)
+            return response or "Empty Response"
+        return await self._llm.astream(self._text_qa_template, query_str=query_str, context_str=context_str, **response_kwargs)
+
+
+def create_response_synthesizer(llm, synthesis_mode=SINGLE_CALL_MODE, max_prompt_tokens=None, streaming=False, callback_manager=None):
+    """
+    Creates the response synthesizer of a synthesis mode.
+    Args:
+        llm: The language model.
+        synthesis_mode (str): "single_call" for a SingleCallSynthesizer, or a response mode of LlamaIndex (e.g. "compact").
+        max_prompt_tokens (int, optional): Maximum number of tokens of the prompt in "single_call" mode.
+        streaming (bool): Whether the answer is streamed.
+        callback_manager (CallbackManager, optional): The callback manager of the synthesizer.
+    Returns:
+        BaseSynthesizer: The response synthesizer.
+    """
+    if synthesis_mode == SINGLE_CALL_MODE:
+        return SingleCallSynthesizer(llm=llm, callback_manager=callback_manager, max_prompt_tokens=max_prompt_tokens, streaming=streaming)
+    return get_response_synthesizer(llm=llm, response_mode=synthesis_mode, streaming=streaming, callback_manager=callback_manager)
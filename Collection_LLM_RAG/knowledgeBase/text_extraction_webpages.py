@@ -1,17 +1,51 @@
 import re
 import json
-import fitz
 import logging
 import requests
+from urllib.parse import urlparse
 from bs4 import BeautifulSoup
 
+from instrumentation import span, current_trace
+
+def extract_text_from_html(html):
+    """
+    Extracts and cleans text content from the HTML source of a webpage.
+    This function parses the HTML content, removes unwanted elements (such as scripts, styles,
+    headers, footers, navigation, and asides), and extracts the text from paragraph, preformatted,
+    and code elements. The extracted text is then normalized to avoid unwanted formatting issues.
+    Args:
+        html (str): The HTML source of the webpage.
+    Returns:
+        str: The cleaned and extracted text content of the webpage.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+
+    # Remove unwanted elements
+    for tag in soup(["script", "style", "header", "footer", "nav", "aside"]):
+        tag.decompose()
+
+    # Extract all relevant elements in the order they appear
+    content = []
+    for element in soup.find_all(["p", "pre", "code"]):  
+        if element.name == "p":
+            content.append(element.get_text(strip=False))
+        elif element.name in ["pre", "code"]:
+            content.append(f"\n```\n{element.get_text(strip=False)}\n```\n")  # Preserve code block formatting
+
+    # Join extracted content while preserving order
+    full_content = "\n\n".join(content)
+
+    # Normalize spaces to avoid unwanted formatting issues
+    full_content = re.sub(r'\s+', ' ', full_content).strip()
+    
+    return full_content
+
 def extract_text_from_url(url):
     """
     Extracts and cleans text content from a given URL.
-    This function sends a GET request to the specified URL, parses the HTML content,
-    removes unwanted elements (such as scripts, styles, headers, footers, navigation, and asides),
-    and extracts the text from paragraph, preformatted, and code elements. The extracted text
-    is then normalized to avoid unwanted formatting issues.
+    This function sends a GET request to the specified URL and extracts the text of the
+    returned HTML content with `extract_text_from_html`. The download ('ingest.fetch', with the
+    host and the number of bytes) and the extraction ('ingest.parse') are recorded as spans.
     Args:
         url (str): The URL of the webpage to extract text from.
     Returns:
@@ -20,32 +54,19 @@ def extract_text_from_url(url):
     """
 
     try:
-        response = requests.get(url, timeout=10)
+        with span("ingest.fetch", host=urlparse(url).netloc) as attributes:
+            attributes["errors"] = 1
+            response = requests.get(url, timeout=10)
+            attributes["bytes"] = len(response.content)
+            attributes["errors"] = int(response.status_code == 404)
         if response.status_code == 404:
             logging.warning(f"Skipping {url}: 404 Not Found")
             return None
         
-        soup = BeautifulSoup(response.text, "html.parser")
-
-        # Remove unwanted elements
-        for tag in soup(["script", "style", "header", "footer", "nav", "aside"]):
-            tag.decompose()
-
-        # Extract all relevant elements in the order they appear
-        content = []
-        for element in soup.find_all(["p", "pre", "code"]):  
-            if element.name == "p":
-                content.append(element.get_text(strip=False))
-            elif element.name in ["pre", "code"]:
-                content.append(f"\n```\n{element.get_text(strip=False)}\n```\n")  # Preserve code block formatting
-
-        # Join extracted content while preserving order
-        full_content = "\n\n".join(content)
-
-        # Normalize spaces to avoid unwanted formatting issues
-        full_content = re.sub(r'\s+', ' ', full_content).strip()
-        
-        return full_content
+        with span("ingest.parse") as attributes:
+            text = extract_text_from_html(response.text)
+            attributes["chars"] = len(text)
+        return text
     except requests.RequestException as e:
         logging.info(f"Error fetching {url}: {e}")
         return None
@@ -84,6 +105,11 @@ def scrape_articles(json_file, output_file):
     except json.JSONDecodeError:
         raise ValueError("Invalid JSON format: {}.".format(json_file))
     
+    # Number of pages of the collection being built, to show the progress of the build
+    trace = current_trace()
+    if trace is not None:
+        trace.attributes["pages"] = len(data["data"])
+
     scraped_data = []
     for article in data["data"]:
         name = article.get("Name", "")
@@ -114,18 +140,28 @@ def extract_text_from_pdf_url(url) -> str:
         Returns:
             str: The extracted text content from the PDF, or None if an error occurs.
         """
+        # PyMuPDF is only needed for PDF collections, so it is not imported at startup
+        import fitz
+
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
+            with span("ingest.fetch", host=urlparse(url).netloc) as attributes:
+                attributes["errors"] = 1
+                response = requests.get(url, timeout=10)
+                attributes["bytes"] = len(response.content)
+                response.raise_for_status()
+                attributes["errors"] = 0
             
-            # Open the PDF from the response content
-            pdf_document = fitz.open(stream=response.content, filetype="pdf")
-            
-            # Extract text from each page
-            text = ""
-            for page_num in range(pdf_document.page_count):
-                page = pdf_document.load_page(page_num)
-                text += page.get_text()
+            with span("ingest.parse") as attributes:
+                # Open the PDF from the response content
+                pdf_document = fitz.open(stream=response.content, filetype="pdf")
+                
+                # Extract text from each page
+                text = ""
+                for page_num in range(pdf_document.page_count):
+                    page = pdf_document.load_page(page_num)
+                    text += page.get_text()
+                attributes["pdf_pages"] = pdf_document.page_count
+                attributes["chars"] = len(text)
             
             return text.strip()
         except requests.RequestException as e:
@@ -164,6 +200,11 @@ def scrape_pdfs(json_file, output_file):
     except json.JSONDecodeError:
         raise ValueError("Invalid JSON format: {}.".format(json_file))
     
+    # Number of pages of the collection being built, to show the progress of the build
+    trace = current_trace()
+    if trace is not None:
+        trace.attributes["pages"] = len(data["data"])
+
     scraped_data = []
     for article in data["data"]:
         name = article.get("Name", "")
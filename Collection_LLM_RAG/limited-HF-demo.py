@@ -11,4 +11,5 @@ if __name__ == '__main__':
     # This runs the application with limited functionality.
     # To enable full capabilities, including creating or deleting query engines, 
     # run `main.py` or set `enable_query_engine_management=True`.
-    launch_app(enable_query_engine_management=False)
\ No newline at end of file
+    # The interface is served before the indices are loaded, to shorten cold starts of the demo.
+    launch_app(enable_query_engine_management=False, fast_startup=True)
\ No newline at end of file
@@ -0,0 +1,365 @@
+import gc
+import os
+import sys
+import copy
+import json
+import time
+import random
+import logging
+import argparse
+import shutil
+import platform
+import tempfile
+import threading
+from datetime import datetime
+
+from user_agent import UserAgent
+from batch_query import load_questions
+from instrumentation import configure_instrumentation, percentile
+from trace_callbacks import register_trace_callbacks
+from call_cache import configure_call_cache, get_call_cache
+from profiling import configure_profiling
+from local_embeddings import configure_local_embeddings
+from knowledgeBase.shards import configure_sharding
+
+# Questions asked when no question file is given: a mix of short lookups, comparisons and follow-ups
+# that depend on the chat memory
+DEFAULT_QUESTIONS = [
+    "What is this library used for?",
+    "How do I install it?",
+    "Which platforms are supported?",
+    "Give me a short example of how to use it.",
+    "What are the main alternatives?",
+    "How does it compare with the alternatives in terms of performance?",
+    "Can you explain that in more detail?",
+    "What license is it released under?",
+    "Summarize the main features of the tools in the collection.",
+    "Which of them would you recommend for a beginner, and why?"
+]
+
+# Answers of `interact_with_agent` and `ai_response` that report an error in the chat instead of raising it
+ERROR_PREFIXES = ("An error occurred", "API key is not valid", "Please select one or more query engines")
+
+
+def resident_memory():
+    """
+    Returns the resident memory of the process in bytes. On systems without /proc, the peak resident
+    memory is returned instead.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+def summarize(values):
+    """
+    Summarizes a list of durations in milliseconds.
+    """
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean_ms": sum(values) / len(values) if values else None,
+        "p50_ms": percentile(values, 50),
+        "p95_ms": percentile(values, 95),
+        "p99_ms": percentile(values, 99),
+        "max_ms": values[-1] if values else None
+    }
+
+def create_sessions(base_agent, num_sessions, modes, collections, collections_per_session, rng):
+    """
+    Creates the sessions of a step the way the Gradio app does: every session deep-copies the initial
+    agent (see `UserAgent.__deepcopy__`), then selects its mode and its collections.
+    Args:
+        base_agent (UserAgent): The initial agent, shared by all sessions.
+        num_sessions (int): The number of sessions.
+        modes (list of str): The modes, assigned to the sessions in turn.
+        collections (list of str): The collections the sessions select from.
+        collections_per_session (int): The number of collections selected by each session.
+        rng (random.Random): The source of the random selections.
+    Returns:
+        list of dict: The sessions, each with its 'id', 'agent', 'mode', 'collections' and 'setup_ms'.
+    """
+    from application import change_mode, on_select_query_engine
+
+    sessions = []
+    for idx in range(num_sessions):
+        start = time.perf_counter()
+        agent = copy.deepcopy(base_agent)
+        mode = modes[idx % len(modes)]
+        selected = sorted(rng.sample(collections, min(collections_per_session, len(collections))))
+        change_mode(mode, agent)
+        on_select_query_engine(agent, selected)
+        sessions.append({
+            "id": idx,
+            "agent": agent,
+            "mode": mode,
+            "collections": selected,
+            "setup_ms": (time.perf_counter() - start) * 1000
+        })
+    return sessions
+
+def run_session(session, questions, turns, think_time, rng, barrier, records):
+    """
+    Sends the questions of one session through `ai_response`, one turn after the other, as a user of the
+    chat does, and appends a record per turn with its latency and whether it failed.
+    Args:
+        session (dict): The session, as returned by `create_sessions`.
+        questions (list of dict): The questions to pick from, as returned by `load_questions`.
+        turns (int): The number of questions asked by the session.
+        think_time (float): The mean pause between two turns in seconds, exponentially distributed.
+        rng (random.Random): The source of the picked questions and pauses, owned by this session.
+        barrier (threading.Barrier): Makes all sessions of a step start at the same time.
+        records (list): The list the records are appended to.
+    """
+    from application import ai_response
+
+    chat_history = []
+    barrier.wait()
+    for turn in range(turns):
+        if turn > 0 and think_time > 0:
+            time.sleep(rng.expovariate(1 / think_time))
+        entry = rng.choice(questions)
+        start = time.perf_counter()
+        try:
+            _, chat_history = ai_response(entry['question'], chat_history, session['agent'], session['collections'])
+            answer = chat_history[-1]['content']
+            error = answer if answer.startswith(ERROR_PREFIXES) else None
+        except Exception as e:
+            error = str(e)
+        end = time.perf_counter()
+        records.append({
+            "session": session['id'],
+            "mode": session['mode'],
+            "turn": turn,
+            "question": entry['id'],
+            "latency_ms": (end - start) * 1000,
+            "end": end,
+            "error": error
+        })
+
+def run_step(base_agent, num_sessions, args, questions, collections, seed):
+    """
+    Runs one step of the ramp: creates the sessions, lets them chat concurrently and summarizes the
+    throughput, the latency of the turns (overall and per mode), the error rate and the memory per session.
+    Args:
+        base_agent (UserAgent): The initial agent, shared by all sessions.
+        num_sessions (int): The number of concurrent sessions.
+        args (argparse.Namespace): The parameters of the load test.
+        questions (list of dict): The question mix.
+        collections (list of str): The collections the sessions select from.
+        seed (int): The seed of the step.
+    Returns:
+        dict: The results of the step.
+    """
+    rng = random.Random(seed)
+    gc.collect()
+    memory_before = resident_memory()
+
+    sessions = create_sessions(base_agent, num_sessions, args.modes, collections, args.collections_per_session, rng)
+    records = []
+    barrier = threading.Barrier(num_sessions + 1)
+    threads = [
+        threading.Thread(
+            target=run_session,
+            args=(session, questions, args.turns, args.think_time_ms / 1000, random.Random(rng.random()), barrier, records),
+            name='load-test-session-{}'.format(session['id']),
+            daemon=True
+        )
+        for session in sessions
+    ]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    memory_after = resident_memory()
+    session_sizes = [session['agent'].session_size() for session in sessions]
+    failures = [record for record in records if record['error'] is not None]
+    answered = [record for record in records if record['error'] is None]
+
+    # Throughput at full concurrency, i.e. until the first session is done, so the tail of the
+    # slowest sessions running alone does not lower it
+    last_end_by_session = {}
+    for record in records:
+        last_end_by_session[record['session']] = max(last_end_by_session.get(record['session'], 0), record['end'])
+    steady_end = min(last_end_by_session.values()) if last_end_by_session else start
+    steady_answered = sum(1 for record in answered if record['end'] <= steady_end)
+
+    result = {
+        "sessions": num_sessions,
+        "turns": len(records),
+        "duration_s": duration,
+        "throughput_qps": len(answered) / duration if duration > 0 else None,
+        "steady_throughput_qps": steady_answered / (steady_end - start) if steady_end > start else None,
+        "errors": len(failures),
+        "error_rate": len(failures) / len(records) if records else None,
+        "error_samples": sorted({record['error'][:200] for record in failures})[:5],
+        "latency": summarize([record['latency_ms'] for record in answered]),
+        "latency_by_mode": {
+            mode: summarize([record['latency_ms'] for record in answered if record['mode'] == mode])
+            for mode in sorted({session['mode'] for session in sessions})
+        },
+        "session_setup": summarize([session['setup_ms'] for session in sessions]),
+        "memory": {
+            "session_state_mean_kb": sum(session_sizes) / len(session_sizes) / 1024,
+            "session_state_max_kb": max(session_sizes) / 1024,
+            "rss_before_mb": memory_before / 2 ** 20,
+            "rss_after_mb": memory_after / 2 ** 20,
+            "rss_growth_per_session_kb": (memory_after - memory_before) / num_sessions / 1024
+        }
+    }
+    del sessions, threads
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the chat: concurrent sessions, each with its own agent, '
+                                                 'mode and collections, send a question mix through the chat handler.')
+    parser.add_argument('--questions', default=None, help='Question file (.jsonl, .json or plain text), see batch_query.py. Defaults to a built-in mix.')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='Numbers of concurrent sessions of the steps of the ramp.')
+    parser.add_argument('--turns', type=int, default=5, help='Number of questions asked by each session.')
+    parser.add_argument('--think-time-ms', type=float, default=0.0, help='Mean pause of a session between two questions.')
+    parser.add_argument('--modes', nargs='+', default=None, help='Modes of the sessions, assigned in turn. Defaults to all modes of the configuration file.')
+    parser.add_argument('--collections', nargs='+', default=None, help='Collections the sessions select from. Defaults to all collections.')
+    parser.add_argument('--collections-per-session', type=int, default=2, help='Number of collections selected by each session.')
+    parser.add_argument('--llm', default=None, help='Name of the LLM. Defaults to the first API LLM of the configuration file.')
+    parser.add_argument('--embedding', default=None, help='Name of the embedding model. Defaults to the first API embedding model of the configuration file.')
+    parser.add_argument('--mock', action='store_true', help='Start the mock OpenAI server in this process and send all requests to it.')
+    parser.add_argument('--chat-latency', default='lognormal:800:300', help='Latency of the chat completions of the mock server (see mock_openai_server.py).')
+    parser.add_argument('--embedding-latency', default='50', help='Latency of the embedding requests of the mock server.')
+    parser.add_argument('--rate-limit-rpm', type=int, default=None, help='Requests per minute accepted by the mock server before answering with HTTP 429.')
+    parser.add_argument('--openai-api-key', default=os.environ.get('OPENAI_API_KEY', ''), help='OpenAI API key. Defaults to the OPENAI_API_KEY environment variable.')
+    parser.add_argument('--call-cache', action='store_true', help='Cache the LLM and embedding calls, in a cache of its own that starts empty. By default, calls are not cached, so every turn calls the API.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the selected collections, questions and pauses.')
+    parser.add_argument('--output', default=None, help='Path of the JSON report. Defaults to Data/benchmarks/load-test-<time>.json.')
+    args = parser.parse_args()
+
+    output = args.output or os.path.join('Data', 'benchmarks', 'load-test-{}.json'.format(datetime.now().strftime('%Y%m%d-%H%M%S')))
+
+    # Loading setting configurations
+    with open('./Collection_LLM_RAG/program_init_config.json', 'r') as file:
+        config_data = json.load(file)
+
+    configure_instrumentation({**config_data['Instrumentation'], "metrics_port": None})
+    register_trace_callbacks()
+    # The calls are not cached by default, so that the latencies are those of the API. With --call-cache, the
+    # cache starts empty and does not touch the cache of the application, so hits only come from the load test
+    cache_dir = None
+    if args.call_cache:
+        cache_dir = tempfile.mkdtemp(prefix='rag-load-test-cache-')
+        configure_call_cache({**config_data['CallCache'], "enabled": True, "path": os.path.join(cache_dir, 'llm-calls.sqlite3')})
+    else:
+        configure_call_cache({"enabled": False})
+    configure_profiling(config_data['Profiling'])
+    configure_local_embeddings(config_data['LocalEmbedding'])
+    configure_sharding(config_data['Sharding'])
+
+    mock_state = None
+    api_base = config_data['OpenAI-API-base']
+    if args.mock:
+        from mock_openai_server import MockOpenAIState, LatencyModel, start_mock_openai_server
+
+        mock_state = MockOpenAIState(
+            chat_latency=LatencyModel.parse(args.chat_latency),
+            embedding_latency=LatencyModel.parse(args.embedding_latency),
+            rate_limit_rpm=args.rate_limit_rpm,
+            seed=args.seed
+        )
+        _, api_base = start_mock_openai_server(port=0, state=mock_state)
+        args.openai_api_key = args.openai_api_key or 'load-test'
+    elif api_base is None:
+        parser.error('The load test would send its requests to OpenAI: use --mock or set OpenAI-API-base in the configuration file.')
+    if args.openai_api_key == "":
+        parser.error('An API key is required (--openai-api-key or OPENAI_API_KEY).')
+
+    from application import collection_manager
+
+    collections = args.collections or [details['name'] for details in collection_manager.get_query_engines_detail()]
+    if not collections:
+        parser.error('There is no collection to query.')
+    args.modes = args.modes or config_data['Modes']
+    questions = load_questions(args.questions) if args.questions else [{"id": str(idx), "question": question} for idx, question in enumerate(DEFAULT_QUESTIONS)]
+
+    base_agent = UserAgent(
+        llm_name=args.llm or config_data['LLMs']['API'][0],
+        embedding_name=args.embedding or config_data['Embedding']['API'][0],
+        mode=args.modes[0],
+        query_engines_details=[],
+        openAI_api=args.openai_api_key,
+        subquestion_max_parallel=config_data['SubQuestion']['max_parallel'],
+        subquestion_timeout=config_data['SubQuestion']['timeout_seconds'],
+        api_base=api_base,
+        context_token_budget=config_data['ContextCompression']['token_budget'],
+        synthesis_mode=config_data['Synthesis']['mode'],
+        max_prompt_tokens=config_data['Synthesis']['max_prompt_tokens'],
+        adaptive_retrieval=config_data['AdaptiveRetrieval'],
+        reranking=config_data['Reranking']
+    )
+
+    # The indices are loaded once before the ramp, as they are shared by the sessions of a running app
+    logging.info('>    Loading the collections {}.'.format(collections))
+    copy.deepcopy(base_agent).set_agent(query_engines_details=collection_manager.get_query_engines_detail_by_name(collections))
+
+    report = {
+        "created": datetime.now().isoformat(timespec='seconds'),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": {**vars(args), "openai_api_key": None, "api_base": api_base, "collections": collections},
+        "results": []
+    }
+
+    try:
+        for step, num_sessions in enumerate(args.sessions):
+            if mock_state is not None:
+                stats_before = dict(mock_state.stats)
+                mock_state.stats["max_in_flight"] = 0
+            cache_before = get_call_cache().stats()['kinds'] if get_call_cache() is not None else None
+
+            # The messages logged for every selection and answer of the sessions are not shown
+            logging.getLogger().setLevel(logging.WARNING)
+            try:
+                result = run_step(base_agent, num_sessions, args, questions, collections, seed=args.seed + step)
+            finally:
+                logging.getLogger().setLevel(logging.INFO)
+            if mock_state is not None:
+                result["mock_server"] = {
+                    key: mock_state.stats[key] - stats_before[key] if key != "max_in_flight" else mock_state.stats[key]
+                    for key in ["chat_completions", "embeddings", "rate_limited", "max_in_flight"]
+                }
+            result["call_cache"] = None
+            if cache_before is not None:
+                result["call_cache"] = {}
+                for kind, stats in get_call_cache().stats()['kinds'].items():
+                    hits = stats['hits'] - cache_before.get(kind, {}).get('hits', 0)
+                    misses = stats['misses'] - cache_before.get(kind, {}).get('misses', 0)
+                    result["call_cache"][kind] = {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits + misses else None}
+            report["results"].append(result)
+            logging.info('>    {} sessions: {:.2f} q/s ({:.2f} q/s at full concurrency), latency p50 {:.0f} ms, p95 {:.0f} ms, '
+                         'p99 {:.0f} ms, errors {:.1%}, session state {:.1f} KB, RSS {:+.1f} KB per session.'.format(
+                num_sessions, result["throughput_qps"] or 0, result["steady_throughput_qps"] or 0,
+                result["latency"]["p50_ms"] or 0, result["latency"]["p95_ms"] or 0, result["latency"]["p99_ms"] or 0,
+                result["error_rate"] or 0, result["memory"]["session_state_mean_kb"], result["memory"]["rss_growth_per_session_kb"]))
+            for kind, stats in sorted((result["call_cache"] or {}).items()):
+                logging.info('>    Call cache {}: {} hits, {} misses ({:.0%} hit rate).'.format(kind, stats['hits'], stats['misses'], stats['hit_rate'] or 0))
+    finally:
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=4)
+        logging.info('>    Load test report saved to {}'.format(output))
+        if cache_dir is not None:
+            configure_call_cache({"enabled": False})
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+
+    # Configure logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    main()
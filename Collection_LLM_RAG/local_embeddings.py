@@ -0,0 +1,266 @@
+import os
+import re
+import zlib
+import logging
+import threading
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+# Embedding models that run on the CPU of the process, without API calls. This module does not import
+# LlamaIndex: the backends compute the embeddings of batches of texts as NumPy arrays, and
+# `local_models.LocalEmbedding` exposes a backend as an embedding model of LlamaIndex.
+# A local model is named '<name> (Local)' in the interface and in the list of query engines, and its
+# settings are read from the 'LocalEmbedding' section of the configuration file. The settings of a
+# model must not change once collections are embedded with it, since their vectors would no longer match.
+
+LOCAL_SUFFIX = ' (Local)'
+
+_word_pattern = re.compile(r"\w+")
+
+# Words too frequent to tell texts apart. The hashed backend does not depend on the collection being
+# embedded, so it cannot learn inverse document frequencies; dropping these words and damping the term
+# frequencies plays their role.
+STOP_WORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between both
+but by can could did do does doing down during each few for from further had has have having he her here hers
+herself him himself his how i if in into is it its itself just me more most my myself no nor not now of off on
+once only or other our ours ourselves out over own same she should so some such than that the their theirs them
+themselves then there these they this those through to too under until up very was we were what when where which
+while who whom why will with would you your yours yourself yourselves
+""".split())
+
+
+class LocalEmbeddingBackend(ABC):
+    """
+    The interface of the backends of local embedding models. A backend is shared by all threads of the
+    process, so `embed` must be thread safe.
+    Attributes:
+        dimension (int): The dimension of the embeddings.
+    Methods:
+        embed(texts):
+    """
+    dimension = None
+
+    @abstractmethod
+    def embed(self, texts):
+        """
+        Computes the embeddings of a batch of texts.
+        Args:
+            texts (list of str): The texts.
+        Returns:
+            numpy.ndarray: A float32 array of shape (len(texts), dimension) with L2-normalized rows.
+        """
+
+
+class HashedNgramBackend(LocalEmbeddingBackend):
+    """
+    Embeds texts as hashed bags of words and word bigrams, without any model file. Every term is hashed,
+    its frequency in the text is damped (1 + log tf), and it is added with random signs to `projections`
+    of the `dimension` coordinates chosen by its hash, which is a sparse random projection of the
+    vector of term frequencies. Texts sharing terms get similar embeddings, so it suits keyword-like
+    queries; it does not know synonyms. A batch is projected with a few NumPy operations.
+    Attributes:
+        dimension (int): The dimension of the embeddings.
+        ngrams (int): The longest word n-gram used as a term (1 or 2).
+        projections (int): The number of coordinates each term is added to.
+        seed (int): The seed of the projection.
+    """
+
+    def __init__(self, dimension=768, ngrams=2, projections=4, seed=0, cache_size=200000):
+        if ngrams not in (1, 2):
+            raise ValueError('Hashed embeddings support unigrams and bigrams only, not {}-grams.'.format(ngrams))
+        self.dimension = dimension
+        self.ngrams = ngrams
+        self.projections = projections
+        self.seed = seed
+
+        rng = np.random.RandomState(seed)
+        # Odd 64-bit multipliers and offsets of the multiply-shift hashes that choose the coordinates of a term
+        self._multipliers = self._random_words(rng, projections) | np.uint64(1)
+        self._offsets = self._random_words(rng, projections)
+
+        # Hashes of the terms seen recently, since most terms of a collection repeat
+        self._hashes = {}
+        self._cache_size = cache_size
+
+    @staticmethod
+    def _random_words(rng, size):
+        return rng.randint(0, 2 ** 32, size=size, dtype=np.uint64) << np.uint64(32) | rng.randint(0, 2 ** 32, size=size, dtype=np.uint64)
+
+    def _terms(self, text):
+        words = [word for word in _word_pattern.findall(text.lower()) if word not in STOP_WORDS]
+        if self.ngrams == 2:
+            words.extend([first + ' ' + second for first, second in zip(words, words[1:])])
+        return words
+
+    def _hash(self, term):
+        hashed = self._hashes.get(term)
+        if hashed is None:
+            if len(self._hashes) >= self._cache_size:
+                self._hashes = {}
+            hashed = self._hashes[term] = zlib.crc32(term.encode('utf-8'))
+        return hashed
+
+    def embed(self, texts):
+        """
+        Computes the embeddings of a batch of texts.
+        Args:
+            texts (list of str): The texts.
+        Returns:
+            numpy.ndarray: A float32 array of shape (len(texts), dimension) with L2-normalized rows.
+        """
+        terms = [self._terms(text) for text in texts]
+        hashes = np.fromiter((self._hash(term) for text_terms in terms for term in text_terms), dtype=np.uint64)
+        rows = np.repeat(np.arange(len(texts), dtype=np.uint64), [len(text_terms) for text_terms in terms])
+
+        # Term frequencies per text, from the distinct (text, term hash) pairs
+        pairs, frequencies = np.unique(rows << np.uint64(32) | hashes, return_counts=True)
+        rows = (pairs >> np.uint64(32)).astype(np.int64)
+        weights = 1.0 + np.log(frequencies)
+
+        # Coordinates and signs of each term, from the high bits of its multiply-shift hashes
+        mixed = ((pairs & np.uint64(0xFFFFFFFF))[:, None] * self._multipliers[None, :] + self._offsets[None, :]) >> np.uint64(32)
+        coordinates = ((mixed >> np.uint64(1)) % np.uint64(self.dimension)).astype(np.int64)
+        signs = np.where(mixed & np.uint64(1), 1.0, -1.0)
+
+        vectors = np.bincount(
+            (rows[:, None] * self.dimension + coordinates).ravel(),
+            weights=(weights[:, None] * signs).ravel(),
+            minlength=len(texts) * self.dimension
+        ).reshape(len(texts), self.dimension).astype(np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+class OnnxBackend(LocalEmbeddingBackend):
+    """
+    Embeds texts with a transformer encoder exported to ONNX (e.g. a sentence-transformers model) and run
+    with ONNX Runtime on the CPU. The model and its tokenizer ('tokenizer.json' of the Tokenizers
+    library) are read from local files; nothing is downloaded.
+    Attributes:
+        dimension (int): The dimension of the embeddings.
+        pooling (str): How the token embeddings are combined: 'mean' (over the attention mask) or 'cls'.
+        max_length (int): The number of tokens after which texts are truncated.
+    """
+
+    def __init__(self, model_path, tokenizer_path, pooling='mean', max_length=256, threads=None):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        for path in (model_path, tokenizer_path):
+            if not os.path.exists(path):
+                raise FileNotFoundError('File of the local embedding model not found: {}'.format(path))
+        if pooling not in ('mean', 'cls'):
+            raise ValueError('Unsupported pooling: {}.'.format(pooling))
+        self.pooling = pooling
+        self.max_length = max_length
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self._session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self._input_names = [model_input.name for model_input in self._session.get_inputs()]
+
+        self._tokenizer = Tokenizer.from_file(tokenizer_path)
+        self._tokenizer.enable_truncation(max_length=max_length)
+        if self._tokenizer.padding is None:
+            self._tokenizer.enable_padding()
+
+        dimension = self._session.get_outputs()[0].shape[-1]
+        self.dimension = dimension if isinstance(dimension, int) else self.embed(['dimension']).shape[1]
+
+    def embed(self, texts):
+        """
+        Computes the embeddings of a batch of texts.
+        Args:
+            texts (list of str): The texts.
+        Returns:
+            numpy.ndarray: A float32 array of shape (len(texts), dimension) with L2-normalized rows.
+        """
+        encodings = self._tokenizer.encode_batch(texts)
+        inputs = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64),
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64)
+        }
+        output = self._session.run(None, {name: inputs[name] for name in self._input_names})[0]
+
+        if output.ndim == 3:
+            if self.pooling == 'cls':
+                output = output[:, 0]
+            else:
+                mask = inputs["attention_mask"][:, :, None].astype(output.dtype)
+                output = (output * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        vectors = output.astype(np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+# Kinds of backends, by the 'backend' of the settings of a model
+BACKENDS = {
+    "hashed": HashedNgramBackend,
+    "onnx": OnnxBackend
+}
+
+# Settings of the local models, by name without the suffix
+_models = {
+    "Hashed n-grams": {"backend": "hashed", "dimension": 768, "ngrams": 2, "projections": 4, "seed": 0}
+}
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def is_local_embedding(embedding_name):
+    """
+    Returns whether an embedding name is the name of a local model.
+    """
+    return embedding_name.endswith(LOCAL_SUFFIX)
+
+def local_embedding_names():
+    """
+    Returns the names of the configured local models, with their suffix.
+    """
+    return [name + LOCAL_SUFFIX for name in _models]
+
+def get_local_backend(embedding_name):
+    """
+    Returns the backend of a local model, creating it the first time.
+    Args:
+        embedding_name (str): The name of the model, with or without its suffix.
+    Returns:
+        LocalEmbeddingBackend: The backend.
+    Raises:
+        ValueError: If the model is not configured or its backend is unknown.
+    """
+    name = embedding_name[:-len(LOCAL_SUFFIX)] if is_local_embedding(embedding_name) else embedding_name
+    if name not in _models:
+        raise ValueError('Selected Embedding name is not supported.')
+    with _backends_lock:
+        backend = _backends.get(name)
+        if backend is None:
+            settings = dict(_models[name])
+            kind = settings.pop('backend')
+            if kind not in BACKENDS:
+                raise ValueError('Unknown backend of the local embedding model {}: {}.'.format(name, kind))
+            backend = _backends[name] = BACKENDS[kind](**settings)
+            logging.info('>    Local embedding model {} ({}, dimension {}) was loaded.'.format(name, kind, backend.dimension))
+    return backend
+
+def configure_local_embeddings(config):
+    """
+    Sets up the local embedding models from the 'LocalEmbedding' section of the configuration file.
+    Args:
+        config (dict): The settings of each model by name (without the ' (Local)' suffix), each with its
+                       'backend' ('hashed' or 'onnx') and the arguments of the backend, e.g. 'dimension'
+                       for 'hashed', and 'model_path' and 'tokenizer_path' for 'onnx'.
+    Returns:
+        list of str: The names of the local models, with their suffix.
+    """
+    with _backends_lock:
+        _models.clear()
+        _models.update({name: dict(settings) for name, settings in config.items()})
+        _backends.clear()
+    return local_embedding_names()
@@ -0,0 +1,39 @@
+from typing import Any, List
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from pydantic import PrivateAttr
+
+from local_embeddings import get_local_backend
+
+# Embedding models of LlamaIndex computed in the process. The backends, which do not depend on
+# LlamaIndex, are defined and configured in `local_embeddings`.
+
+
+class LocalEmbedding(BaseEmbedding):
+    """
+    An embedding model computed in the process by a local backend (see `local_embeddings`). Its
+    embeddings are not cached, since computing them is cheaper than looking them up.
+    Attributes:
+        model_name (str): The name of the local model, with its ' (Local)' suffix.
+    """
+    _backend: Any = PrivateAttr()
+
+    def __init__(self, model_name: str, embed_batch_size: int = 256, **kwargs: Any):
+        super().__init__(model_name=model_name, embed_batch_size=embed_batch_size, **kwargs)
+        self._backend = get_local_backend(model_name)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LocalEmbedding"
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._backend.embed([query])[0].tolist()
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._backend.embed([text])[0].tolist()
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._backend.embed(texts).tolist()
@@ -1,11 +1,27 @@
 import logging
-from application import launch_app
+import argparse
+from instrumentation import ImportProfiler
 
 if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Launches the web-based GUI.')
+    parser.add_argument('--fast-startup', action='store_true', 
+                        help='Serve the interface before importing LlamaIndex and loading the indices, which are loaded in the background.')
+    parser.add_argument('--profile-imports', action='store_true', 
+                        help='Log the import time of each package until the interface is served (saved to Data/logs/import-profile.json).')
+    args = parser.parse_args()
+
+    # Imports are measured from here until the interface is served
+    import_profiler = None
+    if args.profile_imports:
+        import_profiler = ImportProfiler()
+        import_profiler.start()
+
+    from application import launch_app
     
     # Configure logging
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     logging.info('Logging is configured.')
 
     # Launch the web-based GUI
-    launch_app()
\ No newline at end of file
+    launch_app(fast_startup=args.fast_startup, import_profiler=import_profiler)
@@ -0,0 +1,140 @@
+import re
+import time
+import zlib
+from typing import Any, List
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.base.llms.types import CompletionResponse, LLMMetadata
+from llama_index.core.llms.callbacks import llm_completion_callback
+from llama_index.core.llms.custom import CustomLLM
+
+_word_pattern = re.compile(r"\w+")
+
+
+def hash_embed(texts, embed_dim=1536):
+    """
+    Computes deterministic hashed embeddings of a batch of texts. Each word of a text is hashed into
+    one of `embed_dim` buckets with a hash-dependent sign, and the resulting vector is L2-normalized,
+    so texts sharing words get similar embeddings.
+    Args:
+        texts (list of str): The texts to embed.
+        embed_dim (int): The dimension of the embeddings.
+    Returns:
+        numpy.ndarray: A float32 array of shape (len(texts), embed_dim).
+    """
+    vectors = np.zeros((len(texts), embed_dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in _word_pattern.findall(text.lower()):
+            hashed = zlib.crc32(word.encode("utf-8"))
+            vectors[row, hashed % embed_dim] += 1.0 if (hashed >> 31) & 1 else -1.0
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class HashEmbedding(BaseEmbedding):
+    """
+    A deterministic, local stand-in for an embedding model, intended for benchmarks and load tests.
+    Texts are embedded with `hash_embed`.
+    Attributes:
+        embed_dim (int): The dimension of the embeddings. Defaults to 1536, the dimension of
+                         'OpenAI text-embedding-3-small', so existing collections can be queried.
+        latency (float): Artificial latency in seconds added to every embedding call.
+    """
+    embed_dim: int = 1536
+    latency: float = 0.0
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashEmbedding"
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        """
+        Computes the hashed embeddings of a batch of texts.
+        """
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return hash_embed(texts, self.embed_dim).tolist()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed([query])[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts)
+
+
+class CannedLLM(CustomLLM):
+    """
+    A deterministic, local stand-in for an LLM, intended for benchmarks and load tests.
+    It answers every prompt with the same canned response after a configurable latency.
+    Attributes:
+        response (str): The canned response.
+        latency (float): Artificial latency in seconds before the first token.
+        token_latency (float): Artificial latency in seconds for each streamed word of the response.
+        context_window (int): The context window reported in the metadata.
+        num_output (int): The number of output tokens reported in the metadata.
+    """
+    response: str = "[1] > [2] > [3] This is a canned answer generated without calling a language model."
+    latency: float = 0.0
+    token_latency: float = 0.0
+    context_window: int = 128000
+    num_output: int = 256
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CannedLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(
+            context_window=self.context_window,
+            num_output=self.num_output,
+            model_name="canned-llm"
+        )
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if self.token_latency > 0:
+            time.sleep(self.token_latency * len(self.response.split()))
+        return CompletionResponse(text=self.response)
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        def gen():
+            if self.latency > 0:
+                time.sleep(self.latency)
+            text = ""
+            for word in self.response.split(" "):
+                if self.token_latency > 0:
+                    time.sleep(self.token_latency)
+                delta = word if not text else " " + word
+                text += delta
+                yield CompletionResponse(text=text, delta=delta)
+        return gen()
+
+
+def create_mock_models(embed_dim=1536, llm_latency=0.0, token_latency=0.0, embedding_latency=0.0, response=None):
+    """
+    Creates a pair of local stand-in models.
+    Args:
+        embed_dim (int): The dimension of the embeddings.
+        llm_latency (float): Artificial latency in seconds of every LLM call.
+        token_latency (float): Artificial latency in seconds of every generated word.
+        embedding_latency (float): Artificial latency in seconds of every embedding call.
+        response (str, optional): The canned response of the LLM.
+    Returns:
+        tuple: The CannedLLM and the HashEmbedding.
+    """
+    llm_kwargs = {"latency": llm_latency, "token_latency": token_latency}
+    if response is not None:
+        llm_kwargs["response"] = response
+    return CannedLLM(**llm_kwargs), HashEmbedding(embed_dim=embed_dim, latency=embedding_latency)
@@ -0,0 +1,440 @@
+import re
+import json
+import math
+import time
+import uuid
+import base64
+import random
+import hashlib
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mock_models import hash_embed
+
+
+class LatencyModel:
+    """
+    A distribution of artificial response latencies.
+    Attributes:
+        kind (str): The kind of distribution: 'fixed', 'uniform', 'normal' or 'lognormal'.
+        mean_ms (float): The mean latency in milliseconds.
+        spread_ms (float): The spread of the latency in milliseconds (half-width for 'uniform',
+                           standard deviation for 'normal' and 'lognormal').
+    """
+
+    def __init__(self, kind='fixed', mean_ms=0.0, spread_ms=0.0):
+        if kind not in ['fixed', 'uniform', 'normal', 'lognormal']:
+            raise ValueError('Unsupported latency distribution: {}.'.format(kind))
+        self.kind = kind
+        self.mean_ms = mean_ms
+        self.spread_ms = spread_ms
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Parses a latency distribution written as 'kind:mean_ms[:spread_ms]', e.g. 'lognormal:800:300'.
+        A single number is a fixed latency in milliseconds.
+        """
+        parts = text.split(':')
+        if len(parts) == 1:
+            return cls('fixed', float(parts[0]))
+        return cls(parts[0], float(parts[1]), float(parts[2]) if len(parts) > 2 else 0.0)
+
+    def sample(self, rng):
+        """
+        Samples a latency in seconds.
+        """
+        if self.kind == 'fixed' or self.mean_ms <= 0:
+            value = self.mean_ms
+        elif self.kind == 'uniform':
+            value = rng.uniform(self.mean_ms - self.spread_ms, self.mean_ms + self.spread_ms)
+        elif self.kind == 'normal':
+            value = rng.gauss(self.mean_ms, self.spread_ms)
+        else:
+            # Parameters of the underlying normal distribution for the requested mean and deviation
+            sigma = math.sqrt(math.log(1.0 + (self.spread_ms / self.mean_ms) ** 2))
+            mu = math.log(self.mean_ms) - sigma ** 2 / 2
+            value = rng.lognormvariate(mu, sigma)
+        return max(0.0, value) / 1000.0
+
+
+class MockOpenAIState:
+    """
+    Configuration and statistics of the mock server, shared by all request handler threads.
+    Attributes:
+        chat_latency (LatencyModel): Latency before the first token of chat completions.
+        embedding_latency (LatencyModel): Latency of embedding requests.
+        token_latency_ms (float): Latency between streamed tokens in milliseconds.
+        rate_limit_rpm (int): Requests per minute accepted before answering with HTTP 429, or None.
+        error_rate (float): Probability of answering a request with HTTP 429 regardless of the rate limit.
+        response_words (int): Number of words of generated answers.
+        embed_dim (int): Default dimension of the embeddings.
+    """
+
+    def __init__(self, chat_latency, embedding_latency, token_latency_ms=0.0, rate_limit_rpm=None,
+                 error_rate=0.0, response_words=60, embed_dim=1536, seed=0):
+        self.chat_latency = chat_latency
+        self.embedding_latency = embedding_latency
+        self.token_latency_ms = token_latency_ms
+        self.rate_limit_rpm = rate_limit_rpm
+        self.error_rate = error_rate
+        self.response_words = response_words
+        self.embed_dim = embed_dim
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._request_times = []
+        self.stats = {"chat_completions": 0, "embeddings": 0, "embedded_texts": 0, "rate_limited": 0, "in_flight": 0, "max_in_flight": 0}
+
+    def sample_latency(self, latency_model):
+        with self._lock:
+            return latency_model.sample(self._rng)
+
+    def admit(self):
+        """
+        Decides whether a request is accepted or rate limited.
+        Returns:
+            bool: True if the request is accepted.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.error_rate > 0 and self._rng.random() < self.error_rate:
+                self.stats["rate_limited"] += 1
+                return False
+            if self.rate_limit_rpm:
+                self._request_times = [t for t in self._request_times if now - t < 60.0]
+                if len(self._request_times) >= self.rate_limit_rpm:
+                    self.stats["rate_limited"] += 1
+                    return False
+                self._request_times.append(now)
+            return True
+
+    def count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+
+
+def approximate_tokens(text):
+    """
+    Approximates the number of tokens of a text (about four characters per token).
+    """
+    return max(1, len(text) // 4)
+
+def message_text(message):
+    """
+    Returns the text content of a chat message, which may be a string or a list of content parts.
+    """
+    content = message.get('content') or ''
+    if isinstance(content, list):
+        return ' '.join(part.get('text', '') for part in content if isinstance(part, dict))
+    return content
+
+def fill_schema(schema, definitions, context):
+    """
+    Builds a minimal deterministic value that is valid for a JSON schema, used as the arguments of tool calls.
+    Args:
+        schema (dict): The JSON schema.
+        definitions (dict): The '$defs' of the root schema, for resolving references.
+        context (dict): Values for string fields: 'question' (the user question) and 'tool_name'
+                        (the first tool named in the prompt).
+    Returns:
+        The generated value.
+    """
+    if '$ref' in schema:
+        schema = definitions.get(schema['$ref'].split('/')[-1], {})
+    if 'anyOf' in schema:
+        schema = schema['anyOf'][0]
+    if 'enum' in schema:
+        return schema['enum'][0]
+    kind = schema.get('type', 'object')
+    if kind == 'object':
+        properties = schema.get('properties', {})
+        return {name: fill_schema(prop, definitions, dict(context, field=name)) for name, prop in properties.items()}
+    if kind == 'array':
+        return [fill_schema(schema.get('items', {}), definitions, context)]
+    if kind == 'integer':
+        return 1
+    if kind == 'number':
+        return 1.0
+    if kind == 'boolean':
+        return True
+    field = context.get('field', '')
+    if field == 'tool_name' and context.get('tool_name'):
+        return context['tool_name']
+    if 'question' in field or field in ['input', 'query']:
+        return context.get('question', '')
+    return 'mock {}'.format(field).strip()
+
+def generate_reply(messages, tools, response_words):
+    """
+    Generates a deterministic reply to a chat completion request.
+    The reply depends on the kind of prompt, so that the application pipeline keeps working:
+    RankGPT prompts get a ranking, ReAct prompts get a tool call followed by an answer, requests
+    with tools get a tool call whose arguments follow the tool's schema, and other prompts get an
+    answer that is derived from a hash of the prompt.
+    Args:
+        messages (list of dict): The chat messages of the request.
+        tools (list of dict): The tools of the request, if any.
+        response_words (int): The number of words of generated answers.
+    Returns:
+        tuple: The content (str or None) and the tool calls (list or None) of the reply.
+    """
+    prompt = '\n'.join(message_text(message) for message in messages)
+    digest = hashlib.sha256(json.dumps(messages, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    user_messages = [message_text(message) for message in messages if message.get('role') == 'user']
+    question = user_messages[-1] if user_messages else ''
+
+    # RankGPT reranking prompt: keep the original order
+    rank_match = re.search(r'Rank the (\d+) passages', prompt)
+    if rank_match:
+        return ' > '.join('[{}]'.format(i + 1) for i in range(int(rank_match.group(1)))), None
+
+    answer_words = ['Mock', 'answer', digest[:8] + ':']
+    filler = re.findall(r'\w+', question) or ['answer']
+    while len(answer_words) < response_words:
+        answer_words.append(filler[len(answer_words) % len(filler)])
+    answer = ' '.join(answer_words)
+
+    # ReAct agent prompt: call the first tool once, then answer
+    tool_names = re.findall(r'> Tool Name: (\S+)', prompt)
+    if tool_names:
+        observations = [message for message in messages if message.get('role') != 'system' and message_text(message).startswith('Observation:')]
+        if observations:
+            return 'Thought: I can answer without using any more tools.\nAnswer: {}'.format(answer), None
+        return 'Thought: I need to use a tool to help me answer the question.\nAction: {}\nAction Input: {}'.format(
+            tool_names[0], json.dumps({"input": question})), None
+
+    # Function calling, e.g. router selection and sub-question generation
+    if tools:
+        function = tools[0].get('function', {})
+        parameters = function.get('parameters', {})
+        named_tools = re.findall(r'"([\w\-]+)": "', prompt)
+        context = {"question": question, "tool_name": named_tools[0] if named_tools else None}
+        arguments = fill_schema(parameters, parameters.get('$defs', parameters.get('definitions', {})), context)
+        tool_call = {
+            "id": "call_" + digest[:24],
+            "type": "function",
+            "function": {"name": function.get('name', 'tool'), "arguments": json.dumps(arguments)}
+        }
+        return None, [tool_call]
+
+    return answer, None
+
+
+class MockOpenAIRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the chat completions and embeddings endpoints of the OpenAI API.
+    """
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, format, *args):
+        logging.debug('>    Mock OpenAI server: ' + format % args)
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_rate_limit_error(self):
+        self._send_json(429, {"error": {
+            "message": "Rate limit reached for requests (mock server).",
+            "type": "requests",
+            "param": None,
+            "code": "rate_limit_exceeded"
+        }}, headers={"retry-after": "1"})
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path.endswith('/models'):
+            self._send_json(200, {"object": "list", "data": [
+                {"id": model, "object": "model", "owned_by": "mock"} for model in ['gpt-4o-mini', 'gpt-4o', 'text-embedding-3-small']]})
+        elif path.endswith('/stats'):
+            with self.state._lock:
+                stats = dict(self.state.stats)
+            self._send_json(200, stats)
+        else:
+            self._send_json(404, {"error": {"message": "Not found.", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        path = self.path.split('?')[0].rstrip('/')
+        try:
+            request = self._read_json()
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"message": "Invalid JSON body.", "type": "invalid_request_error"}})
+            return
+
+        if not self.state.admit():
+            self._send_rate_limit_error()
+            return
+
+        self.state.count("in_flight")
+        try:
+            if path.endswith('/chat/completions'):
+                self._chat_completions(request)
+            elif path.endswith('/embeddings'):
+                self._embeddings(request)
+            else:
+                self._send_json(404, {"error": {"message": "Not found.", "type": "invalid_request_error"}})
+        finally:
+            self.state.count("in_flight", -1)
+
+    def _chat_completions(self, request):
+        self.state.count("chat_completions")
+        messages = request.get('messages', [])
+        content, tool_calls = generate_reply(messages, request.get('tools'), self.state.response_words)
+        model = request.get('model', 'gpt-4o-mini')
+        completion_id = 'chatcmpl-' + uuid.uuid4().hex[:24]
+        created = int(time.time())
+        prompt_tokens = approximate_tokens(json.dumps(messages))
+        completion_tokens = approximate_tokens(content or json.dumps(tool_calls))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+        time.sleep(self.state.sample_latency(self.state.chat_latency))
+
+        if not request.get('stream'):
+            message = {"role": "assistant", "content": content}
+            if tool_calls:
+                message["tool_calls"] = tool_calls
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}],
+                "usage": usage
+            })
+            return
+
+        # Server-sent events, one chunk per word
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        def send_chunk(delta, finish_reason=None, include_usage=False):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            }
+            if include_usage:
+                chunk["usage"] = usage
+            self.wfile.write('data: {}\n\n'.format(json.dumps(chunk)).encode('utf-8'))
+            self.wfile.flush()
+
+        send_chunk({"role": "assistant", "content": ""})
+        if tool_calls:
+            send_chunk({"tool_calls": [dict(tool_call, index=i) for i, tool_call in enumerate(tool_calls)]})
+        else:
+            words = content.split(' ')
+            for i, word in enumerate(words):
+                if self.state.token_latency_ms > 0:
+                    time.sleep(self.state.token_latency_ms / 1000.0)
+                send_chunk({"content": word if i == 0 else ' ' + word})
+        send_chunk({}, finish_reason="tool_calls" if tool_calls else "stop",
+                   include_usage=bool(request.get('stream_options', {}).get('include_usage')))
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+        self.close_connection = True
+
+    def _embeddings(self, request):
+        inputs = request.get('input', [])
+        if not isinstance(inputs, list) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        texts = [text if isinstance(text, str) else ' '.join(str(token) for token in text) for text in inputs]
+        self.state.count("embeddings")
+        self.state.count("embedded_texts", len(texts))
+
+        time.sleep(self.state.sample_latency(self.state.embedding_latency))
+
+        vectors = hash_embed(texts, int(request.get('dimensions') or self.state.embed_dim))
+        data = []
+        for i, vector in enumerate(vectors):
+            if request.get('encoding_format') == 'base64':
+                embedding = base64.b64encode(vector.astype('<f4').tobytes()).decode('ascii')
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(approximate_tokens(text) for text in texts)
+        self._send_json(200, {
+            "object": "list",
+            "data": data,
+            "model": request.get('model', 'text-embedding-3-small'),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+        })
+
+
+def start_mock_openai_server(host='127.0.0.1', port=8765, state=None):
+    """
+    Starts the mock OpenAI server in a daemon thread.
+    Args:
+        host (str): The host to bind to.
+        port (int): The port to bind to. Use 0 to pick a free port.
+        state (MockOpenAIState, optional): Configuration of the server. Defaults to no latency and no errors.
+    Returns:
+        tuple: The server and the base URL to pass as `api_base` to the OpenAI clients.
+    """
+    if state is None:
+        state = MockOpenAIState(chat_latency=LatencyModel(), embedding_latency=LatencyModel())
+    handler = type('ConfiguredMockOpenAIRequestHandler', (MockOpenAIRequestHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='mock-openai-server', daemon=True)
+    thread.start()
+    base_url = 'http://{}:{}/v1'.format(host, server.server_address[1])
+    logging.info('>    Mock OpenAI server is served on {}'.format(base_url))
+    return server, base_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local OpenAI-compatible stand-in server for load and latency testing.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--chat-latency', default='0', help="Latency of chat completions: 'ms' or 'kind:mean_ms[:spread_ms]' with kind fixed/uniform/normal/lognormal.")
+    parser.add_argument('--embedding-latency', default='0', help='Latency of embedding requests, in the same format as --chat-latency.')
+    parser.add_argument('--token-latency-ms', type=float, default=0.0, help='Delay between streamed words.')
+    parser.add_argument('--rate-limit-rpm', type=int, default=None, help='Requests per minute accepted before answering with HTTP 429.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability of answering a request with HTTP 429.')
+    parser.add_argument('--response-words', type=int, default=60, help='Number of words of generated answers.')
+    parser.add_argument('--embed-dim', type=int, default=1536, help='Default dimension of the embeddings.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the latency and error sampling.')
+    args = parser.parse_args()
+
+    state = MockOpenAIState(
+        chat_latency=LatencyModel.parse(args.chat_latency),
+        embedding_latency=LatencyModel.parse(args.embedding_latency),
+        token_latency_ms=args.token_latency_ms,
+        rate_limit_rpm=args.rate_limit_rpm,
+        error_rate=args.error_rate,
+        response_words=args.response_words,
+        embed_dim=args.embed_dim,
+        seed=args.seed
+    )
+    server, _ = start_mock_openai_server(host=args.host, port=args.port, state=state)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+
+    # Configure logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    main()
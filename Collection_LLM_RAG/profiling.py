@@ -0,0 +1,260 @@
+import os
+import sys
+import time
+import uuid
+import pstats
+import logging
+import cProfile
+import functools
+import threading
+import tracemalloc
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+
+# This module only depends on the standard library. Profiling is off unless it is enabled in the
+# 'Profiling' section of the configuration, by the RAG_PROFILE environment variable, or for a single
+# request; when it is off, a profiled function only pays for reading a setting and a context variable.
+
+_settings = {
+    "enabled": False,
+    "mode": "sampling",
+    "directory": "Data/profiles",
+    "sample_interval_ms": 5,
+    "tracemalloc": False,
+    "top_allocations": 25
+}
+
+# Whether the request being answered in this thread (or asyncio task) asked to be profiled
+_requested = contextvars.ContextVar('profile_requested', default=False)
+
+# Whether a profile is already being recorded in this context, so nested profiled functions are not profiled twice
+_active = contextvars.ContextVar('profile_active', default=False)
+
+# Innermost frames of threads that are waiting for work, which are not sampled
+_idle_frames = {
+    ('threading.py', 'wait'),
+    ('queue.py', 'get'),
+    ('thread.py', '_worker'),
+    ('selectors.py', 'select'),
+    ('socket.py', 'accept')
+}
+
+# tracemalloc is process wide, so it is only stopped when the last profile that started it ends
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+
+class StackSampler:
+    """
+    A sampling profiler that records the stacks of the threads of the process at a fixed interval, in
+    the folded format of flamegraph.pl and speedscope ('thread;outer function;...;inner function count').
+    All threads are sampled, since the work of a request is spread over worker threads, so the samples
+    of concurrent requests are included too; the thread names tell them apart. Threads waiting for work
+    (in a lock, a queue or a select) are skipped.
+    Attributes:
+        interval (float): The time between two samples in seconds.
+    Methods:
+        start():
+        stop():
+        folded():
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._stacks = Counter()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own_ident = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident or (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in _idle_frames:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                if ident not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack.append(names.get(ident, 'thread-{}'.format(ident)))
+                self._stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        """
+        Starts sampling in a background thread.
+        """
+        self._thread = threading.Thread(target=self._sample, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops sampling.
+        """
+        self._stop_event.set()
+        self._thread.join()
+
+    def folded(self):
+        """
+        Returns the sampled stacks in the folded format, one 'stack count' line per distinct stack.
+        """
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in self._stacks.most_common())
+
+
+def profiling_enabled():
+    """
+    Returns whether the current call should be profiled.
+    """
+    return (_settings["enabled"] or _requested.get()) and not _active.get()
+
+
+@contextmanager
+def profile_request(enabled=True):
+    """
+    Profiles the profiled functions called inside the block, e.g. for one request of the HTTP API.
+    Args:
+        enabled (bool): Whether the request is profiled. Defaults to True.
+    """
+    token = _requested.set(bool(enabled))
+    try:
+        yield
+    finally:
+        _requested.reset(token)
+
+
+def _start_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and tracemalloc.is_tracing():
+            # Started by someone else (e.g. PYTHONTRACEMALLOC), who will stop it
+            _tracemalloc_users = -1
+        if _tracemalloc_users >= 0:
+            if _tracemalloc_users == 0:
+                # One frame per allocation is enough for the allocation sites, and much cheaper
+                tracemalloc.start()
+            _tracemalloc_users += 1
+    return tracemalloc.take_snapshot()
+
+def _stop_tracemalloc():
+    global _tracemalloc_users
+    snapshot = tracemalloc.take_snapshot()
+    with _tracemalloc_lock:
+        if _tracemalloc_users > 0:
+            _tracemalloc_users -= 1
+            if _tracemalloc_users == 0:
+                tracemalloc.stop()
+    return snapshot
+
+def _allocation_report(before, after, top):
+    """
+    Returns the allocation sites whose memory grew the most between two tracemalloc snapshots, as text.
+    """
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    statistics = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+    lines = ['Top {} allocation sites by growth:'.format(top)]
+    for statistic in statistics[:top]:
+        lines.append(str(statistic))
+    total = sum(statistic.size_diff for statistic in statistics)
+    lines.append('Total growth: {:.1f} KiB'.format(total / 1024))
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def profile(name):
+    """
+    Profiles the block with the configured profiler and writes the results to the profile directory:
+    '<name>.folded' (sampling mode) or '<name>.prof' and '<name>.txt' (deterministic mode, with cProfile,
+    which only profiles the calling thread), and '<name>.allocations.txt' if tracemalloc snapshots are enabled.
+    Args:
+        name (str): The name of the profiled operation, used in the names of the files.
+    Yields:
+        str: The path of the files without their extension.
+    """
+    os.makedirs(_settings["directory"], exist_ok=True)
+    base_path = os.path.join(_settings["directory"], '{}-{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), name, uuid.uuid4().hex[:8]))
+    token = _active.set(True)
+
+    snapshot = _start_tracemalloc() if _settings["tracemalloc"] else None
+    profiler = None
+    sampler = None
+    if _settings["mode"] == "deterministic":
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Another profiler is active in this thread
+            logging.warning('>    {} is not profiled: {}'.format(name, e))
+            profiler = None
+    else:
+        sampler = StackSampler(interval=_settings["sample_interval_ms"] / 1000)
+        sampler.start()
+
+    start = time.perf_counter()
+    try:
+        yield base_path
+    finally:
+        duration = time.perf_counter() - start
+        _active.reset(token)
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(base_path + '.prof')
+            with open(base_path + '.txt', 'w') as file:
+                pstats.Stats(profiler, stream=file).sort_stats('cumulative').print_stats(60)
+        if sampler is not None:
+            sampler.stop()
+            with open(base_path + '.folded', 'w') as file:
+                file.write(sampler.folded())
+        if snapshot is not None:
+            with open(base_path + '.allocations.txt', 'w') as file:
+                file.write(_allocation_report(snapshot, _stop_tracemalloc(), _settings["top_allocations"]))
+        logging.info('>    Profile of {} ({:.2f} s) saved to {}.*'.format(name, duration, base_path))
+
+
+def profiled(name):
+    """
+    Decorator that profiles a function when profiling is enabled for the process or for the current request.
+    Args:
+        name (str): The name of the profiled operation.
+    Returns:
+        callable: The decorator.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiling_enabled():
+                return function(*args, **kwargs)
+            with profile(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def configure_profiling(config):
+    """
+    Sets up profiling from the 'Profiling' section of the configuration file. The RAG_PROFILE environment
+    variable overrides 'enabled' ('1' or a mode name enables profiling, with that mode if it is one), and
+    RAG_PROFILE_DIR overrides 'directory'.
+    Args:
+        config (dict): The configuration, with 'enabled', 'mode' ('sampling' or 'deterministic'), 'directory',
+                       'sample_interval_ms', 'tracemalloc' and 'top_allocations'.
+    Returns:
+        dict: The settings.
+    """
+    _settings.update({key: value for key, value in config.items() if key in _settings})
+
+    environment = os.environ.get('RAG_PROFILE', '').strip().lower()
+    if environment:
+        _settings["enabled"] = environment not in ('0', 'false', 'no', 'off')
+        if environment in ('sampling', 'deterministic'):
+            _settings["mode"] = environment
+    if os.environ.get('RAG_PROFILE_DIR'):
+        _settings["directory"] = os.environ['RAG_PROFILE_DIR']
+
+    if _settings["mode"] not in ('sampling', 'deterministic'):
+        raise ValueError('Unknown profiling mode: {}.'.format(_settings["mode"]))
+    if _settings["enabled"]:
+        logging.info('>    Requests are profiled ({}) to {}.'.format(_settings["mode"], _settings["directory"]))
+    return dict(_settings)
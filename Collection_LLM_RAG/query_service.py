@@ -0,0 +1,314 @@
+import time
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from llama_index.core import QueryBundle
+
+from knowledgeBase.collection import CollectionManager
+from knowledgeBase.synthesis import create_response_synthesizer
+from user_agent import UserAgent, SUPPORTED_MODES, CatalogWatcher
+from utils import collect_references
+from instrumentation import span, trace_query
+from embedding_memo import request_scope
+from profiling import profile_request
+from trace_callbacks import trace_callback_manager
+
+
+def format_references(references):
+    """
+    Converts references to JSON serializable dictionaries.
+    Args:
+        references (list): A list of tuples ((name, link), score), as returned by `UserAgent.query`.
+    Returns:
+        list of dict: One dictionary with 'name', 'link' and 'score' per reference.
+    """
+    return [{"name": name, "link": link, "score": score} for (name, link), score in references]
+
+
+class QueryService:
+    """
+    Answers queries without the Gradio interface, for the HTTP API and other programmatic callers.
+    Agents are created once for every combination of mode and collections and kept in a pool, so a
+    request only borrows an agent that is already set up. Agents are never used by two requests at
+    the same time, because ReAct agents keep a chat memory, which is reset before every request.
+    All agents share the indices loaded by the collection manager. When the list of collections changes
+    on disk, the agents and indices of the collections that were deleted or built again are dropped
+    before the next request, so a long-running service follows the collections without a restart.
+    Attributes:
+        openAI_api (str): The API key for accessing OpenAI services.
+        llm_name (str): The name of the language model.
+        embedding_name (str): The name of the embedding model.
+        default_mode (str): The mode used when a request does not specify one.
+        collection_manager (CollectionManager): The manager of the collections.
+        max_batch_concurrency (int): Maximum number of questions of a batch answered at the same time.
+        context_token_budget (int): Maximum number of tokens of the retrieved context of a collection sent to the LLM.
+        synthesis_mode (str): How answers are synthesized: "single_call" or a response mode of LlamaIndex.
+        max_prompt_tokens (int): Maximum number of tokens of the synthesis prompt in "single_call" mode.
+        adaptive_retrieval (dict): The 'AdaptiveRetrieval' configuration, which chooses the retrieval depth per query.
+        reranking (dict): The 'Reranking' configuration: window size, passage length and parallelism of the reranker.
+    Methods:
+        list_collections():
+        refresh_catalog(force=False):
+        preload_collections(collections=None):
+        query(question, mode=None, collections=None, profile=False):
+        batch_query(questions, mode=None, collections=None, max_concurrency=None):
+        stream_query(question, collections=None):
+    """
+
+    def __init__(self, openAI_api, llm_name, embedding_name, default_mode, api_base=None, collection_manager=None,
+                 subquestion_max_parallel=4, subquestion_timeout=60, max_batch_concurrency=8, context_token_budget=3000,
+                 synthesis_mode="single_call", max_prompt_tokens=None, adaptive_retrieval=None,
+                 reranking=None):
+        self.openAI_api = openAI_api
+        self.llm_name = llm_name
+        self.embedding_name = embedding_name
+        self.default_mode = default_mode
+        self.api_base = api_base
+        self.collection_manager = collection_manager if collection_manager is not None else CollectionManager()
+        self.subquestion_max_parallel = subquestion_max_parallel
+        self.subquestion_timeout = subquestion_timeout
+        self.max_batch_concurrency = max_batch_concurrency
+        self.context_token_budget = context_token_budget
+        self.synthesis_mode = synthesis_mode
+        self.max_prompt_tokens = max_prompt_tokens
+        self.adaptive_retrieval = adaptive_retrieval
+        self.reranking = reranking
+
+        # Idle agents for each (mode, collections) combination
+        self._agent_pools = {}
+        self._agent_pools_lock = threading.Lock()
+        self._agent_generation = 0
+
+        # Drops the query engines and indices of the collections that change on disk
+        self._catalog_watcher = CatalogWatcher(self.collection_manager)
+
+        # Models used for streaming queries, whose hybrid query engines are the shared ones of the agents
+        self._stream_models = self._create_agent(mode=default_mode, query_engines_details=[])
+
+    def list_collections(self):
+        """
+        Returns the collections that can be queried.
+        Returns:
+            list of dict: The name, description and embedding model of each collection.
+        """
+        return self.collection_manager.get_query_engines_detail()
+
+    def refresh_catalog(self, force=False):
+        """
+        Drops the query engines and indices of the collections that were deleted, changed or built again since
+        the list of collections was last checked, and the idle agents. Indices of the other collections are kept.
+        Args:
+            force (bool, optional): Whether the collections are compared even if the list of collections
+                                    has the same modification time. Defaults to False.
+        Returns:
+            list of str: The names of the collections whose query engines and indices were dropped.
+        """
+        changed = self._catalog_watcher.refresh(force=force)
+        if changed:
+            # Agents are cheap to create again, unlike the indices of the unchanged collections. Agents
+            # borrowed by running requests belong to the previous generation and are not returned.
+            with self._agent_pools_lock:
+                self._agent_pools = {}
+                self._agent_generation += 1
+        return changed
+
+    def preload_collections(self, collections=None):
+        """
+        Loads the indices of collections, so that the first queries do not wait for them.
+        Args:
+            collections (list of str, optional): The names of the collections. Defaults to all collections.
+        Raises:
+            ValueError: If a collection does not exist.
+        """
+        for details in self._resolve_collections(collections):
+            self.collection_manager.preload_collection(details['name'])
+
+    def _resolve_collections(self, collections):
+        """
+        Returns the details of the requested collections, or of all collections if none are requested.
+        Raises:
+            ValueError: If a requested collection does not exist.
+        """
+        if not collections:
+            return self.collection_manager.get_query_engines_detail()
+        details = self.collection_manager.get_query_engines_detail_by_name(collections)
+        unknown = set(collections) - {detail['name'] for detail in details}
+        if unknown:
+            raise ValueError('Unknown collection(s): {}.'.format(', '.join(sorted(unknown))))
+        return details
+
+    def _create_agent(self, mode, query_engines_details):
+        """
+        Creates a UserAgent with the models of the service.
+        """
+        return UserAgent(
+            llm_name=self.llm_name,
+            embedding_name=self.embedding_name,
+            openAI_api=self.openAI_api,
+            mode=mode,
+            query_engines_details=query_engines_details,
+            subquestion_max_parallel=self.subquestion_max_parallel,
+            subquestion_timeout=self.subquestion_timeout,
+            api_base=self.api_base,
+            context_token_budget=self.context_token_budget,
+            synthesis_mode=self.synthesis_mode,
+            max_prompt_tokens=self.max_prompt_tokens,
+            adaptive_retrieval=self.adaptive_retrieval,
+            reranking=self.reranking
+        )
+
+    def _acquire_agent(self, mode, query_engines_details):
+        """
+        Takes an idle agent of the pool of the given mode and collections, or creates a new one.
+        """
+        with self._agent_pools_lock:
+            key = (self._agent_generation, mode, tuple(sorted(detail['name'] for detail in query_engines_details)))
+            pool = self._agent_pools.setdefault(key, [])
+            if pool:
+                return key, pool.pop()
+
+        with span("api.create_agent", mode=mode, num_query_engines=len(query_engines_details)):
+            agent = self._create_agent(mode=mode, query_engines_details=query_engines_details)
+            agent.set_agent(query_engines_details=query_engines_details)
+        return key, agent
+
+    def _release_agent(self, key, agent):
+        """
+        Returns an agent to its pool, unless the collections changed since it was taken.
+        """
+        with self._agent_pools_lock:
+            if key[0] == self._agent_generation:
+                self._agent_pools.setdefault(key, []).append(agent)
+
+    def query(self, question, mode=None, collections=None, profile=False):
+        """
+        Answers a question.
+        Args:
+            question (str): The question.
+            mode (str, optional): The mode of the agent. Defaults to the default mode of the service.
+            collections (list of str, optional): The names of the collections to use. Defaults to all collections.
+            profile (bool, optional): Whether the answer is profiled, even if profiling is disabled (see `profiling`). Defaults to False.
+        Returns:
+            dict: The answer, its references (name, link and score) and the latency in milliseconds.
+        Raises:
+            ValueError: If the mode or a collection is not supported, or no collection is available.
+        """
+        start = time.perf_counter()
+        self.refresh_catalog()
+        mode = mode or self.default_mode
+        if mode not in SUPPORTED_MODES:
+            raise ValueError('Selected mode is not supported.')
+        query_engines_details = self._resolve_collections(collections)
+        if mode != "ReAct: Query Engines & Internet" and len(query_engines_details) == 0:
+            raise ValueError('Please select one or more query engines to answer your queries.')
+
+        key, agent = self._acquire_agent(mode=mode, query_engines_details=query_engines_details)
+        try:
+            agent.reset_memory()
+            with profile_request(profile):
+                answer, references = agent.query(question)
+        finally:
+            self._release_agent(key, agent)
+
+        return {
+            "question": question,
+            "answer": answer,
+            "references": format_references(references),
+            "mode": mode,
+            "collections": [detail['name'] for detail in query_engines_details],
+            "latency_ms": (time.perf_counter() - start) * 1000
+        }
+
+    def batch_query(self, questions, mode=None, collections=None, max_concurrency=None):
+        """
+        Answers several questions concurrently. A failing question does not stop the others.
+        Args:
+            questions (list of str): The questions.
+            mode (str, optional): The mode of the agent. Defaults to the default mode of the service.
+            collections (list of str, optional): The names of the collections to use. Defaults to all collections.
+            max_concurrency (int, optional): Maximum number of questions answered at the same time.
+                                             Limited to `max_batch_concurrency`.
+        Returns:
+            list of dict: The result of `query` for each question, in the same order, or a dictionary
+                          with the question and an 'error' message if it could not be answered.
+        """
+        max_concurrency = min(max_concurrency or self.max_batch_concurrency, self.max_batch_concurrency)
+
+        def answer(question):
+            try:
+                return self.query(question=question, mode=mode, collections=collections)
+            except Exception as e:
+                logging.error('>    Batch question could not be answered: {}'.format(e))
+                return {"question": question, "error": str(e)}
+
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, answer, question) for question in questions]
+            return [future.result() for future in futures]
+
+    def stream_query(self, question, collections=None):
+        """
+        Answers a question from the given collections and streams the answer. The nodes are retrieved and
+        reranked in every collection concurrently, and a single streamed response is synthesized from them.
+        Args:
+            question (str): The question.
+            collections (list of str, optional): The names of the collections to use. Defaults to all collections.
+        Returns:
+            tuple: A generator of the text deltas of the answer, and the references of the answer as a list of
+                   dictionaries with 'name', 'link' and 'score'.
+        Raises:
+            ValueError: If a collection does not exist or no collection is available.
+        """
+        self.refresh_catalog()
+        query_engines_details = self._resolve_collections(collections)
+        if len(query_engines_details) == 0:
+            raise ValueError('Please select one or more query engines to answer your queries.')
+
+        # The answer is generated while the caller consumes the tokens, possibly from other threads, so the
+        # trace and the request scope stay open until the last token. Every step of the generator runs in the
+        # same context, in which they are opened and closed.
+        context = contextvars.copy_context()
+        answer = self._stream_answer(question, query_engines_details)
+        references = context.run(next, answer)
+
+        def tokens():
+            try:
+                while True:
+                    try:
+                        token = context.run(next, answer)
+                    except StopIteration:
+                        return
+                    yield token
+            finally:
+                context.run(answer.close)
+
+        return tokens(), references
+
+    def _stream_answer(self, question, query_engines_details):
+        """
+        Retrieves the nodes of a streaming query and synthesizes its answer. Yields the references first,
+        then the text deltas of the answer.
+        """
+        with trace_query("query.stream", llm=self.llm_name, num_query_engines=len(query_engines_details)), request_scope():
+            query_bundle = QueryBundle(question)
+            query_engines = [self._stream_models.query_engine(details) for details in query_engines_details]
+            if any(query_engine is None for query_engine in query_engines):
+                raise ValueError('A query engine could not be loaded.')
+            with ThreadPoolExecutor(max_workers=len(query_engines)) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, query_engine.retrieve, query_bundle)
+                           for query_engine in query_engines]
+                source_nodes = [node for future in futures for node in future.result()]
+            source_nodes.sort(key=lambda node: node.score if node.score is not None else 0, reverse=True)
+
+            synthesizer = create_response_synthesizer(
+                llm=self._stream_models.model_llm,
+                synthesis_mode=self.synthesis_mode,
+                max_prompt_tokens=self.max_prompt_tokens,
+                streaming=True,
+                callback_manager=trace_callback_manager
+            )
+            response = synthesizer.synthesize(query=query_bundle, nodes=source_nodes)
+
+            yield format_references(collect_references(source_nodes))
+            yield from response.response_gen
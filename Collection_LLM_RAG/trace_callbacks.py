@@ -0,0 +1,112 @@
+import time
+import threading
+
+from llama_index.core import Settings
+from llama_index.core.callbacks import CallbackManager, CBEventType, EventPayload
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.callbacks.token_counting import get_tokens_from_response
+from llama_index.core.utils import get_tokenizer
+from llama_index.core.selectors import PydanticMultiSelector
+
+from instrumentation import metrics_registry, current_trace, span
+
+
+class TraceCallbackHandler(BaseCallbackHandler):
+    """
+    A LlamaIndex callback handler that turns LLM calls, embedding calls, response synthesis,
+    sub-questions, tool calls and agent steps into spans, and counts LLM and embedding tokens.
+    """
+
+    # LlamaIndex events recorded as spans, and the name of their stage
+    stage_names = {
+        CBEventType.LLM: "llm",
+        CBEventType.EMBEDDING: "embedding",
+        CBEventType.SYNTHESIZE: "synthesize",
+        CBEventType.SUB_QUESTION: "sub_question",
+        CBEventType.FUNCTION_CALL: "tool_call",
+        CBEventType.AGENT_STEP: "agent_step",
+    }
+
+    def __init__(self):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self._starts = {}
+        self._lock = threading.Lock()
+        self._tokenizer = None
+
+    def _count_tokens(self, texts):
+        """
+        Counts the tokens of the given texts with the default LlamaIndex tokenizer.
+        """
+        if self._tokenizer is None:
+            self._tokenizer = get_tokenizer()
+        return sum(len(self._tokenizer(str(text))) for text in texts)
+
+    def on_event_start(self, event_type, payload=None, event_id="", parent_id="", **kwargs):
+        if event_type in self.stage_names:
+            with self._lock:
+                self._starts[event_id] = time.perf_counter()
+        return event_id
+
+    def on_event_end(self, event_type, payload=None, event_id="", **kwargs):
+        if event_type not in self.stage_names:
+            return
+        with self._lock:
+            start = self._starts.pop(event_id, None)
+        if start is None:
+            return
+        duration_ms = (time.perf_counter() - start) * 1000
+        payload = payload or {}
+
+        counters = {}
+        if event_type == CBEventType.LLM:
+            response = payload.get(EventPayload.RESPONSE, payload.get(EventPayload.COMPLETION))
+            prompt_tokens, completion_tokens = (0, 0)
+            if response is not None and hasattr(response, 'raw'):
+                prompt_tokens, completion_tokens = get_tokens_from_response(response)
+            counters = {"llm_calls": 1, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+        elif event_type == CBEventType.EMBEDDING:
+            chunks = payload.get(EventPayload.CHUNKS, [])
+            counters = {"embedding_calls": 1, "embedded_texts": len(chunks), "embedding_tokens": self._count_tokens(chunks)}
+
+        stage = self.stage_names[event_type]
+        metrics_registry.observe(stage, duration_ms, **counters)
+        trace = current_trace()
+        if trace is not None:
+            trace.add_span(stage, start, duration_ms, **counters)
+            if counters:
+                trace.add_counters(**counters)
+
+    def __deepcopy__(self, memo):
+        # The handler only writes to the shared registry, so copies of models share it
+        return self
+
+    def start_trace(self, trace_id=None):
+        return None
+
+    def end_trace(self, trace_id=None, trace_map=None):
+        return None
+
+
+class TracedPydanticMultiSelector(PydanticMultiSelector):
+    """
+    A PydanticMultiSelector that records the router selection as a traced stage.
+    """
+
+    def _select(self, choices, query):
+        with span("router.select", num_choices=len(choices)):
+            return super()._select(choices, query)
+
+
+# Shared callback manager passed to the LLMs, embedding models, query engines and agents.
+trace_callback_manager = CallbackManager([TraceCallbackHandler()])
+
+
+def register_trace_callbacks():
+    """
+    Registers the tracing callback manager as the LlamaIndex default. LlamaIndex replaces the callback
+    manager of models with `Settings.callback_manager` when they are attached to an index, so the
+    programs that build or load indices call it once at startup.
+    Returns:
+        None
+    """
+    Settings.callback_manager = trace_callback_manager
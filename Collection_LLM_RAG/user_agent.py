@@ -1,18 +1,141 @@
+import copy
+import json
 import logging
-from llama_index.llms.openai import OpenAI
-from llama_index.embeddings.openai import OpenAIEmbedding 
-from llama_index.core.agent.react import ReActAgent
-from llama_index.core.tools import QueryEngineTool
-from llama_index.core.memory import ChatMemoryBuffer
-from llama_index.core.query_engine import RouterQueryEngine
-from llama_index.core.selectors import PydanticMultiSelector
-from llama_index.core.query_engine import SubQuestionQueryEngine
-from llama_index.core.tools import FunctionTool
-from openai import AuthenticationError
-
-from knowledgeBase.hybrid_query_engine import load_hybrid_query_engine
-from utils import sort_dict_by_values, internet_search
+import weakref
+import threading
+from collections import OrderedDict
+
+from utils import collect_references, internet_search
 from prompts import default_prompt
+from instrumentation import trace_query, object_size
+from embedding_memo import request_scope
+from profiling import profiled
+from call_cache import credential_fingerprint
+
+# LlamaIndex and OpenAI are imported when the models and the agent are first set, so that the
+# interface can be built (and served) without importing them.
+
+# Modes in which the agent can answer queries
+SUPPORTED_MODES = ["ReAct: Query Engines & Internet", "Router-Based Query Engines", "SubQuestion-Based Query Engines"]
+
+# OpenAI model of each supported embedding name. Collections are queried with the embedding model
+# they were embedded with, so a collection can be migrated to another model while it is served.
+EMBEDDING_MODELS = {
+    'OpenAI text-embedding-3-small': "text-embedding-3-small",
+    'OpenAI text-embedding-3-large': "text-embedding-3-large"
+}
+
+# Models and hybrid query engines shared by all agents of the process. They are not modified after
+# they are created, so an agent (one per Gradio session) only keeps its settings, the router or
+# ReAct agent that combines the shared query engines, and its chat memory.
+# Keyed by everything that configures them, with a fingerprint of the API key instead of the key.
+# An object is dropped once no agent uses it and it is not among the most recently used objects, so
+# the objects (and API keys) of the sessions that ended do not accumulate.
+SHARED_OBJECTS_KEPT = 32
+_shared_objects = weakref.WeakValueDictionary()
+_recent_objects = OrderedDict()
+_shared_objects_lock = threading.Lock()
+
+
+def get_shared_object(key, factory):
+    """
+    Returns the shared object of a key, creating it with `factory` the first time.
+    Args:
+        key (tuple): The key of the object, starting with its kind ('llm', 'embedding' or 'query_engine').
+        factory (callable): A function without arguments that creates the object.
+    Returns:
+        The shared object, or None if `factory` returned None (it is not kept).
+    """
+    with _shared_objects_lock:
+        shared_object = _shared_objects.get(key)
+    if shared_object is None:
+        # Created outside the lock, since loading query engines takes a while; if two sessions
+        # create the same object at the same time, the first one is kept
+        shared_object = factory()
+        if shared_object is None:
+            return None
+        with _shared_objects_lock:
+            shared_object = _shared_objects.setdefault(key, shared_object)
+    with _shared_objects_lock:
+        _recent_objects[key] = shared_object
+        _recent_objects.move_to_end(key)
+        while len(_recent_objects) > SHARED_OBJECTS_KEPT:
+            _recent_objects.popitem(last=False)
+    return shared_object
+
+def evict_shared_query_engines(query_engine_name):
+    """
+    Removes the shared query engines of a collection, e.g. after it was deleted, so that a new
+    collection with the same name does not use them.
+    Args:
+        query_engine_name (str): The name of the query engine.
+    """
+    with _shared_objects_lock:
+        for key in [key for key in _shared_objects.keys() if key[0] == 'query_engine' and key[1] == query_engine_name]:
+            _shared_objects.pop(key, None)
+            _recent_objects.pop(key, None)
+
+
+class CatalogWatcher:
+    """
+    Follows the list of collections on disk, and drops the shared query engines and indices of the
+    collections that were deleted, changed, built again or switched to a new storage version (e.g. by a
+    refresh) since the list was last checked. Indices of the other collections are kept.
+    Attributes:
+        collection_manager (CollectionManager): The manager of the collections.
+    Methods:
+        refresh(force=False):
+    """
+
+    def __init__(self, collection_manager):
+        self.collection_manager = collection_manager
+
+        # Version of the list of collections, and the state of every collection, when they were last checked
+        self._lock = threading.Lock()
+        self._version = collection_manager.catalog_version()
+        self._catalog = self._snapshot()
+
+    def _snapshot(self):
+        """
+        Returns the details and the storage version of every collection, keyed by name.
+        """
+        return {
+            details['name']: (json.dumps(details, sort_keys=True), self.collection_manager.storage_version(details['name']))
+            for details in self.collection_manager.get_query_engines_detail()
+        }
+
+    def refresh(self, force=False):
+        """
+        Drops the shared query engines and indices of the collections that changed since the list of collections was last checked.
+        Args:
+            force (bool, optional): Whether the collections are compared even if the list of collections
+                                    has the same modification time. Defaults to False.
+        Returns:
+            list of str: The names of the collections whose query engines and indices were dropped.
+        """
+        version = self.collection_manager.catalog_version()
+        if not force and version == self._version:
+            return []
+
+        with self._lock:
+            catalog = self._snapshot()
+            changed = sorted(name for name in set(self._catalog) | set(catalog) if self._catalog.get(name) != catalog.get(name))
+            for name in changed:
+                evict_shared_query_engines(name)
+                if name in self._catalog:
+                    # The indices of the version that was served, since a refresh switches the collection to a new version
+                    details = json.loads(self._catalog[name][0])
+                    storage_names = self.collection_manager.shard_storage_names(
+                        name, num_shards=details.get('num_shards', 1), storage_version=details.get('storage_version', 0))
+                    for storage_name in storage_names:
+                        self.collection_manager.evict_shared_indices(storage_name)
+            self._catalog = catalog
+            self._version = version
+
+        if changed:
+            logging.info('>    Collections changed on disk: {}.'.format(', '.join(changed)))
+        return changed
+
 
 class UserAgent:
     """
@@ -22,8 +145,16 @@ class UserAgent:
         llm_name (str): The name of the language model to use.
         embedding_name (str): The name of the embedding model to use.
         openAI_api (str): The API key for accessing OpenAI services.
+        api_base (str): The base URL of the OpenAI API, e.g. of a local OpenAI-compatible server. None uses the default URL.
         query_engines_details (list): A list of details for query engines to be used.
         temperature (float): The temperature setting for the language model.
+        subquestion_max_parallel (int): Maximum number of sub-questions answered at the same time in SubQuestion mode.
+        subquestion_timeout (float): Maximum number of seconds for answering a single sub-question in SubQuestion mode.
+        context_token_budget (int): Maximum number of tokens of the retrieved context of a collection sent to the LLM. 0 disables the compression.
+        synthesis_mode (str): How answers of collections are synthesized: "single_call" or a response mode of LlamaIndex.
+        max_prompt_tokens (int): Maximum number of tokens of the synthesis prompt in "single_call" mode. None uses the context window.
+        adaptive_retrieval (dict): The 'AdaptiveRetrieval' configuration, which chooses the retrieval depth per query. None uses fixed depths.
+        reranking (dict): The 'Reranking' configuration: window size, passage length and parallelism of the reranker.
         model_llm (object): The language model instance.
         model_embd (object): The embedding model instance.
         agent (object): The agent instance for querying.
@@ -34,36 +165,83 @@ class UserAgent:
             Sets the language model based on the provided name.
         set_embd(embedding_name):
             Sets the embedding model based on the provided name.
+        embedding_model(embedding_name):
+            Returns the shared embedding model of a name, with which the collections embedded with it are queried.
+        query_engine(query_engine_details):
+            Returns the shared hybrid query engine of a collection.
         set_agent(query_engines_details):
             Sets up the agent with the provided query engines details.
         set_api(openAI_api):
             Sets the OpenAI API key and reinitializes the models and agent.
+        query(message):
+            Answers a message and returns the answer together with its references.
+        session_size():
+            Returns the memory used by the agent without the shared models and query engines.
     """
-    def __init__(self, llm_name, embedding_name, openAI_api, mode, query_engines_details=[], temperature=0, system_message=None):
+    def __init__(self, llm_name, embedding_name, openAI_api, mode, query_engines_details=[], temperature=0, system_message=None,
+                 subquestion_max_parallel=4, subquestion_timeout=60, api_base=None, context_token_budget=3000,
+                 synthesis_mode="single_call", max_prompt_tokens=None, adaptive_retrieval=None,
+                 reranking=None):
         
         self.llm_name = llm_name
         self.embedding_name = embedding_name
         self.openAI_api = openAI_api
+        self.api_base = api_base
         self.mode = mode
         self.temperature = temperature
+        self.subquestion_max_parallel = subquestion_max_parallel
+        self.subquestion_timeout = subquestion_timeout
+        self.context_token_budget = context_token_budget
+        self.synthesis_mode = synthesis_mode
+        self.max_prompt_tokens = max_prompt_tokens
+        self.adaptive_retrieval = adaptive_retrieval
+        self.reranking = reranking
 
         self.model_llm = None
         self.model_embd = None
+        self._llm_key = None
         self.agent = None
         
         self.memory = None
 
         self.query_engines_details = query_engines_details
         
-        if self.openAI_api != "":
-            self.set_llm(llm_name)
-            self.set_embd(embedding_name)
-
         if system_message is None:
             self.system_message = default_prompt()
         else:
             self.system_message = system_message
 
+        if self.openAI_api != "":
+            self.set_llm(llm_name)
+            self.set_embd(embedding_name)
+
+    def __deepcopy__(self, memo):
+        """
+        Gradio deep-copies the initial value of a state for every session. The copy shares the models
+        and query engines, and gets its own agent so that sessions do not share their chat memory.
+        """
+        agent_copy = copy.copy(self)
+        agent_copy.query_engines_details = copy.deepcopy(self.query_engines_details, memo)
+        agent_copy.agent = None
+        agent_copy.memory = None
+        if self.agent is not None:
+            agent_copy.set_agent(query_engines_details=agent_copy.query_engines_details)
+        return agent_copy
+
+    def session_size(self):
+        """
+        Estimates the memory used by this agent alone, i.e. without the models and query engines
+        it shares with the other agents of the process.
+        Returns:
+            int: The estimated number of bytes.
+        """
+        from trace_callbacks import trace_callback_manager
+
+        with _shared_objects_lock:
+            shared_objects = list(_shared_objects.values())
+        return object_size(self, exclude=shared_objects + [trace_callback_manager])
+
+    @profiled('interact_with_agent')
     def interact_with_agent(self, message, chat_history):
         """
         Interacts with the AI agent based on the selected mode and updates the chat history.
@@ -74,106 +252,40 @@ class UserAgent:
         tuple: An empty string and the updated chat history.
         Raises:
         ValueError: If the selected mode is not supported.
-        The function operates in two modes:
-        1. "ReAct: Query Engines & Internet": Sends the user's message to the AI agent and collects article names and links from the sources.
-        2. "Router-Based Query Engines": Sends the user's message to the Router Query Engine and collects article names and links from the source nodes.
-        The collected references are formatted and appended to the bot's message, which is then added to the chat history.
+        The answer and its references are obtained with `query`. The references are formatted and
+        appended to the bot's message, which is then added to the chat history.
         """
-        references = {}
-        if self.mode == "ReAct: Query Engines & Internet":
-            # Send the user's message to the AI agent 
-            try:
-                ai_answer = self.agent.chat(message)
-            except AuthenticationError:
-                bot_message = "An error occurred: Authentication Error. Please check your OpenAI API key."
-                chat_history.append({"role": "user", "content": message})
-                chat_history.append({"role": "assistant", "content": bot_message})
-                logging.error("Authentication error: Incorrect API key provided.")
-                return "", chat_history
-            except Exception as e:
-                bot_message = f"An error occurred: {e}"
-                chat_history.append({"role": "user", "content": message})
-                chat_history.append({"role": "assistant", "content": bot_message})
-                logging.error(f"An unexpected error occurred: {e}")
-                return "", chat_history
-            
-            bot_message = ai_answer.response
-
-            # Collect article names and links
-            for tool_output in ai_answer.sources:
-                raw_output = tool_output.raw_output
-                # Check if raw_output has the attribute 'source_nodes', to avoid situations when 
-                # the agent has not decided to retrieve any information from the query engines
-                if hasattr(raw_output, 'source_nodes'):
-                    for node in raw_output.source_nodes:
-                        name = node.node.metadata.get('Name')
-                        link = node.node.metadata.get('Link')
-                        if name and link:
-                            if name and link:
-                                current_score = node.score if node.score is not None else 0
-                                if name and len(name) > 80:
-                                    name = name[:80] + "..."
-                                if (name, link) in references:
-                                    # Update the score if the reference already exists
-                                    references[(name, link)] = max(references[(name, link)], current_score)
-                                else:
-                                    references[(name, link)] = current_score
-                else:
-                    # Handle the case where source_nodes isn't available
-                    logging.info("Warning: 'source_nodes' attribute not found in raw_output.")
-        
-        elif self.mode in ["Router-Based Query Engines", "SubQuestion-Based Query Engines"]:    
-            # Send the user's message to the Router Query Engine
-            try:
-                response = self.agent.query(message)
-            except AuthenticationError:
-                bot_message = "An error occurred: Authentication Error. Please check your OpenAI API key."
-                chat_history.append({"role": "user", "content": message})
-                chat_history.append({"role": "assistant", "content": bot_message})
-                logging.error("Authentication error: Incorrect API key provided.")
-                return "", chat_history
-            except Exception as e:
-                bot_message = f"An error occurred: {e}"
-                chat_history.append({"role": "user", "content": message})
-                chat_history.append({"role": "assistant", "content": bot_message})
-                logging.error(f"An unexpected error occurred: {e}")
-                return "", chat_history
-
-            bot_message = response.response
-            for source in response.source_nodes:
-                # Access the underlying node from the NodeWithScore object
-                node = source.node  
-                # Assuming metadata is stored as a dict in the node's metadata attribute:
-                metadata = node.metadata  
-                name = metadata.get('Name')
-                link = metadata.get('Link')
-                if name and link:
-                    current_score = source.score if source.score is not None else 0
-                    if name and len(name) > 80:
-                            name = name[:80] + "..."
-                    if (name, link) in references:
-                        # Update the score if the reference already exists
-                        references[(name, link)] = max(references[(name, link)], current_score)
-                    else:
-                        references[(name, link)] = current_score
-        else:
+        from openai import AuthenticationError
+
+        if self.mode not in SUPPORTED_MODES:
             raise ValueError('Selected mode is not supported.')
-        
+
+        try:
+            bot_message, references = self.query(message)
+        except AuthenticationError:
+            bot_message = "An error occurred: Authentication Error. Please check your OpenAI API key."
+            chat_history.append({"role": "user", "content": message})
+            chat_history.append({"role": "assistant", "content": bot_message})
+            logging.error("Authentication error: Incorrect API key provided.")
+            return "", chat_history
+        except Exception as e:
+            bot_message = f"An error occurred: {e}"
+            chat_history.append({"role": "user", "content": message})
+            chat_history.append({"role": "assistant", "content": bot_message})
+            logging.error(f"An unexpected error occurred: {e}")
+            return "", chat_history
+
         # Format the references
         if references:
-            # Sort the references by LLM Judge score 
-            references = sort_dict_by_values(references)
             formatted_references = []
-            # Loop through references
+            # Loop through references, sorted by LLM Judge score
             for item in references:
                 # Unpack the first part of the tuple and the score
                 (name, link), score = item
                 # Format the reference as needed
                 formatted_references.append(f"🔗 [{name}]({link}) ⭐ {score:.2f}/1  | " if score != 0 else f"🔗 [{name}]({link}) ⭐ -/1  | ")
 
-            references = formatted_references
-
-            references_text = "Some helpful articles, sorted by relevance according to LLM Judge, along with semantic scores:\n" + " ".join(references)
+            references_text = "Some helpful articles, sorted by relevance according to LLM Judge, along with semantic scores:\n" + " ".join(formatted_references)
             bot_message += "\n\n" + references_text
         
         # Update the chat history
@@ -181,6 +293,48 @@ class UserAgent:
         chat_history.append({"role": "assistant", "content": bot_message})
         return "", chat_history
 
+    @profiled('query')
+    def query(self, message):
+        """
+        Answers a message with the agent of the selected mode. Errors of the agent are raised.
+        The function operates in three modes:
+        1. "ReAct: Query Engines & Internet": Sends the message to the ReAct agent and collects the sources of its tool calls.
+        2. "Router-Based Query Engines": Sends the message to the Router Query Engine and collects its source nodes.
+        3. "SubQuestion-Based Query Engines": Sends the message to the SubQuestion Query Engine and collects its source nodes.
+        Args:
+            message (str): The user's message.
+        Returns:
+            tuple: The answer (str) and its references, a list of tuples ((name, link), score) sorted by score.
+        Raises:
+            ValueError: If the selected mode is not supported.
+        """
+        with trace_query("query", mode=self.mode, llm=self.llm_name, num_query_engines=len(self.query_engines_details)), request_scope():
+            source_nodes = []
+            if self.mode == "ReAct: Query Engines & Internet":
+                ai_answer = self.agent.chat(message)
+                answer = ai_answer.response
+                for tool_output in ai_answer.sources:
+                    raw_output = tool_output.raw_output
+                    # Check if raw_output has the attribute 'source_nodes', to avoid situations when 
+                    # the agent has not decided to retrieve any information from the query engines
+                    if hasattr(raw_output, 'source_nodes'):
+                        source_nodes.extend(raw_output.source_nodes)
+                    else:
+                        # Handle the case where source_nodes isn't available
+                        logging.info("Warning: 'source_nodes' attribute not found in raw_output.")
+                # The agent keeps every finished task with the outputs of its tools; the conversation
+                # itself is kept in the memory buffer, so the tasks are dropped to bound the session state
+                for task in self.agent.list_tasks():
+                    self.agent.delete_task(task.task_id)
+            elif self.mode in ["Router-Based Query Engines", "SubQuestion-Based Query Engines"]:
+                response = self.agent.query(message)
+                answer = response.response
+                source_nodes = response.source_nodes
+            else:
+                raise ValueError('Selected mode is not supported.')
+
+        return answer, collect_references(source_nodes)
+
 
     def set_llm(self, llm_name):
         """
@@ -192,33 +346,128 @@ class UserAgent:
         Raises:
         ValueError: If the provided LLM name is not supported.
         """
+        from cached_models import CachedOpenAI
+        from trace_callbacks import trace_callback_manager
 
-        self.llm_name = llm_name
-        if self.llm_name == 'OpenAI GPT-4o mini':
-            self.model_llm = OpenAI(model="gpt-4o-mini", temperature=self.temperature, api_key=self.openAI_api, system_prompt=self.system_message)
-        elif self.llm_name == 'OpenAI GPT-4o':
-            self.model_llm = OpenAI(model="gpt-4o", temperature=self.temperature, api_key=self.openAI_api, system_prompt=self.system_message)
+        if llm_name == 'OpenAI GPT-4o mini':
+            model = "gpt-4o-mini"
+        elif llm_name == 'OpenAI GPT-4o':
+            model = "gpt-4o"
         else:
             raise ValueError('Selected LLM name is not supported.')
 
+        self.llm_name = llm_name
+        self._llm_key = ('llm', model, self.temperature, self.system_message, credential_fingerprint(self.openAI_api), self.api_base)
+        self.model_llm = get_shared_object(
+            key=self._llm_key,
+            factory=lambda: CachedOpenAI(model=model, temperature=self.temperature, api_key=self.openAI_api, system_prompt=self.system_message,
+                                         api_base=self.api_base, callback_manager=trace_callback_manager)
+        )
+
 
     def set_embd(self, embedding_name):
         """
         Sets the embedding model based on the provided embedding name.
 
         Parameters:
-        embedding_name (str): The name of the embedding model to be set. Currently, only 'OpenAI text-embedding-3-small' is supported.
+        embedding_name (str): The name of the embedding model to be set, one of `EMBEDDING_MODELS` or a local model (see `local_embeddings`).
 
         Raises:
         ValueError: If the provided embedding name is not supported.
         """
+        self.model_embd = self.embedding_model(embedding_name)
         self.embedding_name = embedding_name
-        if self.embedding_name == 'OpenAI text-embedding-3-small':
-            self.model_embd = OpenAIEmbedding(model="text-embedding-3-small", api_key=self.openAI_api)
-        else:
+
+
+    def embedding_model(self, embedding_name):
+        """
+        Returns the shared embedding model of an embedding name, e.g. to query a collection with the model it was embedded with.
+
+        Parameters:
+        embedding_name (str): The name of the embedding model, one of `EMBEDDING_MODELS` or a local model (see `local_embeddings`).
+
+        Returns:
+        CachedOpenAIEmbedding or LocalEmbedding: The embedding model.
+
+        Raises:
+        ValueError: If the provided embedding name is not supported.
+        """
+        from cached_models import CachedOpenAIEmbedding
+        from local_models import LocalEmbedding
+        from local_embeddings import is_local_embedding
+        from trace_callbacks import trace_callback_manager
+
+        key = self._embedding_key(embedding_name)
+        if is_local_embedding(embedding_name):
+            return get_shared_object(
+                key=key,
+                factory=lambda: LocalEmbedding(model_name=embedding_name, callback_manager=trace_callback_manager)
+            )
+        return get_shared_object(
+            key=key,
+            factory=lambda: CachedOpenAIEmbedding(model=key[1], api_key=self.openAI_api,
+                                                  api_base=self.api_base, callback_manager=trace_callback_manager)
+        )
+
+    def _embedding_key(self, embedding_name):
+        """
+        Returns the key of the shared embedding model of an embedding name.
+        Raises:
+            ValueError: If the provided embedding name is not supported.
+        """
+        from local_embeddings import is_local_embedding
+
+        if is_local_embedding(embedding_name):
+            # Computed in the process, so it does not depend on the API key
+            return ('embedding', embedding_name)
+        if embedding_name not in EMBEDDING_MODELS:
             raise ValueError('Selected Embedding name is not supported.')
+        return ('embedding', EMBEDDING_MODELS[embedding_name], credential_fingerprint(self.openAI_api), self.api_base)
     
 
+    def query_engine(self, query_engine_details):
+        """
+        Returns the hybrid query engine (semantic + keyword-based) of a collection, shared by the agents with
+        the same models and settings, loading it the first time.
+        Args:
+            query_engine_details (dict): The details of the collection, with its 'name' and 'description'.
+        Returns:
+            HybridQueryEngine: The query engine, or None if it could not be loaded.
+        """
+        from knowledgeBase.hybrid_query_engine import load_hybrid_query_engine
+
+        # Queries of a collection are embedded with the model its chunks were embedded with
+        model_embd = self.model_embd
+        embedding_name = query_engine_details.get('embedding_name', self.embedding_name)
+        if embedding_name != self.embedding_name:
+            try:
+                model_embd = self.embedding_model(embedding_name)
+            except ValueError:
+                logging.warning('>    {} was embedded with {}, which is not supported; it is queried with {}.'.format(
+                    query_engine_details['name'], embedding_name, self.embedding_name))
+                embedding_name = self.embedding_name
+
+        # The models are shared objects too, so their keys identify them. A refreshed collection is
+        # stored under a new version, whose query engine is a new one.
+        return get_shared_object(
+            key=('query_engine', query_engine_details['name'], query_engine_details['description'],
+                 query_engine_details.get('storage_version', 0), query_engine_details.get('num_shards', 1),
+                 self._llm_key, self._embedding_key(embedding_name),
+                 self.context_token_budget, self.synthesis_mode, self.max_prompt_tokens,
+                 json.dumps(self.adaptive_retrieval, sort_keys=True), json.dumps(self.reranking, sort_keys=True)),
+            factory=lambda: load_hybrid_query_engine(
+                        model_llm=self.model_llm,
+                        model_embd=model_embd,
+                        query_engine_name=query_engine_details['name'],
+                        query_engine_description=query_engine_details['description'],
+                        context_token_budget=self.context_token_budget,
+                        synthesis_mode=self.synthesis_mode,
+                        max_prompt_tokens=self.max_prompt_tokens,
+                        adaptive_retrieval=self.adaptive_retrieval,
+                        reranking=self.reranking
+                    )
+        )
+
     def set_agent(self, query_engines_details):
         """
         Set up the agent with the provided query engines details.
@@ -232,24 +481,36 @@ class UserAgent:
         Raises:
             ValueError: If the selected mode is not supported.
         """
+        from llama_index.core.agent.react import ReActAgent
+        from llama_index.core.tools import QueryEngineTool, FunctionTool
+        from llama_index.core.memory import ChatMemoryBuffer
+        from llama_index.core.query_engine import RouterQueryEngine, SubQuestionQueryEngine
+        from knowledgeBase.bounded_query_engine import BoundedQueryEngine, create_query_semaphore
+        from trace_callbacks import trace_callback_manager, TracedPydanticMultiSelector
+
         self.query_engines_details = query_engines_details
 
+        # In SubQuestion mode, sub-questions are answered concurrently. All query engines share
+        # one semaphore so that the parallelism limit applies to the whole query.
+        query_semaphore = create_query_semaphore(self.subquestion_max_parallel)
+
         # Load and initialize query engines based on provided set of query engines
         qs_list = []
         for qs_detail_i in query_engines_details:
             print(qs_detail_i)
-            # Load hybrid query engine: Semantic + Keyword-based
-            qs_i = load_hybrid_query_engine(
-                            model_llm=self.model_llm, 
-                            model_embd=self.model_embd, 
-                            query_engine_name=qs_detail_i['name'], 
-                            query_engine_description=qs_detail_i['description']
-                        )
+            qs_i = self.query_engine(qs_detail_i)
 
             if qs_i is None:
                 logging.info('>    Query engine {} could not be loaded.'.format(qs_detail_i['name']))
             else:
                 logging.info('>    Query engine {} was loaded.'.format(qs_detail_i['name']))
+                if self.mode == "SubQuestion-Based Query Engines":
+                    qs_i = BoundedQueryEngine(
+                        query_engine=qs_i,
+                        query_engine_name=qs_detail_i['name'],
+                        semaphore=query_semaphore,
+                        timeout=self.subquestion_timeout
+                    )
                 # Create a QueryEngine tool instance from the loaded query engine
                 qs_i_tool = QueryEngineTool.from_defaults(
                    query_engine=qs_i,
@@ -268,20 +529,24 @@ class UserAgent:
                 tools=qs_list+[search_tool],
                 llm=self.model_llm,
                 memory=self.memory,
+                callback_manager=trace_callback_manager,
                 verbose=True
             )
         elif self.mode == "Router-Based Query Engines":
             # Create a RouterQueryEngine using the list of tools
             self.agent = RouterQueryEngine(
-                            selector=PydanticMultiSelector.from_defaults(llm=self.model_llm),
+                            selector=TracedPydanticMultiSelector.from_defaults(llm=self.model_llm),
                             query_engine_tools=qs_list,
                             llm=self.model_llm,
                             verbose=True
                         )
         elif self.mode == "SubQuestion-Based Query Engines":
+            # Sub-questions run concurrently; the ones that fail or time out are skipped
+            # and the answer is synthesized from the remaining ones
             self.agent = SubQuestionQueryEngine.from_defaults(
                 query_engine_tools=qs_list,
                 llm=self.model_llm,
+                use_async=True,
                 verbose=True
             )
         else:
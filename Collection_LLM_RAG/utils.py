@@ -1,5 +1,6 @@
 import re
-from duckduckgo_search import DDGS
+import time
+import threading
 from knowledgeBase.text_extraction_webpages import extract_text_from_url
 from types import SimpleNamespace
 
@@ -31,6 +32,28 @@ def sort_dict_by_values(my_dict):
     sorted_items = sorted(my_dict.items(), key=lambda item: item[1], reverse=True)
     return sorted_items
 
+def collect_references(source_nodes, max_name_length=80):
+    """
+    Collects the names and links of the sources of an answer, keeping the highest score of each source.
+    Args:
+        source_nodes (list of NodeWithScore): The retrieved nodes the answer is based on.
+        max_name_length (int): Names longer than this are shortened.
+    Returns:
+        list: A list of tuples ((name, link), score) sorted by score in descending order.
+    """
+    references = {}
+    for source in source_nodes:
+        metadata = source.node.metadata
+        name = metadata.get('Name')
+        link = metadata.get('Link')
+        if name and link:
+            current_score = source.score if source.score is not None else 0
+            if len(name) > max_name_length:
+                name = name[:max_name_length] + "..."
+            # Keep the highest score if the reference already exists
+            references[(name, link)] = max(references.get((name, link), current_score), current_score)
+    return sort_dict_by_values(references)
+
 def format_collection_name(name: str) -> str:
     """
     Formats a collection name by applying several transformations to ensure it is valid.
@@ -63,6 +86,33 @@ def format_collection_name(name: str) -> str:
     # Truncate to 63 characters if too long
     return name[:63] if name else "default_name"  # Provide a fallback name if empty
 
+class RateLimiter:
+    """
+    A thread-safe limiter that spaces calls evenly to at most `rate_per_minute` calls per minute.
+    Attributes:
+        rate_per_minute (float): The maximum number of calls per minute. 0 or None disables the limit.
+    Methods:
+        acquire(): Blocks until the next call is allowed.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.rate_per_minute = rate_per_minute
+        self._lock = threading.Lock()
+        self._next_time = time.monotonic()
+
+    def acquire(self):
+        """
+        Blocks until the next call is allowed.
+        """
+        if not self.rate_per_minute:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_time - now
+            self._next_time = max(now, self._next_time) + 60.0 / self.rate_per_minute
+        if wait > 0:
+            time.sleep(wait)
+
 
 def internet_search(query: str) -> SimpleNamespace:
     """
@@ -78,6 +128,8 @@ def internet_search(query: str) -> SimpleNamespace:
     
     In case of an error during the search, returns a SimpleNamespace with an 'error' attribute describing the issue.
     """
+    from duckduckgo_search import DDGS
+
     try:
         response = DDGS().text(query, max_results=5)
     except Exception as e:
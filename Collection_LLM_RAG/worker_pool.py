@@ -0,0 +1,355 @@
+import time
+import uuid
+import queue
+import logging
+import threading
+import contextvars
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+from knowledgeBase.collection import CollectionManager
+
+# This module only depends on the standard library and the collection manager in the front process:
+# LlamaIndex, Chroma and the indices are only imported and loaded by the worker processes.
+#
+# The front process sends every request to the worker process with the fewest running requests,
+# through a queue of its own, and receives the results of all workers through a shared queue. Every
+# worker runs a QueryService over the same collections on disk, opened read-only: the SQLite stores
+# are memory-mapped, so their pages are shared by all workers through the page cache.
+
+# Messages of the workers are (request id, kind, payload), and a request is finished by its
+# 'result', 'error' or 'done' message
+_final_kinds = ('result', 'error', 'done')
+
+
+class WorkerAuthenticationError(Exception):
+    """
+    Raised in the front process when a worker was refused by the OpenAI API because of its API key.
+    """
+
+
+def _error_kind(error):
+    """
+    Returns the kind of an exception of a worker, which decides the exception raised in the front process.
+    """
+    from openai import AuthenticationError
+
+    if isinstance(error, AuthenticationError):
+        return 'authentication'
+    if isinstance(error, ValueError):
+        return 'value'
+    return 'error'
+
+def _run_request(service, result_queue, request_id, method, kwargs):
+    """
+    Runs a request in a worker process and sends its result, or the text deltas of a streamed answer, to the front process.
+    """
+    try:
+        if method == 'stream_query':
+            tokens, references = service.stream_query(**kwargs)
+            result_queue.put((request_id, 'references', references))
+            for token in tokens:
+                if token:
+                    result_queue.put((request_id, 'token', token))
+            result_queue.put((request_id, 'done', None))
+        else:
+            result_queue.put((request_id, 'result', getattr(service, method)(**kwargs)))
+    except Exception as e:
+        logging.error('>    Request {} failed in the worker: {}'.format(method, e))
+        result_queue.put((request_id, 'error', (_error_kind(e), str(e))))
+
+def _worker_main(index, service_kwargs, config, worker_threads, task_queue, result_queue):
+    """
+    Main function of a worker process: answers the requests of its queue in `worker_threads` threads until it receives None.
+    """
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - worker {} - %(levelname)s - %(message)s'.format(index))
+
+    from query_service import QueryService
+    from instrumentation import configure_instrumentation
+    from trace_callbacks import register_trace_callbacks
+    from call_cache import configure_call_cache
+    from profiling import configure_profiling
+    from local_embeddings import configure_local_embeddings
+    from knowledgeBase.shards import configure_sharding
+
+    # Every worker serves its own metrics on the next ports after the port of the front process
+    instrumentation = dict(config['Instrumentation'])
+    if instrumentation.get('metrics_port') is not None:
+        instrumentation['metrics_port'] += 1 + index
+    configure_instrumentation(instrumentation)
+    register_trace_callbacks()
+    configure_call_cache(config['CallCache'])
+    configure_profiling(config['Profiling'])
+    configure_local_embeddings(config['LocalEmbedding'])
+    # The workers already run in parallel, so they search the shards of collections in threads
+    configure_sharding(dict(config['Sharding'], search_processes=0))
+
+    service = QueryService(**service_kwargs)
+    executor = ThreadPoolExecutor(max_workers=worker_threads, thread_name_prefix='request')
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        request_id, method, kwargs = task
+        # Catalog changes are applied before the requests that follow them in the queue
+        if method == 'refresh_catalog':
+            _run_request(service, result_queue, request_id, method, kwargs)
+        else:
+            executor.submit(_run_request, service, result_queue, request_id, method, kwargs)
+    executor.shutdown(wait=True)
+
+
+class QueryWorkerPool:
+    """
+    Answers queries in worker processes, each with its own QueryService, so that the CPU-bound parts of
+    the requests (keyword lookup, parsing of web pages, preparation of the reranking, JSON handling) run
+    in parallel on several cores instead of sharing the GIL of one process. It has the methods of
+    QueryService used by the HTTP API. Requests go to the worker with the fewest running requests, and
+    a worker that exits is started again. The list of collections is watched by the front process:
+    when it changes, every worker drops the agents and indices of the changed collections without
+    being restarted (workers also check it before every request).
+    Attributes:
+        num_workers (int): The number of worker processes.
+        worker_threads (int): The maximum number of requests answered at the same time by a worker.
+        max_batch_concurrency (int): Maximum number of questions of a batch answered at the same time.
+        collection_manager (CollectionManager): The manager of the collections, for listing them.
+    Methods:
+        list_collections():
+        refresh_catalog(force=False):
+        preload_collections(collections=None):
+        query(question, mode=None, collections=None):
+        batch_query(questions, mode=None, collections=None, max_concurrency=None):
+        stream_query(question, collections=None):
+        shutdown():
+    """
+
+    def __init__(self, num_workers, service_kwargs, config, worker_threads=8, max_batch_concurrency=8, catalog_poll_seconds=2.0):
+        """
+        Starts the worker processes.
+        Args:
+            num_workers (int): The number of worker processes.
+            service_kwargs (dict): The arguments of the QueryService of every worker. They are sent to the
+                                   workers, so they must be picklable.
+            config (dict): The configuration file, for the instrumentation, call cache and sharding of the workers.
+            worker_threads (int, optional): The maximum number of requests answered at the same time by a worker. Defaults to 8.
+            max_batch_concurrency (int, optional): Maximum number of questions of a batch answered at the same time. Defaults to 8.
+            catalog_poll_seconds (float, optional): How often the list of collections is checked for changes. Defaults to 2.
+        """
+        self.num_workers = num_workers
+        self.worker_threads = worker_threads
+        self.max_batch_concurrency = max_batch_concurrency
+        self.collection_manager = CollectionManager()
+        self._service_kwargs = service_kwargs
+        self._config = config
+        self._catalog_poll_seconds = catalog_poll_seconds
+
+        # Workers are spawned, since forking a process with running threads is unsafe
+        self._context = multiprocessing.get_context('spawn')
+        self._result_queue = self._context.Queue()
+        self._task_queues = [None] * num_workers
+        self._processes = [None] * num_workers
+        self._running = [0] * num_workers
+        # Queue of the messages of each unfinished request (None if nobody waits for them) and its worker
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        for index in range(num_workers):
+            self._start_worker(index)
+        self._catalog_version = self.collection_manager.catalog_version()
+        self._supervisor = threading.Thread(target=self._supervise, name='worker-pool', daemon=True)
+        self._supervisor.start()
+        logging.info('>    Started {} worker processes with {} threads each.'.format(num_workers, worker_threads))
+
+    def _start_worker(self, index):
+        """
+        Starts the worker process of a slot, with a new task queue.
+        """
+        self._task_queues[index] = self._context.Queue()
+        self._processes[index] = self._context.Process(
+            target=_worker_main,
+            args=(index, self._service_kwargs, self._config, self.worker_threads, self._task_queues[index], self._result_queue),
+            name='query-worker-{}'.format(index),
+            daemon=True
+        )
+        self._processes[index].start()
+
+    def _supervise(self):
+        """
+        Routes the messages of the workers to the waiting requests, restarts the workers that exited, and
+        broadcasts changes of the list of collections.
+        """
+        next_check = 0.0
+        while not self._stopped.is_set():
+            try:
+                request_id, kind, payload = self._result_queue.get(timeout=0.5)
+            except queue.Empty:
+                request_id = None
+            if request_id is not None:
+                with self._lock:
+                    messages, index = self._pending.get(request_id, (None, None))
+                    if kind in _final_kinds and request_id in self._pending:
+                        del self._pending[request_id]
+                        self._running[index] -= 1
+                if messages is not None:
+                    messages.put((kind, payload))
+
+            now = time.monotonic()
+            if now >= next_check:
+                next_check = now + self._catalog_poll_seconds
+                self._restart_exited_workers()
+                version = self.collection_manager.catalog_version()
+                if version != self._catalog_version:
+                    self._catalog_version = version
+                    for index in range(self.num_workers):
+                        self._dispatch('refresh_catalog', {}, index=index, wait=False)
+
+    def _restart_exited_workers(self):
+        """
+        Fails the unfinished requests of the workers that exited and starts them again.
+        """
+        for index, process in enumerate(self._processes):
+            if process.is_alive() or self._stopped.is_set():
+                continue
+            logging.error('>    Worker process {} exited with code {}, starting it again.'.format(index, process.exitcode))
+            with self._lock:
+                failed = [(request_id, messages) for request_id, (messages, worker) in self._pending.items() if worker == index]
+                for request_id, _ in failed:
+                    del self._pending[request_id]
+                self._running[index] = 0
+                self._start_worker(index)
+            for _, messages in failed:
+                if messages is not None:
+                    messages.put(('error', ('error', 'The worker process answering the request exited.')))
+
+    def _dispatch(self, method, kwargs, index=None, wait=True):
+        """
+        Sends a request to a worker, by default the one with the fewest running requests.
+        Returns:
+            queue.Queue: The queue of the messages of the request, or None if `wait` is False.
+        """
+        request_id = uuid.uuid4().hex
+        messages = queue.Queue() if wait else None
+        with self._lock:
+            if index is None:
+                index = min(range(self.num_workers), key=lambda idx: self._running[idx])
+            self._running[index] += 1
+            self._pending[request_id] = (messages, index)
+            self._task_queues[index].put((request_id, method, kwargs))
+        return messages
+
+    @staticmethod
+    def _raise(payload):
+        """
+        Raises the exception of a failed request in the front process.
+        """
+        kind, message = payload
+        if kind == 'authentication':
+            raise WorkerAuthenticationError(message)
+        if kind == 'value':
+            raise ValueError(message)
+        raise RuntimeError(message)
+
+    def _call(self, method, index=None, **kwargs):
+        """
+        Runs a request in a worker and returns its result.
+        """
+        kind, payload = self._dispatch(method, kwargs, index=index).get()
+        if kind == 'error':
+            self._raise(payload)
+        return payload
+
+    def list_collections(self):
+        """
+        Returns the collections that can be queried.
+        Returns:
+            list of dict: The name, description and embedding model of each collection.
+        """
+        return self.collection_manager.get_query_engines_detail()
+
+    def refresh_catalog(self, force=False):
+        """
+        Makes every worker drop the agents and indices of the collections that changed on disk.
+        Args:
+            force (bool, optional): Whether the collections are compared even if the list of collections
+                                    has the same modification time. Defaults to False.
+        Returns:
+            list of str: The names of the changed collections.
+        """
+        changed = [self._call('refresh_catalog', index=index, force=force) for index in range(self.num_workers)]
+        return sorted(set(name for names in changed for name in names))
+
+    def preload_collections(self, collections=None):
+        """
+        Loads the indices of collections in every worker, so that the first queries do not wait for them.
+        Args:
+            collections (list of str, optional): The names of the collections. Defaults to all collections.
+        Raises:
+            ValueError: If a collection does not exist.
+        """
+        pending = [self._dispatch('preload_collections', {"collections": collections}, index=index) for index in range(self.num_workers)]
+        for messages in pending:
+            kind, payload = messages.get()
+            if kind == 'error':
+                self._raise(payload)
+
+    def query(self, question, mode=None, collections=None, profile=False):
+        """
+        Answers a question in a worker. See `QueryService.query`.
+        Raises:
+            ValueError: If the mode or a collection is not supported, or no collection is available.
+            WorkerAuthenticationError: If the OpenAI API key is incorrect.
+        """
+        return self._call('query', question=question, mode=mode, collections=collections, profile=profile)
+
+    def batch_query(self, questions, mode=None, collections=None, max_concurrency=None):
+        """
+        Answers several questions concurrently, spread over the workers. See `QueryService.batch_query`.
+        """
+        max_concurrency = min(max_concurrency or self.max_batch_concurrency, self.max_batch_concurrency)
+
+        def answer(question):
+            try:
+                return self.query(question=question, mode=mode, collections=collections)
+            except Exception as e:
+                logging.error('>    Batch question could not be answered: {}'.format(e))
+                return {"question": question, "error": str(e)}
+
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, answer, question) for question in questions]
+            return [future.result() for future in futures]
+
+    def stream_query(self, question, collections=None):
+        """
+        Answers a question in a worker and streams the answer. See `QueryService.stream_query`.
+        Returns:
+            tuple: A generator of the text deltas of the answer, and the references of the answer.
+        Raises:
+            ValueError: If a collection does not exist or no collection is available.
+            WorkerAuthenticationError: If the OpenAI API key is incorrect.
+        """
+        messages = self._dispatch('stream_query', {"question": question, "collections": collections})
+        kind, payload = messages.get()
+        if kind == 'error':
+            self._raise(payload)
+
+        def tokens():
+            while True:
+                kind, payload = messages.get()
+                if kind == 'done':
+                    return
+                if kind == 'error':
+                    self._raise(payload)
+                yield payload
+
+        return tokens(), payload
+
+    def shutdown(self):
+        """
+        Stops the worker processes after their running requests.
+        """
+        self._stopped.set()
+        for task_queue in self._task_queues:
+            task_queue.put(None)
+        for process in self._processes:
+            process.join(timeout=30)